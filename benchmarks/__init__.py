@@ -0,0 +1,8 @@
+"""
+Performance benchmarks for the books api.
+
+    python -m benchmarks.run --transactions 100000 --output results.json
+
+See benchmarks/run.py for options and benchmarks/ledger.py for the
+synthetic data.
+"""
@@ -0,0 +1,133 @@
+"""
+Compare per-request commits with group commit for concurrent writes.
+
+    python -m benchmarks.group_commit --threads 16 --requests 4000
+
+Each mode sends the same number of PUT /accounts/<id>/transactions
+requests from --threads concurrent clients against a SQLite file, then
+reports per-request latency percentiles, write throughput and failures.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import tempfile
+import threading
+
+from books_api import app, db
+
+from benchmarks import ledger
+from benchmarks.run import percentile, git_commit
+
+modes = [
+    ("per-request commit", False),
+    ("group commit", True),
+]
+
+
+def writer(account_ids, count, seed, timings, failures):
+    client = app.test_client()
+    rng = random.Random(seed)
+    for _ in range(count):
+        body = json.dumps({
+            "date": datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+            "description": "benchmark",
+            "amount": rng.randrange(1, 10000),
+            "type": "debit",
+            "category": "none",
+        })
+        start = time.time()
+        r = client.put('/accounts/{}/transactions'.format(rng.choice(account_ids)),
+                       data=body, content_type='application/json')
+        elapsed = time.time() - start
+        if r.status_code == 200:
+            timings.append(elapsed)
+        else:
+            failures.append(r.status_code)
+
+
+def run_mode(group_commit, account_ids, threads, requests):
+    """
+    :return: dict of latency statistics in milliseconds, writes per second
+    and number of failed requests
+    """
+    app.config['GROUP_COMMIT_ENABLED'] = group_commit
+    timings = []
+    failures = []
+    workers = [threading.Thread(target=writer, args=(account_ids, requests // threads, i, timings, failures))
+               for i in range(threads)]
+
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.time() - start
+
+    timings.sort()
+    return {
+        'requests': len(timings) + len(failures),
+        'failed': len(failures),
+        'p50_ms': percentile(timings, 50) * 1000 if timings else None,
+        'p95_ms': percentile(timings, 95) * 1000 if timings else None,
+        'p99_ms': percentile(timings, 99) * 1000 if timings else None,
+        'throughput_per_s': len(timings) / elapsed,
+    }
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--accounts", type=int, default=5)
+    parser.add_argument("--transactions", type=int, default=10000,
+                        help="Size of the generated book written to")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=2000, help="Writes per mode")
+    parser.add_argument("--max-items", type=int, default=None)
+    parser.add_argument("--max-delay", type=float, default=None, help="Seconds")
+    parser.add_argument("--database", help="New or empty SQLite file to use, a temporary one by default")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    database = args.database or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + database
+    if args.max_items is not None:
+        app.config['GROUP_COMMIT_MAX_ITEMS'] = args.max_items
+    if args.max_delay is not None:
+        app.config['GROUP_COMMIT_MAX_DELAY'] = args.max_delay
+
+    try:
+        account_ids = ledger.generate(args.accounts, transactions=args.transactions)
+    except ledger.DatabaseNotEmpty as e:
+        sys.exit(str(e))
+    db.session.remove()
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'parameters': vars(args),
+        'modes': {},
+    }
+
+    print("{:<20} {:>10} {:>10} {:>10} {:>12} {:>8}".format(
+        "mode", "p50 ms", "p95 ms", "p99 ms", "writes/s", "failed"))
+    for name, enabled in modes:
+        stats = run_mode(enabled, account_ids, args.threads, args.requests)
+        results['modes'][name] = stats
+        print("{:<20} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.1f} {:>8}".format(
+            name, stats['p50_ms'] or 0, stats['p95_ms'] or 0, stats['p99_ms'] or 0,
+            stats['throughput_per_s'], stats['failed']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Synthetic books for benchmarking.
+
+Generates accounts, categories and transactions with roughly realistic
+shapes: many small debits with a long tail of large ones, category use
+skewed towards a few popular categories, more activity on weekdays and
+a regular paycheck credit per account.
+"""
+import bisect
+import random
+import datetime
+
+from books_api import db
+from books_api.models import Category, Account, Transaction, TransactionSummary
+from books_api.models import account_types
+
+base_categories = [
+    "none", "paycheck", "bills", "grocery", "dining", "gas", "rent",
+    "utilities", "travel", "health", "entertainment", "shopping",
+]
+
+merchants = [
+    "Safeway", "Shell", "Amazon", "Chipotle", "Comcast", "PG&E", "Target",
+    "Costco", "Uber", "Delta", "Walgreens", "Netflix", "Starbucks", "REI",
+]
+
+
+class DatabaseNotEmpty(Exception):
+    pass
+
+
+def category_names(count):
+    names = base_categories[:count]
+    names.extend("category-{}".format(i) for i in range(len(names), count))
+    return names
+
+
+def random_date(rng, start, days):
+    # Weekends see about half the activity of weekdays.
+    while True:
+        date = start + datetime.timedelta(days=rng.randrange(days))
+        if date.weekday() < 5 or rng.random() < 0.5:
+            return date
+
+
+def generate_transactions(rng, account_ids, categories, count, start, days):
+    """
+    :return: Iterator of row dicts for the transaction table
+    """
+    # Zipf-like weights, the first categories are used far more often.
+    spending = [c for c in categories if c != "paycheck"]
+    cumulative = []
+    total = 0.0
+    for rank in range(len(spending)):
+        total += 1.0 / (rank + 1)
+        cumulative.append(total)
+
+    for i in range(count):
+        account_id = account_ids[i % len(account_ids)]
+        date = random_date(rng, start, days)
+
+        if i % 20 == 0:
+            # Roughly biweekly paychecks
+            yield {
+                'account_id': account_id,
+                'description': "Payroll deposit",
+                'amount': 250000 + rng.randrange(0, 5000),
+                'type': "credit",
+                'date': date,
+                'category': "paycheck",
+            }
+            continue
+
+        yield {
+            'account_id': account_id,
+            'description': "{} #{}".format(rng.choice(merchants), rng.randrange(1000)),
+            # Log-normal amounts, median around $30
+            'amount': max(1, int(rng.lognormvariate(8.0, 1.2))),
+            'type': "debit",
+            'date': date,
+            'category': spending[bisect.bisect(cumulative, rng.random() * total)],
+        }
+
+
+def generate(accounts=5, categories=12, transactions=10000, years=5, seed=0, chunk_size=10000):
+    """
+    Fill the empty database with a synthetic book.
+    Transactions are written with executemany in chunks, then balances,
+    running balances and the summary rollup are computed afterwards.
+    :return: List of account ids
+    Raises DatabaseNotEmpty if the database already holds a book, results
+    on top of other data are not comparable between runs.
+    """
+    rng = random.Random(seed)
+    db.create_all()
+    for model in (Account, Category, Transaction):
+        if db.session.query(model.query.exists()).scalar():
+            raise DatabaseNotEmpty("{} already holds data, benchmark an empty database.".format(
+                db.engine.url.database))
+
+    names = category_names(categories)
+    Category.add_categories(names)
+
+    new_accounts = [Account(description="Account {}".format(i), type=account_types[i % len(account_types)])
+                    for i in range(accounts)]
+    for account in new_accounts:
+        db.session.add(account)
+    db.session.commit()
+    account_ids = [a.id for a in new_accounts]
+
+    days = 365 * years
+    start = datetime.date.today() - datetime.timedelta(days=days)
+    rows = generate_transactions(rng, account_ids, names, transactions, start, days)
+
+    category_ids = Category.load_categories()
+    table = Transaction.__table__
+    chunk = []
+    for row in rows:
+        row['category_id'] = category_ids[row.pop('category')]
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            db.session.execute(table.insert(), chunk)
+            db.session.commit()
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+        db.session.commit()
+
+    signed = Transaction.signed_amount_column()
+    db.session.execute(Account.__table__.update().values(
+        balance=db.select([db.func.coalesce(db.func.sum(signed), 0)])
+        .where(Transaction.account_id == Account.id)
+        .as_scalar()
+    ))
+    for account_id in account_ids:
+        Transaction.recompute_balances(account_id)
+    TransactionSummary.rebuild()
+    db.session.commit()
+
+    return account_ids
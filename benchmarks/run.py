@@ -0,0 +1,414 @@
+"""
+Measure latency and throughput of every endpoint and model query.
+
+    python -m benchmarks.run --transactions 1000000 --output after.json \
+        --baseline before.json
+
+A synthetic book is generated in a scratch SQLite database (see
+benchmarks/ledger.py), each case is run --repeat times and p50/p95/p99
+latencies plus throughput are reported and optionally saved as JSON.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+
+from books_api import app, db
+from books_api.models import Category, Account, Transaction, TransactionSummary
+from books_api.views import cashflow_cache
+
+from benchmarks import ledger
+
+# (name, function) pairs, filled in by the decorators below.
+endpoint_cases = []
+model_cases = []
+
+
+def endpoint(name):
+    def register(func):
+        endpoint_cases.append((name, func))
+        return func
+    return register
+
+
+def model(name):
+    def register(func):
+        model_cases.append((name, func))
+        return func
+    return register
+
+
+class Context(object):
+    """ State shared by the cases: test client, ids and a random source. """
+    def __init__(self, client, account_ids, categories, seed=0):
+        self.client = client
+        self.account_ids = account_ids
+        self.categories = categories
+        self.rng = random.Random(seed)
+        self.counter = 0
+
+    def account_id(self):
+        return self.rng.choice(self.account_ids)
+
+    def unique(self, prefix):
+        self.counter += 1
+        return "{}-{}-{}".format(prefix, os.getpid(), self.counter)
+
+    def transaction(self):
+        return {
+            "date": datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+            "description": "benchmark",
+            "amount": self.rng.randrange(1, 10000),
+            "type": self.rng.choice(["debit", "credit"]),
+            "category": self.rng.choice(self.categories),
+        }
+
+    def get(self, uri, **kwargs):
+        r = self.client.get(uri, **kwargs)
+        r.get_data()
+        if r.status_code not in (200, 304):
+            raise RuntimeError("GET {} failed [{}]: {}".format(uri, r.status_code, r.data))
+        return r
+
+    def put(self, uri, body):
+        r = self.client.put(uri, data=json.dumps(body), content_type='application/json')
+        if r.status_code != 200:
+            raise RuntimeError("PUT {} failed [{}]: {}".format(uri, r.status_code, r.data))
+        return r
+
+
+@endpoint("GET /categories")
+def get_categories(ctx):
+    ctx.get('/categories')
+
+
+@endpoint("PUT /categories")
+def put_categories(ctx):
+    ctx.put('/categories', {"categories": ctx.categories[:5] + [ctx.unique("category")]})
+
+
+@endpoint("GET /accounts")
+def get_accounts(ctx):
+    ctx.get('/accounts')
+
+
+@endpoint("GET /accounts/<id>")
+def get_account(ctx):
+    ctx.get('/accounts/{}'.format(ctx.account_id()))
+
+
+@endpoint("GET /accounts/<id>/summary")
+def get_account_summary(ctx):
+    ctx.get('/accounts/{}/summary'.format(ctx.account_id()))
+
+
+@endpoint("GET /accounts/<id>/balance?at=")
+def get_account_balance(ctx):
+    at = datetime.date.today() - datetime.timedelta(days=ctx.rng.randrange(0, 1500))
+    ctx.get('/accounts/{}/balance'.format(ctx.account_id()), query_string={'at': at.isoformat()})
+
+
+@endpoint("GET /networth")
+def get_net_worth(ctx):
+    ctx.get('/networth')
+
+
+@endpoint("GET /reports/cashflow")
+def get_cashflow_report(ctx):
+    ctx.get('/reports/cashflow')
+
+
+@endpoint("GET /reports/cashflow (uncached year)")
+def get_cashflow_report_uncached(ctx):
+    cashflow_cache.clear()
+    year = datetime.date.today().year - ctx.rng.randrange(0, 5)
+    ctx.get('/reports/cashflow', query_string={'month_from': '{}-01'.format(year),
+                                               'month_to': '{}-12'.format(year)})
+
+
+@endpoint("GET /analytics (by category)")
+def get_analytics(ctx):
+    ctx.get('/analytics')
+
+
+@endpoint("GET /analytics (account, month, window)")
+def get_analytics_rolling(ctx):
+    ctx.get('/analytics', query_string={'account_id': ctx.account_id(), 'group_by': 'month',
+                                        'window': 30})
+
+
+@endpoint("GET /accounts/<id>/transactions")
+def get_account_transactions(ctx):
+    ctx.get('/accounts/{}/transactions'.format(ctx.account_id()))
+
+
+@endpoint("GET /accounts/<id>/transactions (page 5)")
+def get_account_transactions_deep(ctx):
+    uri = '/accounts/{}/transactions'.format(ctx.account_id())
+    query = {}
+    for _ in range(5):
+        resp = json.loads(ctx.get(uri, query_string=query).data.decode('utf-8'))
+        if not resp['next']:
+            break
+        query['next'] = resp['next']
+
+
+@endpoint("GET /accounts/<id>/transactions (If-None-Match)")
+def get_account_transactions_not_modified(ctx):
+    uri = '/accounts/{}/transactions'.format(ctx.account_id())
+    etag = ctx.get(uri).headers.get('ETag')
+    ctx.get(uri, headers={'If-None-Match': etag})
+
+
+@endpoint("GET /transactions (date range)")
+def get_transactions_range(ctx):
+    start = datetime.date.today() - datetime.timedelta(days=ctx.rng.randrange(30, 1500))
+    ctx.get('/transactions', query_string={
+        'date_from': start.isoformat(),
+        'date_to': (start + datetime.timedelta(days=30)).isoformat(),
+    })
+
+
+@endpoint("GET /transactions (category, amount)")
+def get_transactions_category(ctx):
+    ctx.get('/transactions', query_string={
+        'category': ctx.rng.choice(ctx.categories), 'amount_min': 5000, 'sort': 'amount',
+    })
+
+
+@endpoint("GET /transactions/search (prefix)")
+def search_transactions(ctx):
+    ctx.get('/transactions/search', query_string={'q': ctx.rng.choice(ledger.merchants)[:3] + '*'})
+
+
+@endpoint("GET /transactions/search (phrase, account)")
+def search_transactions_phrase(ctx):
+    ctx.get('/transactions/search', query_string={
+        'q': '"payroll deposit"', 'account_id': ctx.account_id(),
+    })
+
+
+@endpoint("GET /accounts/<id>/transactions/export")
+def export_account(ctx):
+    ctx.get('/accounts/{}/transactions/export'.format(ctx.account_id()))
+
+
+@endpoint("GET /transactions/export (csv)")
+def export_all(ctx):
+    ctx.get('/transactions/export', query_string={'format': 'csv'})
+
+
+@endpoint("PUT /accounts/<id>/transactions")
+def put_transaction(ctx):
+    ctx.put('/accounts/{}/transactions'.format(ctx.account_id()), ctx.transaction())
+
+
+@endpoint("PUT /accounts/<id>/transactions/batch (100)")
+def put_transaction_batch(ctx):
+    ctx.put('/accounts/{}/transactions/batch'.format(ctx.account_id()),
+            {"transactions": [ctx.transaction() for _ in range(100)]})
+
+
+@endpoint("PUT /accounts")
+def put_account(ctx):
+    ctx.put('/accounts', {"description": ctx.unique("account"), "type": "checking", "balance": 0})
+
+
+@endpoint("GET /metrics")
+def get_metrics(ctx):
+    ctx.get('/metrics')
+
+
+@model("Category.is_category")
+def category_is_category(ctx):
+    Category.is_category(ctx.rng.choice(ctx.categories))
+
+
+@model("Category.get_all_categories")
+def category_get_all(ctx):
+    Category.get_all_categories()
+
+
+@model("Category.get_existing")
+def category_get_existing(ctx):
+    Category.get_existing(ctx.categories)
+
+
+@model("Category.get_transactions")
+def category_get_transactions(ctx):
+    Category(category=ctx.rng.choice(ctx.categories)).get_transactions()
+
+
+@model("Account.get_all")
+def account_get_all(ctx):
+    Account.get_all()
+
+
+@model("Account.get_rows")
+def account_get_rows(ctx):
+    Account.get_rows()
+
+
+@model("Account.get_by_name")
+def account_get_by_name(ctx):
+    Account.get_by_name("Account 0")
+
+
+@model("Account.get_by_id")
+def account_get_by_id(ctx):
+    Account.get_by_id(ctx.account_id())
+
+
+@model("Account.get_transactions (limit 100)")
+def account_get_transactions(ctx):
+    Account.get_by_id(ctx.account_id()).get_transactions(limit=100)
+
+
+@model("Account.get_transactions (all)")
+def account_get_all_transactions(ctx):
+    Account.get_by_id(ctx.account_id()).get_transactions()
+
+
+@model("Transaction.get_transactions (account, date range)")
+def transaction_get_transactions(ctx):
+    start = datetime.date.today() - datetime.timedelta(days=ctx.rng.randrange(30, 1500))
+    Transaction.get_transactions(account_id=ctx.account_id(), date_from=start,
+                                 date_to=start + datetime.timedelta(days=30))
+
+
+@model("Transaction.iter_rows (account)")
+def transaction_iter_rows(ctx):
+    for _ in Transaction.iter_rows(account_id=ctx.account_id()):
+        pass
+
+
+@model("TransactionSummary.get_for_account")
+def summary_get_for_account(ctx):
+    TransactionSummary.get_for_account(ctx.account_id())
+
+
+def percentile(sorted_values, p):
+    """ Nearest-rank percentile of an already sorted list. """
+    index = max(0, int(math.ceil(p / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[index]
+
+
+def measure(func, ctx, repeat, warmup):
+    """
+    :return: dict of latency statistics in milliseconds and calls per second
+    """
+    for _ in range(warmup):
+        func(ctx)
+        db.session.remove()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        func(ctx)
+        timings.append(time.time() - start)
+        db.session.remove()
+
+    timings.sort()
+    total = sum(timings)
+    return {
+        'runs': repeat,
+        'p50_ms': percentile(timings, 50) * 1000,
+        'p95_ms': percentile(timings, 95) * 1000,
+        'p99_ms': percentile(timings, 99) * 1000,
+        'mean_ms': total / repeat * 1000,
+        'throughput_per_s': repeat / total if total else float('inf'),
+    }
+
+
+def git_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=devnull)
+        return output.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    print("{:<55} {:>10} {:>10} {:>10} {:>12}".format("case", "p50 ms", "p95 ms", "p99 ms", "per sec"))
+    for group in ('endpoints', 'models'):
+        for name, stats in sorted(results[group].items()):
+            line = "{:<55} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.1f}".format(
+                name, stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['throughput_per_s'])
+
+            old = (baseline or {}).get(group, {}).get(name)
+            if old:
+                line += "  p50 {:+.0%}".format(stats['p50_ms'] / old['p50_ms'] - 1)
+            print(line)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--accounts", type=int, default=5)
+    parser.add_argument("--categories", type=int, default=12)
+    parser.add_argument("--transactions", type=int, default=100000)
+    parser.add_argument("--years", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--only", help="Only run cases whose name contains this")
+    parser.add_argument("--database", help="New or empty SQLite file to use, a temporary one by default")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="Earlier results file to compare against")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    database = args.database or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + database
+    app.config['TESTING'] = True
+    app.config['ANALYTICS_SNAPSHOT_DIR'] = tempfile.mkdtemp()
+
+    start = time.time()
+    try:
+        account_ids = ledger.generate(args.accounts, args.categories, args.transactions,
+                                      args.years, args.seed)
+    except ledger.DatabaseNotEmpty as e:
+        sys.exit(str(e))
+    print("Generated {} transactions in {:.1f}s ({})".format(
+        args.transactions, time.time() - start, database))
+
+    ctx = Context(app.test_client(), account_ids, ledger.category_names(args.categories), args.seed)
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'parameters': vars(args),
+        'endpoints': {},
+        'models': {},
+    }
+
+    for group, cases in (('endpoints', endpoint_cases), ('models', model_cases)):
+        for name, func in cases:
+            if args.only and args.only not in name:
+                continue
+            results[group][name] = measure(func, ctx, args.repeat, args.warmup)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
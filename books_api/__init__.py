@@ -5,6 +5,6 @@ app = Flask(__name__)
 app.config.from_object('public_config')
 db = SQLAlchemy(app)
 
-from books_api import views, models
+from books_api import views, models, compression, metrics, querylog, analytics
 
 # TODO add logging and otherstuff
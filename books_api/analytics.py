@@ -0,0 +1,432 @@
+"""
+Spending analytics over a columnar snapshot of every transaction.
+
+The snapshot keeps one flat binary file per column in
+ANALYTICS_SNAPSHOT_DIR, memory-mapped read-only by every worker:
+
+    id, account_id, category_id (-1 if uncategorized)
+    day - date as an ordinal, see datetime.date.toordinal
+    amount - signed amount in cents, as it affects the account balance
+
+Transaction ids only grow, so rows written since the last read are appended
+by id before the next query.  Changing or deleting existing transactions
+bumps the 'transaction_rewrites' DataVersion, and the next read rebuilds the
+snapshot into a new generation directory instead.  The previous generation is
+only removed by the rebuild after that, so workers that read meta.json just
+before a rebuild can still map it; a worker that falls further behind reads
+meta.json again under the lock.
+
+GET /analytics computes grouped totals, percentiles and rolling daily
+windows with numpy.  numpy is optional, without it (or with
+ANALYTICS_SNAPSHOT_DIR set to None) the endpoint answers 404.
+"""
+import os
+import json
+import fcntl
+import shutil
+import datetime
+import threading
+import contextlib
+
+from flask import request, abort
+
+from books_api import app, db
+from books_api.models import Transaction, DataVersion, category_cache
+from books_api.models import archive_transactions, archive_cutoff
+from books_api.serialization import json_response
+from books_api.views import make_etag, conditional_response
+from books_api.request_args import parse_date, int_args
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Column name and numpy dtype, in the order they are selected.
+columns = [
+    ('id', 'int64'),
+    ('account_id', 'int32'),
+    ('category_id', 'int32'),
+    ('day', 'int32'),
+    ('amount', 'int64'),
+]
+
+# Rows fetched and appended at a time when refreshing.
+FETCH_BATCH_SIZE = 50000
+
+# SQLite julianday() of a date minus its datetime.date ordinal.
+JULIAN_DAY_OFFSET = 1721424.5
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+group_keys = ['category', 'account', 'month']
+
+DEFAULT_PERCENTILES = [50, 90, 99]
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """ Serialize refreshes between worker processes. """
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class Snapshot(object):
+    """
+    The memory-mapped columns of one ANALYTICS_SNAPSHOT_DIR.
+
+    meta.json records the current generation, its number of rows, the
+    highest transaction id they include and the 'transaction_rewrites'
+    version they were built at.  Column files may hold a partial append
+    beyond the recorded rows, which is ignored and overwritten.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._mapped = None
+        self._arrays = None
+
+    @staticmethod
+    def directory():
+        return app.config.get('ANALYTICS_SNAPSHOT_DIR')
+
+    def read_meta(self):
+        try:
+            with open(os.path.join(self.directory(), 'meta.json')) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write_meta(self, meta):
+        path = os.path.join(self.directory(), 'meta.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.rename(path + '.tmp', path)
+
+    def column_path(self, meta, name):
+        return os.path.join(self.directory(), 'generation-{}'.format(meta['generation']), name)
+
+    @staticmethod
+    def database_state():
+        """
+        :return: (highest transaction id, 'transaction_rewrites' version)
+        """
+        # One index lookup per table, max() over the storage() union would
+        # scan both.
+        tables = [Transaction.__table__]
+        if archive_cutoff() is not None:
+            tables.append(archive_transactions)
+        max_id = max(db.session.execute(db.select([db.func.max(table.c.id)])).scalar() or 0
+                     for table in tables)
+        return max_id, DataVersion.get('transaction_rewrites')
+
+    @staticmethod
+    def is_current(meta, max_id, rewrites):
+        return meta is not None and meta['max_id'] == max_id and meta['rewrites'] == rewrites
+
+    def load(self):
+        """
+        Bring the snapshot up to date with the database and map it.
+        :return: (meta, dict of column name to array)
+        """
+        max_id, rewrites = self.database_state()
+        meta = self.read_meta()
+        directory = self.directory()
+        if not self.is_current(meta, max_id, rewrites):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with self._lock, _file_lock(os.path.join(directory, 'lock')):
+                # Another worker may have refreshed while we waited.
+                meta = self.read_meta()
+                if not self.is_current(meta, max_id, rewrites):
+                    meta = self.refresh(meta, max_id, rewrites)
+                return meta, self.map(meta)
+
+        try:
+            return meta, self.map(meta)
+        except (IOError, OSError):
+            # Two rebuilds since meta.json was read removed its generation,
+            # none can run while the lock is held.
+            with self._lock, _file_lock(os.path.join(directory, 'lock')):
+                meta = self.read_meta()
+                return meta, self.map(meta)
+
+    def refresh(self, meta, max_id, rewrites):
+        """
+        Append transactions newer than the snapshot, or rebuild it if
+        existing transactions changed.
+        :return: New meta
+        """
+        stale = None
+        if meta is None or meta['rewrites'] != rewrites or max_id < meta['max_id']:
+            # Keep the generation being replaced for workers that just read
+            # meta.json, remove the one before it.
+            if meta is not None:
+                stale = dict(meta, generation=meta['generation'] - 1)
+            meta = {
+                'generation': meta['generation'] + 1 if meta else 1,
+                'rows': 0,
+                'max_id': 0,
+                'rewrites': rewrites,
+            }
+            # Left over if a rebuild was interrupted
+            directory = os.path.dirname(self.column_path(meta, 'id'))
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory)
+
+        self.append(meta)
+        self.write_meta(meta)
+
+        if stale is not None:
+            shutil.rmtree(os.path.dirname(self.column_path(stale, 'id')), ignore_errors=True)
+
+        return meta
+
+    def append(self, meta):
+        """
+        Append every transaction with an id above meta['max_id'] to the
+        column files, updating meta.
+        """
+        table = Transaction.storage()
+        result = db.session.execute(
+            db.select([
+                table.c.id,
+                table.c.account_id,
+                db.func.coalesce(table.c.category_id, -1),
+                db.cast(db.func.julianday(table.c.date) - JULIAN_DAY_OFFSET, db.Integer),
+                Transaction.signed_amount_column(table.c),
+            ])
+            .where(table.c.id > meta['max_id'])
+            .order_by(table.c.id))
+
+        files = []
+        try:
+            for name, dtype in columns:
+                f = open(self.column_path(meta, name), 'ab')
+                f.truncate(meta['rows'] * numpy.dtype(dtype).itemsize)
+                files.append(f)
+
+            while True:
+                rows = result.fetchmany(FETCH_BATCH_SIZE)
+                if not rows:
+                    break
+                block = numpy.array(rows, dtype=numpy.int64)
+                for i, ((name, dtype), f) in enumerate(zip(columns, files)):
+                    block[:, i].astype(dtype).tofile(f)
+                meta['rows'] += len(block)
+                meta['max_id'] = int(block[-1, 0])
+        finally:
+            for f in files:
+                f.close()
+
+    def map(self, meta):
+        """
+        :return: dict of column name to read-only array of meta['rows']
+        """
+        key = (self.directory(), meta['generation'], meta['rows'])
+        if self._mapped != key:
+            arrays = {}
+            for name, dtype in columns:
+                if meta['rows']:
+                    arrays[name] = numpy.memmap(self.column_path(meta, name), dtype=dtype,
+                                                mode='r', shape=(meta['rows'],))
+                else:
+                    # mmap refuses empty files
+                    arrays[name] = numpy.zeros(0, dtype=dtype)
+            self._arrays = arrays
+            self._mapped = key
+
+        return self._arrays
+
+
+snapshot = Snapshot()
+
+
+def select_rows(arrays, account_ids=None, category_ids=None, date_from=None, date_to=None):
+    """
+    :return: Boolean mask of the snapshot rows matching every given filter
+    """
+    mask = numpy.ones(len(arrays['id']), dtype=bool)
+    if account_ids:
+        mask &= numpy.isin(arrays['account_id'], account_ids)
+    if category_ids is not None:
+        mask &= numpy.isin(arrays['category_id'], category_ids)
+    if date_from is not None:
+        mask &= arrays['day'] >= date_from.toordinal()
+    if date_to is not None:
+        mask &= arrays['day'] <= date_to.toordinal()
+    return mask
+
+
+def month_keys(days):
+    """
+    :param days: Array of date ordinals
+    :return: Array of months since 1970-01
+    """
+    return (days - EPOCH_ORDINAL).astype('datetime64[D]').astype('datetime64[M]').astype(numpy.int64)
+
+
+def group_stats(keys, amounts, percentiles):
+    """
+    Count, total, mean, min, max and linearly interpolated percentiles of
+    amounts per distinct key, from one sort.
+    :param percentiles: Sequence of percentiles between 0 and 100
+    :return: dict of arrays, one element per key in ascending order, with
+    'percentiles' shaped (keys, percentiles)
+    """
+    order = numpy.lexsort((amounts, keys))
+    keys = keys[order]
+    amounts = amounts[order]
+
+    starts = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]]) if len(keys) else \
+        numpy.zeros(0, dtype=numpy.int64)
+    counts = numpy.diff(numpy.r_[starts, len(keys)])
+    ends = starts + counts - 1
+    totals = numpy.add.reduceat(amounts, starts) if len(starts) else numpy.zeros(0, dtype=numpy.int64)
+
+    positions = starts[:, None] + numpy.asarray(percentiles, dtype=float)[None, :] / 100 * (counts - 1)[:, None]
+    below = numpy.floor(positions).astype(numpy.int64)
+    above = numpy.ceil(positions).astype(numpy.int64)
+    values = amounts[below] + (amounts[above] - amounts[below]) * (positions - below)
+
+    return {
+        'key': keys[starts],
+        'count': counts,
+        'total': totals,
+        'mean': totals / counts.astype(float),
+        'min': amounts[starts],
+        'max': amounts[ends],
+        'percentiles': values,
+    }
+
+
+def rolling_totals(days, amounts, first, last, window):
+    """
+    Net amount per day from first to last (ordinals, inclusive) and its sum
+    over the trailing window days.  Days before a full window sum what
+    there is.
+    :return: (daily totals, rolling sums, rolling means) arrays
+    """
+    length = last - first + 1
+    daily = numpy.bincount(days - first, weights=amounts, minlength=length)
+    daily = numpy.rint(daily).astype(numpy.int64)
+
+    cumulative = numpy.r_[0, numpy.cumsum(daily)]
+    ends = numpy.arange(1, length + 1)
+    starts = numpy.maximum(ends - window, 0)
+    rolling = cumulative[ends] - cumulative[starts]
+
+    return daily, rolling, rolling / (ends - starts).astype(float)
+
+
+def _day_strings(first, length):
+    dates = numpy.arange(first, first + length) - EPOCH_ORDINAL
+    return numpy.datetime_as_string(dates.astype('datetime64[D]')).tolist()
+
+
+def _group_labels(group_by, keys):
+    if group_by == 'category':
+        # Uncategorized (-1) maps to None
+        names = category_cache.get().names
+        return [names.get(k) for k in keys.tolist()]
+    if group_by == 'month':
+        return numpy.datetime_as_string(keys.astype('datetime64[M]')).tolist()
+    return keys.tolist()
+
+
+@app.route("/analytics", methods=['GET'])
+def analytics():
+    """
+    Statistics of signed transaction amounts (credits positive), optional
+    parameters:
+        account_id, category - repeat to match any of several
+        date_from, date_to - inclusive, YYYY-MM-DD
+        group_by - category (default), account or month
+        percentile - repeat for several, 50, 90 and 99 by default
+        window - days, adds daily totals with their trailing window sums,
+        for at most ANALYTICS_MAX_DAYS days
+    """
+    if numpy is None or not snapshot.directory():
+        abort(404, "Analytics are disabled.")
+
+    account_ids = int_args('account_id')
+    categories = request.args.getlist('category')
+    dates = dict((name, parse_date(request.args[name], name))
+                 for name in ('date_from', 'date_to') if name in request.args)
+
+    group_by = request.args.get('group_by', 'category')
+    if group_by not in group_keys:
+        abort(400, "group_by must be one of {}".format(group_keys))
+
+    try:
+        percentiles = [float(p) for p in request.args.getlist('percentile')] or DEFAULT_PERCENTILES
+    except ValueError:
+        abort(400, "percentile must be a number.")
+    if not all(0 <= p <= 100 for p in percentiles):
+        abort(400, "percentile must be between 0 and 100.")
+
+    window = int_args('window')
+    window = window[0] if window else None
+    if window is not None and window <= 0:
+        abort(400, "window must be positive.")
+
+    meta, arrays = snapshot.load()
+
+    def build():
+        category_ids = None
+        if categories:
+            known = category_cache.get()
+            category_ids = [known[c] for c in categories if c in known]
+
+        mask = select_rows(arrays, account_ids, category_ids, **dates)
+        days = arrays['day'][mask]
+        amounts = arrays['amount'][mask]
+
+        if group_by == 'category':
+            keys = arrays['category_id'][mask]
+        elif group_by == 'account':
+            keys = arrays['account_id'][mask]
+        else:
+            keys = month_keys(days)
+
+        stats = group_stats(keys, amounts, percentiles)
+        labels = _group_labels(group_by, stats['key'])
+        names = ['{:g}'.format(p) for p in percentiles]
+
+        groups = []
+        for i, label in enumerate(labels):
+            groups.append({
+                group_by: label,
+                'count': int(stats['count'][i]),
+                'total': int(stats['total'][i]),
+                'mean': float(stats['mean'][i]),
+                'min': int(stats['min'][i]),
+                'max': int(stats['max'][i]),
+                'percentiles': dict(zip(names, stats['percentiles'][i].tolist())),
+            })
+
+        result = {'group_by': group_by, 'groups': groups}
+
+        if window is not None:
+            first = dates['date_from'].toordinal() if 'date_from' in dates else \
+                (int(days.min()) if len(days) else None)
+            last = dates['date_to'].toordinal() if 'date_to' in dates else \
+                (int(days.max()) if len(days) else None)
+            daily = []
+            if first is not None and last is not None and first <= last:
+                # One entry per day, bound the response and its arrays.
+                if last - first + 1 > app.config['ANALYTICS_MAX_DAYS']:
+                    abort(400, "window covers at most {} days, narrow date_from and date_to.".format(
+                        app.config['ANALYTICS_MAX_DAYS']))
+                totals, rolling, means = rolling_totals(days, amounts, first, last, window)
+                daily = [{'date': d, 'total': t, 'window_total': r, 'window_mean': m}
+                         for d, t, r, m in zip(_day_strings(first, len(totals)), totals.tolist(),
+                                               rolling.tolist(), means.tolist())]
+            result['rolling'] = {'window': window, 'days': daily}
+
+        return json_response({'analytics': result})
+
+    return conditional_response(make_etag('analytics', meta['generation'], meta['max_id']), build)
@@ -0,0 +1,75 @@
+"""
+Move old transactions out of the hot transaction table.
+
+archive_before(cutoff) copies every transaction dated before cutoff into
+the ARCHIVE_DATABASE file and deletes it from the main database, recording
+each account's opening balance at the cutoff.  Listings, exports and the
+summary rebuild read the archive only when their date range needs it, see
+Transaction.needs_archive.  Archived history is read-only afterwards.
+"""
+import os
+import datetime
+
+from flask import g, has_request_context
+
+from books_api import app, db
+from books_api.models import Account, Transaction, GenericBooksException
+from books_api.models import archive_transactions
+
+
+class ArchiveException(GenericBooksException):
+    pass
+
+
+def archive_before(cutoff):
+    """
+    Archive transactions dated before cutoff, in one database transaction.
+    :param cutoff: datetime.date
+    :return: Number of transactions moved
+    """
+    path = app.config['ARCHIVE_DATABASE']
+    if not path:
+        raise ArchiveException("ARCHIVE_DATABASE is not configured.")
+
+    hot = Transaction.__table__
+    old = hot.c.date < cutoff
+
+    connection = db.session.connection()
+    # Requests attach the archive read-only, this connection needs to write.
+    attached = [row[1] for row in connection.execute("PRAGMA database_list")]
+    if 'archive' in attached:
+        connection.execute("DETACH DATABASE archive")
+    connection.execute("ATTACH DATABASE ? AS archive", (os.path.abspath(path),))
+    archive_transactions.create(connection, checkfirst=True)
+
+    moved_id = connection.execute(db.select([db.func.max(hot.c.id)]).where(old)).scalar()
+    if moved_id is None:
+        return 0
+
+    # Ids of archived rows must never be handed out again.  Tables created
+    # before Transaction used AUTOINCREMENT reuse max(id) + 1, so there the
+    # newest transaction has to stay behind.
+    autoincrement = connection.execute(
+        "SELECT 1 FROM sqlite_sequence WHERE name = 'transaction'").scalar()
+    if not autoincrement:
+        kept_id = connection.execute(db.select([db.func.max(hot.c.id)]).where(~old)).scalar()
+        if kept_id is None or kept_id < moved_id:
+            raise ArchiveException("The newest transaction (id {}) is before {}, archiving it "
+                                   "would let its id be reused.".format(moved_id, cutoff))
+
+    day_before = cutoff - datetime.timedelta(days=1)
+    for account in Account.query.filter(db.or_(Account.archived_before.is_(None),
+                                                Account.archived_before < cutoff)):
+        account.opening_balance = Account.balance_at(account.id, day_before)
+        account.archived_before = cutoff
+    db.session.flush()
+
+    columns = [c.name for c in hot.columns]
+    connection.execute(archive_transactions.insert().from_select(
+        columns, db.select([hot.c[c] for c in columns]).where(old)))
+    moved = connection.execute(hot.delete().where(old)).rowcount
+
+    db.session.commit()
+    if has_request_context():
+        g.pop('archive_cutoff', None)
+    return moved
@@ -0,0 +1,100 @@
+import time
+import threading
+from collections import OrderedDict
+
+from flask import g, has_request_context
+
+
+class VersionedCache(object):
+    """
+    In-process copy of a value loaded from the database, reused until a
+    version counter stored alongside the data changes.
+
+    Writers bump the version in the same database transaction as their
+    change (see models.DataVersion) and call invalidate() locally, so other
+    worker processes only pay for a cheap version lookup instead of a full
+    reload on every read.  The version is checked at most once per
+    request, so reads in a loop don't each run a query.
+    """
+    def __init__(self, load, get_version, check_interval=0):
+        """
+        :param load: Callable returning a fresh value from the database.
+        :param get_version: Callable returning the current version number.
+        :param check_interval: Seconds to trust the cached value before
+        checking the version again, 0 checks on every read.
+        """
+        self.load = load
+        self.get_version = get_version
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        self._value = None
+        self._version = None
+        self._checked_at = 0
+
+    def get(self):
+        now = time.time()
+        if self._version is not None and (now - self._checked_at < self.check_interval or
+                                          self._checked_in_request() == self._version):
+            return self._value
+
+        with self._lock:
+            # Read the version before the data, so a concurrent change makes
+            # the next check reload rather than pinning stale data.
+            version = self.get_version()
+            if version != self._version:
+                self._value = self.load()
+                self._version = version
+            self._checked_at = now
+            if has_request_context():
+                g.setdefault('versioned_cache_checks', {})[id(self)] = version
+
+            return self._value
+
+    def _checked_in_request(self):
+        """
+        :return: Version seen by this request's last check, None if none.
+        """
+        if not has_request_context():
+            return None
+        return g.get('versioned_cache_checks', {}).get(id(self))
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+
+
+class LRUCache(object):
+    """
+    Bounded mapping that drops the least recently used entry when full.
+    Keys should include whatever version the value depends on, stale
+    entries are then never hit again and age out.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,95 @@
+"""
+Negotiated gzip (and brotli, when installed) compression of responses.
+
+Buffered responses are compressed if they are at least COMPRESSION_MIN_SIZE
+bytes, streamed responses (exports) are always compressed chunk by chunk as
+they are sent.
+"""
+import zlib
+
+from flask import request
+
+from books_api import app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _gzip_compressor(level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress, compressor.flush
+
+
+def _brotli_compressor(quality):
+    compressor = brotli.Compressor(quality=quality)
+    return compressor.process, compressor.finish
+
+
+def choose_encoding():
+    """
+    :return: Content-Encoding to use for this request, None to send as is.
+    The coding with the highest q-value wins, brotli on a tie; q=0 refuses
+    a coding.
+    """
+    accepted = request.accept_encodings
+    best = None
+    for encoding in (['br', 'gzip'] if brotli is not None else ['gzip']):
+        if accepted[encoding] > 0 and (best is None or accepted[encoding] > accepted[best]):
+            best = encoding
+    return best
+
+
+def make_compressor(encoding):
+    """
+    :return: (compress, finish) functions for encoding at the configured level
+    """
+    if encoding == 'br':
+        return _brotli_compressor(app.config['COMPRESSION_BROTLI_QUALITY'])
+    return _gzip_compressor(app.config['COMPRESSION_LEVEL'])
+
+
+def compress_stream(chunks, encoding):
+    compress, finish = make_compressor(encoding)
+    try:
+        for chunk in chunks:
+            data = compress(chunk)
+            # Compressors buffer internally, only send full blocks.
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+@app.after_request
+def compress_response(response):
+    if not app.config['COMPRESSION_ENABLED']:
+        return response
+
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in app.config['COMPRESSION_MIMETYPES']):
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.iter_encoded(), encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESSION_MIN_SIZE']:
+            return response
+
+        compress, finish = make_compressor(encoding)
+        response.set_data(compress(data) + finish())
+
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,21 @@
+"""
+Engine event listeners registered only while the feature using them is
+enabled, so disabled features add nothing to every statement.
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+def set_listeners(listeners, enabled):
+    """
+    Register or remove engine event listeners, leaving ones already in the
+    wanted state alone.
+    :param listeners: List of (event name, function)
+    :param enabled: True to register them, False to remove them
+    """
+    for name, listener in listeners:
+        registered = event.contains(Engine, name, listener)
+        if enabled and not registered:
+            event.listen(Engine, name, listener)
+        elif registered and not enabled:
+            event.remove(Engine, name, listener)
@@ -0,0 +1,204 @@
+"""
+Group commit for single-row writes.
+
+With GROUP_COMMIT_ENABLED, commit_write hands the write to one background
+writer instead of committing in the request.  The writer collects the
+writes that arrive within GROUP_COMMIT_MAX_DELAY seconds (at most
+GROUP_COMMIT_MAX_ITEMS) and commits them in one database transaction, so
+concurrent requests share a single fsync.  Each request still gets its own
+result or exception back.  A request that gives up waiting withdraws its
+write, unless the writer has already started on it, so a timed out write
+is never applied and can safely be retried.
+"""
+import os
+import threading
+from timeit import default_timer
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from books_api import app, db
+
+
+class GroupCommitTimeout(Exception):
+    pass
+
+
+class PendingWrite(object):
+    """ A queued write and, once the writer is done with it, its outcome. """
+    def __init__(self, write, finish):
+        self.write = write
+        self.finish = finish
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        # None while queued, then 'claimed' by the writer or 'withdrawn'
+        self._state = None
+
+    def claim(self):
+        """
+        Called by the writer before applying the write.
+        :return: False if the waiting request withdrew it
+        """
+        with self._lock:
+            if self._state is None:
+                self._state = 'claimed'
+            return self._state == 'claimed'
+
+    def withdraw(self):
+        """
+        :return: True if the write is withdrawn, False if the writer
+        already claimed it
+        """
+        with self._lock:
+            if self._state is None:
+                self._state = 'withdrawn'
+            return self._state == 'withdrawn'
+
+    def resolve(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout):
+        """
+        :return: The write's result, raises its exception if it failed.
+        Raises GroupCommitTimeout if the writer didn't start on it within
+        timeout; it is then withdrawn and never applied.
+        """
+        if not self._done.wait(timeout):
+            if self.withdraw():
+                raise GroupCommitTimeout("Write not started within {}s, nothing was written.".format(
+                    timeout))
+            # Being committed, its outcome is on the way.
+            self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def apply_writes(writes):
+    """
+    Run writes in the current session and commit them together.
+    :param writes: List of PendingWrite
+    :return: List of results, in order
+    """
+    written = [w.write() for w in writes]
+    # Results are built before the commit expires the new objects.
+    db.session.flush()
+    results = [w.finish(obj) if w.finish else obj for w, obj in zip(writes, written)]
+    db.session.commit()
+    return results
+
+
+class GroupCommitWriter(object):
+    """
+    Background thread committing queued writes in groups.
+    Started on first use, and again in a forked worker process.
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def submit(self, write, finish=None):
+        """
+        :param write: Callable making the changes in db.session, returning
+        e.g. the new object.  Must not commit.
+        :param finish: Callable turning write's return value into the
+        result, run after the group is flushed.
+        :return: PendingWrite to wait on
+        """
+        self._ensure_started()
+        pending = PendingWrite(write, finish)
+        self.queue.put(pending)
+        return pending
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="group-commit")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def next_group(self):
+        """
+        Block for the next write, then gather whatever else arrives before
+        the group is full or the delay is up.
+        """
+        group = [self.queue.get()]
+        max_items = app.config['GROUP_COMMIT_MAX_ITEMS']
+        deadline = default_timer() + app.config['GROUP_COMMIT_MAX_DELAY']
+        while len(group) < max_items:
+            try:
+                remaining = deadline - default_timer()
+                if remaining > 0:
+                    group.append(self.queue.get(timeout=remaining))
+                else:
+                    group.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return group
+
+    def _run(self):
+        while True:
+            group = [pending for pending in self.next_group() if pending.claim()]
+            if not group:
+                continue
+            with app.app_context():
+                self.commit_group(group)
+
+    @staticmethod
+    def commit_group(group):
+        try:
+            results = apply_writes(group)
+        except Exception as e:
+            db.session.rollback()
+            if len(group) == 1:
+                group[0].resolve(error=e)
+                return
+
+            # Replay one by one so a bad write only fails its own request.
+            for pending in group:
+                try:
+                    result, = apply_writes([pending])
+                except Exception as e:
+                    db.session.rollback()
+                    pending.resolve(error=e)
+                else:
+                    pending.resolve(result)
+            return
+
+        for pending, result in zip(group, results):
+            pending.resolve(result)
+
+
+writer = GroupCommitWriter()
+
+
+def commit_write(write, finish=None):
+    """
+    Run write and commit it, through the group commit writer when
+    GROUP_COMMIT_ENABLED is set, otherwise in the current session.
+    See GroupCommitWriter.submit for the arguments.
+    :return: Result of finish, or of write if finish is None
+    Raises whatever write raised, or GroupCommitTimeout; nothing is
+    committed in either case.
+    """
+    if app.config['GROUP_COMMIT_ENABLED']:
+        return writer.submit(write, finish).wait(app.config['GROUP_COMMIT_TIMEOUT'])
+
+    try:
+        result, = apply_writes([PendingWrite(write, finish)])
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return result
@@ -0,0 +1,218 @@
+"""
+Request instrumentation exposed in Prometheus text format on /metrics.
+
+Every route records a latency histogram, response status counts and the
+number and duration of SQL statements it ran.  Set METRICS_ENABLED to
+False to turn all of it off.
+"""
+import threading
+from timeit import default_timer
+
+from flask import g, request, has_request_context, make_response, abort
+
+from books_api import app
+from books_api.engine_events import set_listeners
+
+# Upper bounds of the histogram buckets
+latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+query_count_buckets = [1, 2, 5, 10, 20, 50, 100, 500]
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            cumulative += count
+            yield '{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, cumulative)
+        yield '{}_sum{{{}}} {}'.format(name, labels, self.sum)
+        yield '{}_count{{{}}} {}'.format(name, labels, self.count)
+
+
+class Registry(object):
+    """ All metrics, keyed by (method, route). """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.latency = {}
+        self.statuses = {}
+        self.queries = {}
+        self.sql_seconds = {}
+
+    def started(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def finished(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def record(self, method, route, status, seconds, queries, sql_seconds):
+        key = (method, route)
+        with self.lock:
+            if key not in self.latency:
+                self.latency[key] = Histogram(latency_buckets)
+                self.queries[key] = Histogram(query_count_buckets)
+                self.sql_seconds[key] = 0
+            self.latency[key].observe(seconds)
+            self.queries[key].observe(queries)
+            self.sql_seconds[key] += sql_seconds
+
+            status_key = key + (status,)
+            self.statuses[status_key] = self.statuses.get(status_key, 0) + 1
+
+    def render(self):
+        """
+        :return: Metrics in Prometheus text exposition format
+        """
+        def labels(method, route):
+            return 'method="{}",route="{}"'.format(method, route.replace('"', '\\"'))
+
+        with self.lock:
+            lines = [
+                '# HELP books_requests_in_flight Requests currently being served.',
+                '# TYPE books_requests_in_flight gauge',
+                'books_requests_in_flight {}'.format(self.in_flight),
+                '# HELP books_request_seconds Request latency.',
+                '# TYPE books_request_seconds histogram',
+            ]
+            for key in sorted(self.latency):
+                lines.extend(self.latency[key].lines('books_request_seconds', labels(*key)))
+
+            lines.extend([
+                '# HELP books_responses_total Responses by status code.',
+                '# TYPE books_responses_total counter',
+            ])
+            for method, route, status in sorted(self.statuses):
+                lines.append('books_responses_total{{{},status="{}"}} {}'.format(
+                    labels(method, route), status, self.statuses[(method, route, status)]))
+
+            lines.extend([
+                '# HELP books_request_sql_queries SQL statements run per request.',
+                '# TYPE books_request_sql_queries histogram',
+            ])
+            for key in sorted(self.queries):
+                lines.extend(self.queries[key].lines('books_request_sql_queries', labels(*key)))
+
+            lines.extend([
+                '# HELP books_sql_seconds_total Time spent in SQL statements.',
+                '# TYPE books_sql_seconds_total counter',
+            ])
+            for key in sorted(self.sql_seconds):
+                lines.append('books_sql_seconds_total{{{}}} {}'.format(labels(*key), self.sql_seconds[key]))
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def _instrumented():
+    return app.config['METRICS_ENABLED'] and request.endpoint != 'metrics'
+
+
+@app.before_request
+def start_request_timer():
+    sync_query_listeners()
+    if not _instrumented():
+        return
+    g.metrics_request = {'start': default_timer(), 'queries': 0, 'sql_seconds': 0, 'finished': False}
+    registry.started()
+
+
+def _record(method, route, status, stats):
+    registry.record(method, route, status, default_timer() - stats['start'],
+                    stats['queries'], stats['sql_seconds'])
+    registry.finished()
+
+
+def _finish(status, response=None):
+    stats = g.get('metrics_request')
+    if stats is None or stats['finished']:
+        return
+    stats['finished'] = True
+
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    if response is not None and response.is_streamed:
+        # The body is only produced after after_request, record once the
+        # server has sent it.  Queries run while streaming are still counted.
+        method = request.method
+        response.call_on_close(lambda: _record(method, route, status, stats))
+    else:
+        _record(request.method, route, status, stats)
+
+
+@app.after_request
+def record_request(response):
+    _finish(response.status_code, response)
+    return response
+
+
+@app.teardown_request
+def record_failed_request(exc):
+    # Only still pending if after_request never ran, i.e. an unhandled error.
+    _finish(500)
+
+
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_start', []).append(default_timer())
+
+
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('metrics_query_start')
+    if not starts:
+        # Listeners registered while the statement ran
+        return
+    elapsed = default_timer() - starts.pop()
+    stats = g.get('metrics_request') if has_request_context() else None
+    if stats is not None:
+        stats['queries'] += 1
+        stats['sql_seconds'] += elapsed
+
+
+def _drop_query_timer(exception_context):
+    # after_cursor_execute doesn't run for a failed statement
+    conn = exception_context.connection
+    starts = conn.info.get('metrics_query_start') if conn is not None else None
+    if starts:
+        starts.pop()
+
+
+query_listeners = [
+    ('before_cursor_execute', _start_query_timer),
+    ('after_cursor_execute', _record_query),
+    ('handle_error', _drop_query_timer),
+]
+
+
+def sync_query_listeners():
+    set_listeners(query_listeners, app.config['METRICS_ENABLED'])
+
+
+sync_query_listeners()
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    if not app.config['METRICS_ENABLED']:
+        abort(404, "Metrics are disabled.")
+
+    response = make_response(registry.render())
+    response.mimetype = 'text/plain'
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
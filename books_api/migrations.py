@@ -0,0 +1,240 @@
+"""
+Idempotent upgrades for databases created by an older version of the models.
+
+db.create_all() creates missing tables but never touches existing ones, so
+each step here brings an existing table up to date.  Steps check the schema
+before changing it and are safe to run repeatedly, see db_upgrade.py.
+
+Schema steps each run in one short transaction.  Backfills commit every
+BACKFILL_BATCH_SIZE rows instead, so the application keeps writing while
+they run, and an interrupted backfill picks up the rows it has not reached.
+"""
+import sqlalchemy
+from sqlalchemy.schema import CreateColumn
+
+from books_api import db
+from books_api.models import Account, Transaction, DataVersion, transaction_search_ddl
+
+# Indexes replaced by newer ones, dropped by drop_obsolete_indexes.
+obsolete_indexes = [
+    # Text category column, replaced by ix_transaction_category_id_date
+    'ix_transaction_category_date',
+]
+
+# Rows updated per transaction by backfills, keeps each write lock short.
+BACKFILL_BATCH_SIZE = 10000
+
+
+def add_missing_columns(connection):
+    """
+    Add columns declared on the models that existing tables lack.
+    New columns must be nullable or have a server default.
+    :return: Names of the columns added, as table.column
+    """
+    inspector = sqlalchemy.inspect(connection)
+    added = []
+    for table in db.metadata.sorted_tables:
+        existing = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = CreateColumn(column).compile(dialect=connection.dialect)
+                connection.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                    connection.dialect.identifier_preparer.format_table(table), ddl))
+                added.append('{}.{}'.format(table.name, column.name))
+
+    return added
+
+
+def backfill_category_ids(connection):
+    """
+    Move transactions from the old category description column to
+    category_id.  Categories only named by transactions are created first,
+    then each row gets its id and its description is cleared, committing
+    every BACKFILL_BATCH_SIZE ids.  Finished rows are skipped when re-run.
+    :param connection: Connection outside of a transaction
+    :return: Number of transactions updated
+    """
+    columns = [c['name'] for c in sqlalchemy.inspect(connection).get_columns('transaction')]
+    if 'category' not in columns:
+        return 0
+
+    with connection.begin():
+        created = connection.execute(
+            'INSERT OR IGNORE INTO category (category) '
+            'SELECT DISTINCT category FROM "transaction" WHERE category IS NOT NULL')
+        if created.rowcount:
+            DataVersion.bump('categories', connection)
+
+    backfill = sqlalchemy.text(
+        'UPDATE "transaction" '
+        'SET category_id = (SELECT id FROM category WHERE category.category = "transaction".category), '
+        'category = NULL '
+        'WHERE id >= :start AND id < :end AND category IS NOT NULL')
+    last_id = connection.execute('SELECT max(id) FROM "transaction"').scalar() or 0
+
+    updated = 0
+    for start in range(0, last_id + 1, BACKFILL_BATCH_SIZE):
+        with connection.begin():
+            count = connection.execute(backfill, start=start, end=start + BACKFILL_BATCH_SIZE).rowcount
+            if count:
+                DataVersion.bump('transaction_rewrites', connection)
+        updated += count
+
+    return updated
+
+
+def drop_obsolete_indexes(connection):
+    """
+    :return: Names of the obsolete_indexes that were dropped
+    """
+    dropped = []
+    for table in db.metadata.sorted_tables:
+        existing = set(i['name'] for i in sqlalchemy.inspect(connection).get_indexes(table.name))
+        for name in obsolete_indexes:
+            if name in existing:
+                connection.execute('DROP INDEX {}'.format(
+                    connection.dialect.identifier_preparer.quote(name)))
+                dropped.append(name)
+
+    return dropped
+
+
+def create_missing_indexes(connection):
+    """
+    Create indexes declared on the models that the database lacks.
+    :return: Names of the indexes created
+    """
+    inspector = sqlalchemy.inspect(connection)
+    created = []
+    for table in db.metadata.sorted_tables:
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
+                created.append(index.name)
+
+    return created
+
+
+def backfill_running_balances(connection):
+    """
+    Compute Transaction.balance_after for accounts that have transactions
+    without one, i.e. rows written before the column existed.  Each
+    account is rewritten in (date, id) order, committing every
+    BACKFILL_BATCH_SIZE rows.
+    :param connection: Connection outside of a transaction
+    :return: Number of transactions updated
+    """
+    table = Transaction.__table__
+    account_ids = [account_id for account_id, in connection.execute(
+        db.select([table.c.account_id]).where(table.c.balance_after.is_(None)).distinct())]
+
+    updated = 0
+    for account_id in account_ids:
+        after = None
+        while True:
+            with connection.begin():
+                count, after = backfill_balances_batch(connection, account_id, after)
+            updated += count
+            if count < BACKFILL_BATCH_SIZE:
+                break
+
+    return updated
+
+
+def backfill_balances_batch(connection, account_id, after=None):
+    """
+    Rewrite balance_after for the account's next BACKFILL_BATCH_SIZE
+    transactions.  The running balance before them is worked back from the
+    stored account balance as it is now, so writes committed between
+    batches are accounted for.
+    :param after: (date, id) of the last transaction already rewritten
+    :return: (number of transactions updated, (date, id) of the last one)
+    """
+    table = Transaction.__table__
+    signed = Transaction.signed_amount_column()
+    own = table.c.account_id == account_id
+
+    condition = own
+    if after is not None:
+        date, id = after
+        condition = db.and_(own, db.or_(table.c.date > date,
+                                        db.and_(table.c.date == date, table.c.id > id)))
+    rows = connection.execute(db.select([table.c.id, table.c.date, signed])
+                              .where(condition)
+                              .order_by(table.c.date, table.c.id)
+                              .limit(BACKFILL_BATCH_SIZE)).fetchall()
+    if not rows:
+        return 0, after
+
+    first_id, first_date = rows[0][0], rows[0][1]
+    from_first = db.or_(table.c.date > first_date,
+                        db.and_(table.c.date == first_date, table.c.id >= first_id))
+    balance = connection.execute(db.select([Account.__table__.c.balance])
+                                 .where(Account.__table__.c.id == account_id)).scalar()
+    running = balance - connection.execute(
+        db.select([db.func.coalesce(db.func.sum(signed), 0)]).where(db.and_(own, from_first))).scalar()
+
+    updates = []
+    for id, _, amount in rows:
+        running += amount
+        updates.append({'b_id': id, 'b_balance': running})
+    connection.execute(table.update()
+                       .where(table.c.id == db.bindparam('b_id'))
+                       .values(balance_after=db.bindparam('b_balance')), updates)
+
+    return len(updates), (rows[-1][1], rows[-1][0])
+
+
+def create_search_index(connection):
+    """
+    Create the transaction_search full-text index and its triggers, and
+    fill it from existing transactions.  SQLite only.
+    :return: True if the index was created
+    """
+    if connection.dialect.name != 'sqlite':
+        return False
+
+    exists = 'transaction_search' in sqlalchemy.inspect(connection).get_table_names()
+    for statement in transaction_search_ddl:
+        connection.execute(statement)
+    if exists:
+        return False
+
+    connection.execute("INSERT INTO transaction_search (transaction_search) VALUES ('rebuild')")
+    return True
+
+
+# (description, step) in the order they must run.  Steps in batched_steps
+# commit as they go, the others run in a transaction of their own.
+steps = [
+    ("add missing columns", add_missing_columns),
+    ("backfill category ids", backfill_category_ids),
+    ("drop obsolete indexes", drop_obsolete_indexes),
+    ("create missing indexes", create_missing_indexes),
+    ("backfill running balances", backfill_running_balances),
+    ("create search index", create_search_index),
+]
+
+batched_steps = [backfill_category_ids, backfill_running_balances]
+
+
+def upgrade(engine):
+    """
+    Create missing tables, then run every step.  An interrupted upgrade is
+    finished by running it again.
+    :return: List of (description, result) for each step
+    """
+    db.metadata.create_all(engine)
+
+    results = []
+    with engine.connect() as connection:
+        for description, step in steps:
+            if step in batched_steps:
+                result = step(connection)
+            else:
+                with connection.begin():
+                    result = step(connection)
+            results.append((description, result))
+
+    return results
@@ -1,9 +1,18 @@
+import os
+import re
 import sys
+import sqlite3
+import datetime
+import operator
 
 import sqlalchemy.exc
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 from books_api import db
 from books_api import app
+from books_api.cache import VersionedCache
 
 # TODO: what is the best way to model this instead of strings?
 
@@ -43,6 +52,69 @@ class TransactionException(GenericBooksException):
     pass
 
 
+class DataVersion(db.Model):
+    """
+    Named counters bumped whenever the data they cover changes.
+    Lets each process check cheaply whether its cached copy is stale.
+    """
+    __tablename__ = 'data_version'
+
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def get(name):
+        """
+        :return: Current version of name, 0 if it was never bumped.
+        """
+        version = db.session.query(DataVersion.version).filter_by(name=name).scalar()
+        return version or 0
+
+    @staticmethod
+    def bump(name, connection=None):
+        """
+        Increment the version of name in the current database transaction.
+        :param connection: Connection to use instead of the session, for
+        calls from inside a flush.
+        """
+        execute = connection.execute if connection is not None else db.session.execute
+        table = DataVersion.__table__
+        increment = table.update().where(table.c.name == name).values(version=table.c.version + 1)
+
+        # The row almost always exists, only create it on first use.
+        if execute(increment).rowcount == 0:
+            execute(table.insert().prefix_with('OR IGNORE', dialect='sqlite')
+                    .values(name=name, version=0))
+            execute(increment)
+
+    @staticmethod
+    def bump_all(names):
+        """
+        Increment several versions in the current database transaction,
+        with one executemany to create missing rows and one to increment.
+        """
+        names = [{'b_name': name} for name in names]
+        if not names:
+            return
+
+        table = DataVersion.__table__
+        db.session.execute(table.insert().prefix_with('OR IGNORE', dialect='sqlite')
+                           .values(name=db.bindparam('b_name'), version=0), names)
+        db.session.execute(table.update().where(table.c.name == db.bindparam('b_name'))
+                           .values(version=table.c.version + 1), names)
+
+    @staticmethod
+    def get_range(first, last):
+        """
+        :return: Sorted list of (name, version) for names between first and
+        last inclusive, one primary key range scan.
+        """
+        return db.session.query(DataVersion.name, DataVersion.version)\
+            .filter(DataVersion.name.between(first, last))\
+            .order_by(DataVersion.name)\
+            .all()
+
+
 # todo: determine how to get categories
 # todo: possible allow no categoies (none)
 class Category(db.Model):
@@ -55,15 +127,109 @@ class Category(db.Model):
 
     @staticmethod
     def is_category(category):
-        # TODO: test if this can be injected
-        return Category.query.filter_by(category=category).first() is not None
+        return category in category_cache.get()
+
+    @staticmethod
+    def get_existing(categories):
+        """
+        :param categories: Iterable of category descriptions
+        :return: Set of the given categories that exist, looked up with IN queries.
+        """
+        categories = list(set(categories))
+        existing = set()
+        # Stay under SQLite's bound parameter limit.
+        for i in range(0, len(categories), 500):
+            chunk = categories[i:i + 500]
+            existing.update(c for c, in db.session.query(Category.category)
+                            .filter(Category.category.in_(chunk)))
+        return existing
+
+    @staticmethod
+    def add_categories(categories):
+        """
+        Add the categories that don't exist yet with one existence lookup
+        and one bulk insert.  The insert ignores conflicts, so concurrent
+        callers adding overlapping categories don't hit IntegrityError.
+        Caller is required to commit.
+        :param categories: List of category descriptions
+        :return: List of categories that were not already present
+        """
+        existing = Category.get_existing(categories)
+        new_categories = []
+        for category in categories:
+            if category not in existing:
+                existing.add(category)
+                new_categories.append(category)
+
+        if new_categories:
+            db.session.execute(
+                Category.__table__.insert().prefix_with('OR IGNORE', dialect='sqlite'),
+                [{'category': c} for c in new_categories]
+            )
+            Category.categories_changed()
+
+        return new_categories
 
     @staticmethod
     def get_all_categories():
         """
-        :return: All categories as list of strings
+        :return: All categories as list of strings, served from category_cache
         """
-        return [c.category for c in Category.query.all()]
+        categories = category_cache.get()
+        return sorted(categories, key=categories.get)
+
+    @staticmethod
+    def load_categories():
+        """
+        :return: Dict of category description to id, read from the database.
+        """
+        return dict(db.session.query(Category.category, Category.id))
+
+    @staticmethod
+    def get_ids(categories):
+        """
+        Resolve category descriptions to ids through category_cache.
+        Categories the cache doesn't know yet (added in this session or by
+        another process within the check interval) are looked up directly.
+        :param categories: Iterable of category descriptions, None allowed
+        :return: Dict of description to id, None maps to None.
+        Raises CategoryNotFoundException for categories that don't exist.
+        """
+        known = category_cache.get()
+        ids = {None: None}
+        missing = []
+        for category in set(categories):
+            if category in known:
+                ids[category] = known[category]
+            elif category is not None:
+                missing.append(category)
+
+        if missing:
+            ids.update(db.session.query(Category.category, Category.id)
+                       .filter(Category.category.in_(missing)))
+            unknown = sorted(c for c in missing if c not in ids)
+            if unknown:
+                raise CategoryNotFoundException("Category '{}' does not exist.".format(
+                    "', '".join(unknown)))
+
+        return ids
+
+    @staticmethod
+    def names_by_id():
+        """
+        :return: Dict of category id to description, from category_cache.
+        Shared, don't modify.
+        """
+        return category_cache.get().names
+
+    @staticmethod
+    def categories_changed(connection=None):
+        """
+        Mark cached categories stale, here and in other processes.
+        Called on every write to the category table.
+        """
+        DataVersion.bump('categories', connection)
+        category_cache.invalidate()
 
     @staticmethod
     def get_category(description):
@@ -74,11 +240,31 @@ class Category(db.Model):
 
     def get_transactions(self, number_of_results=10):
         # TODO: allow options here
-        return Transaction.query\
-            .filter_by(category=self.category)\
-            .order_by(Transaction.date.desc())\
-            .limit(number_of_results)\
-            .all()
+        return Transaction.filter_query(category=self.category, limit=number_of_results).all()
+
+
+class CategoryIds(dict):
+    """
+    Category description to id, as cached by category_cache, with the
+    inverse map built once per load in names.
+    """
+    def __init__(self, ids):
+        super(CategoryIds, self).__init__(ids)
+        self.names = dict((id, name) for name, id in self.items())
+
+
+category_cache = VersionedCache(
+    load=lambda: CategoryIds(Category.load_categories()),
+    get_version=lambda: DataVersion.get('categories'),
+    check_interval=app.config.get('CATEGORY_CACHE_CHECK_INTERVAL', 0),
+)
+
+
+@event.listens_for(Category, 'after_insert')
+@event.listens_for(Category, 'after_update')
+@event.listens_for(Category, 'after_delete')
+def _category_written(mapper, connection, target):
+    Category.categories_changed(connection)
 
 
 class Account(db.Model):
@@ -87,6 +273,13 @@ class Account(db.Model):
     # In cents, TODO: use a different type.
     balance = db.Column(db.Integer, nullable=False)
     type = db.Column(db.String(64), nullable=False)
+    # Bumped with every balance change, used for ETags.
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Transactions dated before archived_before were moved to the archive
+    # database (see books_api/archive.py), opening_balance is the balance
+    # at that date.
+    archived_before = db.Column(db.Date)
+    opening_balance = db.Column(db.Integer)
 
     transactions = db.relationship('Transaction', backref='account_info', lazy='dynamic')
 
@@ -118,6 +311,32 @@ class Account(db.Model):
     def get_by_id(id):
         return Account.query.get(id)
 
+    @staticmethod
+    def get_version(id):
+        """
+        :return: Version of the account, None if it doesn't exist.
+        Reads a single column, the account itself is not loaded.
+        """
+        return db.session.query(Account.version).filter_by(id=id).scalar()
+
+    # Columns of the plain row form used by listings, in order.
+    row_columns = ['id', 'description', 'balance', 'type']
+
+    @staticmethod
+    def get_rows(description=None):
+        """
+        Accounts as plain tuples of row_columns, selected through Core
+        without building ORM instances.
+        :param description: Only return the account with this description.
+        :return: List of rows
+        """
+        table = Account.__table__
+        query = db.select([table.c[c] for c in Account.row_columns]).order_by(table.c.id)
+        if description is not None:
+            query = query.where(table.c.description == description)
+
+        return db.session.execute(query).fetchall()
+
     def as_dict(self):
         return {
             "id": self.id,
@@ -126,14 +345,103 @@ class Account(db.Model):
             "type": self.type,
         }
 
-    def __update_balance_by(self, amount, transaction_type):
-        # TODO ensure this is OK
-        self.balance = self.balance + amount if transaction_type == "credit"\
-            else self.balance - amount
+    @staticmethod
+    def update_balance(account_id, delta, earliest=None):
+        """
+        Add delta to the stored balance with a single UPDATE, so concurrent
+        writers can't lose each other's changes and the account row never
+        needs to be loaded first.
+        :param account_id: Account to update
+        :param delta: Signed amount in cents
+        :param earliest: Earliest date of the transactions being added,
+        the update is refused if it is before the account's archive cutoff,
+        or archive_cutoff() for accounts created after the last archiving.
+        :return: False if the account does not exist
+        Raises TransactionException if earliest is archived.
+        """
+        table = Account.__table__
+        condition = table.c.id == account_id
+        cutoff = table.c.archived_before
+        if earliest is not None:
+            # Archived history is read-only.  Checked in the UPDATE itself,
+            # so inserts don't pay for a separate lookup.
+            if archive_attached():
+                others = table.alias('others')
+                cutoff = db.func.coalesce(
+                    table.c.archived_before,
+                    db.select([db.func.max(others.c.archived_before)]).as_scalar())
+            condition = db.and_(condition, db.or_(cutoff.is_(None), cutoff <= as_date(earliest)))
+
+        result = db.session.execute(
+            table.update()
+            .where(condition)
+            .values(balance=table.c.balance + delta, version=table.c.version + 1)
+        )
+        if result.rowcount != 1:
+            # Only failed updates pay for telling the two cases apart.
+            row = db.session.execute(db.select([cutoff]).where(table.c.id == account_id)).first()
+            if row is None:
+                return False
+            raise TransactionException("Transactions before {} are archived.".format(row[0]))
+
+        DataVersion.bump('accounts')
+        return True
+
+    def __update_balance_by(self, amount, transaction_type, earliest=None):
+        Account.update_balance(self.id, Transaction.signed_amount(amount, transaction_type), earliest)
+        self.__expire_balance()
+
+    def __expire_balance(self):
+        # The stored balance changed underneath us, reload it on next access.
+        if self in db.session:
+            db.session.expire(self, ['balance', 'version'])
+
+    @staticmethod
+    def insert_transaction(account_id, date, description, amount, type, category):
+        """
+        Add a transaction to an account without loading the account.
+        The balance is updated in SQL in the same database transaction.
+        Caller is required to add the returned object and commit.
+        :param account_id: Account to add the transaction to
+        :return: Transaction added
+        Raises AccountException if the account does not exist,
+        CategoryNotFoundException if the category doesn't.
+        """
+        # The column holds a date, keep the new object as it will be read back.
+        date = as_date(date)
+        amount = int(amount)
+        signed = Transaction.signed_amount(amount, type)
+        category_id = Category.get_ids([category])[category]
+        if not Account.update_balance(account_id, signed, earliest=date):
+            raise AccountException("Account does not exist.")
+
+        TransactionSummary.apply(account_id, date, category, type, amount)
+
+        # The new row sorts last on its date: its running balance is the new
+        # account balance less everything dated later, and only those later
+        # rows move.  Appends touch no other rows.  Earlier transactions the
+        # caller added to the session must be written first to be counted.
+        db.session.flush()
+        table = Transaction.__table__
+        later = db.select([db.func.coalesce(db.func.sum(Transaction.signed_amount_column()), 0)])\
+            .where(db.and_(table.c.account_id == account_id, table.c.date > date))\
+            .as_scalar()
+        balance_after = db.session.execute(
+            db.select([Account.balance - later]).where(Account.id == account_id)).scalar()
+        Transaction.shift_balances(account_id, signed, date)
+
+        return Transaction(
+            account_id=account_id,
+            description=description,
+            amount=amount,
+            type=type,
+            date=date,
+            category_id=category_id,
+            balance_after=balance_after,
+        )
 
     def add_transaction(self, date, description, amount, type, category):
         # TODO: how to ensure date is a datetime object, or ensure it can be?
-        # TODO: determine if amount isn't int
         # Caller is required to call the returned object and the self object
         """
         :param date: Datetime object
@@ -143,41 +451,107 @@ class Account(db.Model):
         :param category: Transaction category
         :return: Transaction added
         """
-        amount = int(amount)
-        new_transaction = Transaction(
-            account_id=self.id,
-            description=description,
-            amount=amount,
-            type=type,
-            date=date,
-            category=category
-        )
-
-        self.__update_balance_by(amount, type)
+        new_transaction = Account.insert_transaction(
+            self.id, date, description, amount, type, category)
+        self.__expire_balance()
 
         return new_transaction
 
-    def get_transactions(self):
-        # TODO: allow filtering options here
-        return Transaction.query \
-            .filter_by(account_id=self.id) \
-            .order_by(Transaction.date.desc()) \
-            .all()
+    def add_transactions(self, transactions):
+        """
+        Insert many transactions with one executemany and a single balance update.
+        Caller is required to add the self object and commit.
+        :param transactions: List of dicts with date, description, amount, type
+        and category.  Fields must already be checked with Transaction.validate.
+        :return: Number of transactions inserted
+        """
+        rows = []
+        delta = 0
+        summary = TransactionSummary.Deltas()
+        category_ids = Category.get_ids(tx['category'] for tx in transactions)
+        for tx in transactions:
+            amount = int(tx['amount'])
+            rows.append({
+                'account_id': self.id,
+                'description': tx['description'],
+                'amount': amount,
+                'type': tx['type'],
+                'date': tx['date'],
+                'category_id': category_ids[tx['category']],
+            })
+            delta += Transaction.signed_amount(amount, tx['type'])
+            summary.add(self.id, tx['date'], tx['category'], tx['type'], amount)
+
+        if rows:
+            earliest = min(as_date(r['date']) for r in rows)
+            self.__update_balance_by(delta, "credit", earliest)
+            db.session.execute(Transaction.__table__.insert(), rows)
+            TransactionSummary.apply_deltas(summary)
+            # Only the earliest new date onwards can have moved.
+            Transaction.recompute_balances(self.id, since=earliest)
+
+        return len(rows)
+
+    @staticmethod
+    def balance_at(account_id, date):
+        """
+        Balance of the account at the end of date, from the running balance
+        of its last transaction on or before date (one index lookup).
+        Before the first transaction this is the opening balance.  Archived
+        transactions are only looked up if the hot table has none by date.
+        :return: Balance in cents, None if the account does not exist.
+        """
+        tables = [Transaction.__table__]
+        if archive_cutoff() is not None:
+            tables.append(archive_transactions)
+
+        lasts = []
+        openings = []
+        for table in tables:
+            own = table.c.account_id == Account.id
+            lasts.append(db.select([table.c.balance_after])
+                         .where(db.and_(own, table.c.date <= date))
+                         .order_by(table.c.date.desc(), table.c.id.desc())
+                         .limit(1).as_scalar())
+            openings.insert(0, db.select([table.c.balance_after - Transaction.signed_amount_column(table.c)])
+                            .where(own)
+                            .order_by(table.c.date, table.c.id)
+                            .limit(1).as_scalar())
+
+        return db.session.execute(
+            db.select([db.func.coalesce(*(lasts + openings + [Account.balance]))])
+            .where(Account.id == account_id)
+        ).scalar()
+
+    def get_transactions(self, limit=None, after=None):
+        """
+        Transactions for this account, newest first.
+        Ordered by (date, id) so pages are stable across inserts.
+        :param limit: Maximum number of transactions to return, all if None.
+        :param after: (date, id) of the last transaction of the previous page.
+        Only transactions strictly older than it are returned.
+        :return: List of transactions
+        """
+        return Transaction.filter_query(account_id=self.id, after=after, limit=limit).all()
 
     def remove_transaction(self, transaction):
         """
         Roll back transaction for this account.
         Caller is required to add account & remove transaction database session
         :param transaction: Valid transaction object w/ id.
-        :return: Raise Exception if id isn't found for this account.
+        :return: Raise Exception if id isn't found for this account, or
+        TransactionException if it was archived.
         """
-        # Check that transaction still exists.
-        record_list = Transaction.get_transactions(transaction_id=transaction.id)
-        if not record_list:
+        # Check that transaction still exists.  Only the hot table can be
+        # written, archived rows stay as they are.
+        record = Transaction.query.filter_by(id=transaction.id).first()
+        if record is None:
+            if archive_attached() and db.session.execute(
+                    db.select([archive_transactions.c.id]).where(
+                        archive_transactions.c.id == transaction.id)).scalar() is not None:
+                raise TransactionException("Transaction {} is archived.".format(transaction.id))
             raise AccountException("Transaction does not exist.")
 
-        record = record_list.pop()
-
         # TODO: how to guarantee that transaction is the correct object
         if record.account_id != self.id:
             raise AccountException("Transaction {} not found for this account {}".format(
@@ -185,6 +559,10 @@ class Account(db.Model):
             ))
 
         self.__update_balance_by(-record.amount, record.type)
+        TransactionSummary.apply(self.id, record.date, record.category, record.type,
+                                 -record.amount, count=-1)
+        Transaction.shift_balances(self.id, -Transaction.signed_amount(record.amount, record.type),
+                                   record.date, after_id=record.id)
 
         return record
 
@@ -194,7 +572,37 @@ class Account(db.Model):
         )
 
 
+@event.listens_for(Account, 'after_insert')
+@event.listens_for(Account, 'after_update')
+@event.listens_for(Account, 'after_delete')
+def _account_written(mapper, connection, target):
+    DataVersion.bump('accounts', connection)
+
+
+def category_filter(column, categories):
+    """
+    :param column: Transaction.category_id
+    :param categories: Category descriptions, unknown ones match nothing.
+    :return: Predicate on the category ids
+    """
+    known = category_cache.get()
+    ids = [known[c] for c in categories if c in known]
+    if not ids:
+        return db.false()
+    return column == ids[0] if len(ids) == 1 else column.in_(ids)
+
+
 class Transaction(db.Model):
+    # Listing queries filter on account or category and sort by (date, id),
+    # these let them walk an index in order instead of scanning and sorting.
+    __table_args__ = (
+        db.Index('ix_transaction_account_id_date', 'account_id', 'date', 'id'),
+        db.Index('ix_transaction_category_id_date', 'category_id', 'date', 'id'),
+        db.Index('ix_transaction_date', 'date', 'id'),
+        # Ids of deleted or archived transactions are never handed out again.
+        {'sqlite_autoincrement': True},
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     account_id = db.Column(db.Integer, db.ForeignKey('account.id'))
 
@@ -202,31 +610,393 @@ class Transaction(db.Model):
     amount = db.Column(db.Integer, nullable=False)
     type = db.Column(db.String(64), nullable=False)
 
-    category = db.Column(db.String(64), db.ForeignKey('category.category'))
+    # Category names live only in the category table, the API resolves them
+    # through Category.get_ids and names_by_id.
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
     date = db.Column(db.Date, nullable=False)
 
+    # Account balance once this and every earlier transaction, in (date, id)
+    # order, are applied.  Maintained by Account.add_transaction(s) and
+    # remove_transaction, NULL only before the upgrade backfill has run.
+    balance_after = db.Column(db.Integer)
+
+    @property
+    def category(self):
+        """
+        :return: Category description, None if uncategorized
+        """
+        return Category.names_by_id().get(self.category_id)
+
+    @category.setter
+    def category(self, description):
+        self.category_id = Category.get_ids([description])[description]
+
+    @staticmethod
+    def signed_amount(amount, type):
+        """
+        :return: amount as it affects the account balance
+        """
+        return amount if type == "credit" else -amount
+
+    @staticmethod
+    def signed_amount_column(columns=None):
+        """
+        :param columns: Transaction (default), or the columns of a table with
+        the same layout such as archive_transactions.c
+        :return: SQL expression of signed_amount for the amount and type columns
+        """
+        columns = columns if columns is not None else Transaction
+        return db.case([(columns.type == "credit", columns.amount)], else_=-columns.amount)
+
+    @staticmethod
+    def shift_balances(account_id, delta, date, after_id=None):
+        """
+        Add delta to balance_after of the account's transactions that come
+        after (date, after_id), or after every transaction on date if
+        after_id is None.  Caller is required to commit.
+        """
+        later = Transaction.date > date
+        if after_id is not None:
+            later = db.or_(later, db.and_(Transaction.date == date, Transaction.id > after_id))
+
+        table = Transaction.__table__
+        db.session.execute(table.update()
+                           .where(db.and_(table.c.account_id == account_id, later))
+                           .values(balance_after=table.c.balance_after + delta))
+
+    @staticmethod
+    def recompute_balances(account_id, since=None):
+        """
+        Rewrite balance_after for the account's transactions dated on or
+        after since (all of them if None), working back from the stored
+        account balance.  Caller is required to commit.
+        :return: Number of transactions updated
+        """
+        table = Transaction.__table__
+        signed = Transaction.signed_amount_column()
+
+        condition = table.c.account_id == account_id
+        if since is not None:
+            condition = db.and_(condition, table.c.date >= since)
+
+        rows = db.session.execute(db.select([table.c.id, signed])
+                                  .where(condition)
+                                  .order_by(table.c.date, table.c.id)).fetchall()
+        if not rows:
+            return 0
+
+        account = Account.__table__
+        balance = db.session.execute(db.select([account.c.balance]).where(account.c.id == account_id)).scalar()
+
+        running = balance - sum(amount for _, amount in rows)
+        updates = []
+        for id, amount in rows:
+            running += amount
+            updates.append({'b_id': id, 'b_balance': running})
+
+        db.session.execute(table.update()
+                           .where(table.c.id == db.bindparam('b_id'))
+                           .values(balance_after=db.bindparam('b_balance')), updates)
+
+        return len(updates)
+
+    @staticmethod
+    def validate(date, description, amount, type, category):
+        """
+        Check transaction fields before they are written.
+        Category existence is left to the caller, see category_cache.
+        :return: amount as int (cents)
+        Raises TransactionException describing the bad field.
+        """
+        if not isinstance(date, (datetime.date, datetime.datetime)):
+            raise TransactionException("Invalid date '{}'.".format(date))
+
+        if not description:
+            raise TransactionException("Missing description.")
+
+        if type not in transaction_types:
+            raise TransactionException("Type '{}' not in '{}'.".format(type, transaction_types))
+
+        try:
+            amount = int(amount)
+        except (TypeError, ValueError):
+            raise TransactionException("Amount '{}' is not an integer.".format(amount))
+
+        return amount
+
+    # Keyword filters accepted by filter_query: name -> (column, comparison).
+    # All comparisons are plain column predicates so the planner can use the
+    # (account_id, date, id), (category_id, date, id) and (date, id) indexes.
+    # Category filters take descriptions, see category_filter.
+    filters = {
+        'transaction_id': ('id', operator.eq),
+        'account_id': ('account_id', operator.eq),
+        'account_ids': ('account_id', lambda column, values: column.in_(values)),
+        'description': ('description', operator.eq),
+        'amount': ('amount', operator.eq),
+        'amount_min': ('amount', operator.ge),
+        'amount_max': ('amount', operator.le),
+        'date': ('date', operator.eq),
+        'date_from': ('date', operator.ge),
+        'date_to': ('date', operator.le),
+        'type': ('type', operator.eq),
+        'category': ('category_id', lambda column, value: category_filter(column, [value])),
+        'categories': ('category_id', category_filter),
+    }
+
+    # Columns filter_query can sort on, id breaks ties.
+    sort_columns = ['date', 'amount']
+
+    @staticmethod
+    def filter_conditions(columns, **filters):
+        """
+        :param columns: Transaction, or the columns of a table with the
+        same layout such as archive_transactions.c
+        :param filters: See Transaction.filters, None values are ignored.
+        :return: List of conditions
+        """
+        conditions = []
+        for name, value in filters.items():
+            if name not in Transaction.filters:
+                raise TypeError("Unknown transaction filter '{}'".format(name))
+            if value is None:
+                continue
+
+            column, compare = Transaction.filters[name]
+            conditions.append(compare(getattr(columns, column), value))
+
+        return conditions
+
+    @staticmethod
+    def apply_filters(query, **filters):
+        """
+        :param query: Query over Transaction
+        :param filters: See Transaction.filters, None values are ignored.
+        :return: query restricted by filters
+        """
+        return query.filter(*Transaction.filter_conditions(Transaction, **filters))
+
+    @staticmethod
+    def needs_archive(**filters):
+        """
+        :param filters: See Transaction.filters
+        :return: True if the archive is attached and the filters' date range
+        starts before its cutoff.  filter_query still reads only the hot
+        table when that answers the page, see __hot_rows_suffice.
+        """
+        cutoff = archive_cutoff()
+        if cutoff is None:
+            return False
+
+        start = filters.get('date_from') or filters.get('date')
+        return start is None or as_date(start) < cutoff
+
     @staticmethod
-    def get_transactions(transaction_id=None,
-                         account_id=None, description=None,
-                         amount=None, date=None, type=None, category=None):
-        # TODO: clean this mess up
+    def storage():
+        """
+        :return: Table holding all transactions: the hot table, or the hot
+        table and the archive combined while an archive is attached.
+        """
+        if archive_cutoff() is None:
+            return Transaction.__table__
+
+        return db.union_all(
+            db.select([Transaction.__table__]), db.select([archive_transactions])
+        ).alias('transaction_storage')
+
+    @staticmethod
+    def filter_query(sort='date', descending=True, after=None, limit=None, **filters):
+        """
+        Build a transaction query from keyword filters, see Transaction.filters.
+        Filters set to None are ignored, other values (including 0) apply.
+        :param sort: Column in Transaction.sort_columns to order by.
+        :param descending: Sort order, id breaks ties in the same direction.
+        :param after: (sort value, id) of the last row of the previous page.
+        :param limit: Maximum number of rows, all if None.
+        :return: Query
+        """
+        if sort not in Transaction.sort_columns:
+            raise TransactionException("Can't sort transactions by '{}'.".format(sort))
+
+        def page(columns):
+            conditions = Transaction.filter_conditions(columns, **filters)
+            sort_column = getattr(columns, sort)
+            if after is not None:
+                after_value, after_id = after
+                before = operator.lt if descending else operator.gt
+                conditions.append(db.or_(
+                    before(sort_column, after_value),
+                    db.and_(sort_column == after_value, before(columns.id, after_id))
+                ))
+
+            if descending:
+                return conditions, [sort_column.desc(), columns.id.desc()]
+            return conditions, [sort_column, columns.id]
+
         t = Transaction.query
-        if transaction_id:
-            t = t.filter_by(id=transaction_id)
-        if account_id:
-            t = t.filter_by(account_id=account_id)
-        if description:
-            t = t.filter_by(description=description)
-        if date:
-            t = t.filter_by(date=date)
-        if type:
-            t = t.filter_by(type=type)
-        if amount:
-            t = t.filter_by(amount=amount)
-        if category:
-            t = t.filter_by(category=category)
-
-        return t.order_by(Transaction.date.desc()).all()
+        if (Transaction.needs_archive(**filters) and
+                not Transaction.__hot_rows_suffice(page, sort, descending, limit, **filters)):
+            # Page through hot and archived rows separately, each from its
+            # own index, and merge the two pages.
+            parts = []
+            for table in (Transaction.__table__, archive_transactions):
+                conditions, order = page(table.c)
+                part = db.select([table]).order_by(*order)
+                for condition in conditions:
+                    part = part.where(condition)
+                if limit is not None:
+                    part = part.limit(limit)
+                parts.append(db.select([part.alias()]))
+            t = t.select_entity_from(db.union_all(*parts).alias('transaction_storage'))
+
+        conditions, order = page(Transaction)
+        t = t.filter(*conditions).order_by(*order)
+
+        if limit is not None:
+            t = t.limit(limit)
+
+        return t
+
+    @staticmethod
+    def __hot_rows_suffice(page, sort, descending, limit, transaction_id=None, **filters):
+        """
+        Archived rows all predate archive_cutoff(), so the hot table alone
+        answers a lookup of an id it holds, or a newest first page by date it
+        fills with rows from on or after the cutoff.  Checked with one index
+        lookup on the hot table.
+        :param page: filter_query's function building conditions and order
+        """
+        table = Transaction.__table__
+        conditions, order = page(table.c)
+        if transaction_id is not None:
+            probe = db.select([table.c.id])
+        elif sort == 'date' and descending and limit is not None:
+            probe = db.select([table.c.date]).order_by(*order).offset(limit - 1)
+        else:
+            return False
+
+        for condition in conditions:
+            probe = probe.where(condition)
+        found = db.session.execute(probe.limit(1)).scalar()
+        if found is None:
+            return False
+
+        return transaction_id is not None or as_date(found) >= archive_cutoff()
+
+    @staticmethod
+    def get_transactions(**filters):
+        """
+        :param filters: See Transaction.filters
+        :return: Matching transactions, newest first
+        """
+        return Transaction.filter_query(**filters).all()
+
+    @staticmethod
+    def search_query(text, after=None, limit=None, **filters):
+        """
+        Full-text search over descriptions through the transaction_search
+        FTS5 index, best matches first.
+        :param text: Search terms, see search_expression.
+        :param after: (rank, id) of the last row of the previous page.
+        :param limit: Maximum number of rows, all if None.
+        :param filters: See Transaction.filters
+        :return: Query of transactions, select transaction_search.c.rank
+        through as_rows to build a cursor.
+        Raises TransactionException if text has no search terms.
+        """
+        expression = search_expression(text)
+        rank = transaction_search.c.rank
+
+        t = Transaction.query\
+            .join(transaction_search, transaction_search.c.rowid == Transaction.id)\
+            .filter(transaction_search.c.transaction_search.op('MATCH')(expression))
+        t = Transaction.apply_filters(t, **filters)
+
+        if after is not None:
+            after_rank, after_id = after
+            t = t.filter(db.or_(rank > after_rank, db.and_(rank == after_rank, Transaction.id > after_id)))
+
+        # FTS5 ranks are bm25 scores, lower is a better match.
+        t = t.order_by(rank, Transaction.id)
+        if limit is not None:
+            t = t.limit(limit)
+
+        return t
+
+    # Columns of the plain row form used by listings and exports, in order.
+    row_columns = ['id', 'account_id', 'date', 'description', 'amount', 'type', 'category',
+                   'balance_after']
+
+    @staticmethod
+    def as_rows(query, *extra):
+        """
+        Select row_columns instead of Transaction instances, skipping
+        identity map bookkeeping for read-only listings.
+        :param query: Transaction query, e.g. from filter_query
+        :param extra: Further columns to select after row_columns
+        :return: Query yielding named tuples
+        """
+        return query.with_entities(*Transaction.row_entities(Transaction) + list(extra))
+
+    @staticmethod
+    def row_entities(columns):
+        """
+        :param columns: Transaction or the columns of a table with the same layout
+        :return: row_columns to select, with the category id as 'category'
+        """
+        return [columns.category_id.label('category') if c == 'category' else getattr(columns, c)
+                for c in Transaction.row_columns]
+
+    @staticmethod
+    def resolve_categories(rows):
+        """
+        Replace the category id selected by as_rows with its description.
+        :param rows: Iterable of rows from as_rows
+        :return: Iterator of tuples
+        """
+        names = Category.names_by_id()
+        index = Transaction.row_columns.index('category')
+        for row in rows:
+            yield row[:index] + (names.get(row[index]),) + row[index + 1:]
+
+    @staticmethod
+    def iter_rows(account_id=None, batch_size=1000):
+        """
+        Stream transactions as plain tuples (see row_columns) in ledger order.
+        Rows are fetched batch_size at a time from the cursor instead of
+        being loaded up front, so memory use doesn't grow with the ledger.
+        :param account_id: Only export this account, all accounts if None.
+        :param batch_size: Rows fetched per round trip.
+        :return: Iterator of tuples
+        """
+        if archive_cutoff() is not None:
+            return Transaction.resolve_categories(Transaction.__iter_archived_rows(account_id))
+
+        t = Transaction.as_rows(Transaction.query)
+        if account_id is not None:
+            t = t.filter(Transaction.account_id == account_id)
+
+        return Transaction.resolve_categories(
+            t.order_by(Transaction.account_id, Transaction.date, Transaction.id).yield_per(batch_size))
+
+    @staticmethod
+    def __iter_archived_rows(account_id):
+        # Per account, every archived row predates every hot one (see
+        # Account.update_balance), so each table is read in index order
+        # and no sort over both is needed.
+        if account_id is not None:
+            account_ids = [account_id]
+        else:
+            account_ids = [id for id, in db.session.query(Account.id).order_by(Account.id)]
+
+        for id in account_ids:
+            for table in (archive_transactions, Transaction.__table__):
+                rows = db.session.execute(
+                    db.select(Transaction.row_entities(table.c))
+                    .where(table.c.account_id == id)
+                    .order_by(table.c.date, table.c.id))
+                for row in rows:
+                    yield tuple(row)
 
     def as_dict(self):
         return {
@@ -237,6 +1007,7 @@ class Transaction(db.Model):
             'type': self.type,
             'category': self.category,
             'date': str(self.date),
+            'balance_after': self.balance_after,
         }
 
     def __repr__(self):
@@ -250,3 +1021,372 @@ class Transaction(db.Model):
             self.category,
             self.date
         )
+
+
+# Inserts only ever add higher ids, readers of copies of the transaction
+# table (see books_api/analytics.py) pick those up by id.  Changing or
+# deleting existing rows bumps 'transaction_rewrites' instead.
+@event.listens_for(Transaction, 'after_update')
+@event.listens_for(Transaction, 'after_delete')
+def _transaction_rewritten(mapper, connection, target):
+    DataVersion.bump('transaction_rewrites', connection)
+
+
+# External content FTS5 index over Transaction.description, keyed by
+# transaction id.  Triggers keep it in sync with every write, including
+# Core bulk inserts that bypass the ORM.  Not part of db.metadata, the DDL
+# runs with the transaction table (and in migrations for older databases).
+transaction_search = db.table(
+    'transaction_search',
+    db.column('rowid', db.Integer),
+    db.column('transaction_search'),
+    db.column('rank', db.Float),
+)
+
+transaction_search_ddl = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS transaction_search USING fts5(
+        description, content='transaction', content_rowid='id', prefix='2 3')""",
+    """CREATE TRIGGER IF NOT EXISTS transaction_search_insert AFTER INSERT ON "transaction" BEGIN
+        INSERT INTO transaction_search (rowid, description) VALUES (new.id, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS transaction_search_delete AFTER DELETE ON "transaction" BEGIN
+        INSERT INTO transaction_search (transaction_search, rowid, description)
+        VALUES ('delete', old.id, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS transaction_search_update AFTER UPDATE OF description
+    ON "transaction" BEGIN
+        INSERT INTO transaction_search (transaction_search, rowid, description)
+        VALUES ('delete', old.id, old.description);
+        INSERT INTO transaction_search (rowid, description) VALUES (new.id, new.description);
+    END""",
+]
+
+for _statement in transaction_search_ddl:
+    event.listen(Transaction.__table__, 'after_create',
+                 db.DDL(_statement).execute_if(dialect='sqlite'))
+event.listen(Transaction.__table__, 'after_drop',
+             db.DDL("DROP TABLE IF EXISTS transaction_search").execute_if(dialect='sqlite'))
+
+_search_term = re.compile(r'"([^"]*)"\*?|(\S+)')
+
+
+def search_expression(text):
+    """
+    Translate user search text into an FTS5 query.  Every term must match:
+    "quoted words" match as a phrase and a trailing * matches a prefix,
+    anything else is taken literally rather than as FTS5 syntax.
+    :return: FTS5 query string
+    Raises TransactionException if text has no search terms.
+    """
+    terms = []
+    for match in _search_term.finditer(text or ''):
+        phrase, word = match.groups()
+        if phrase is not None:
+            term, prefix = phrase, match.group(0).endswith('*')
+        else:
+            term, prefix = word.rstrip('*'), word.endswith('*')
+
+        # Only keep terms with something the tokenizer indexes.
+        if not re.search(r'\w', term, re.UNICODE):
+            continue
+        terms.append(u'"{}"{}'.format(term.replace('"', '""'), '*' if prefix else ''))
+
+    if not terms:
+        raise TransactionException("No search terms in '{}'.".format(text))
+
+    return ' '.join(terms)
+
+
+# Transactions moved out of the hot table by books_api/archive.py.  They
+# live in the ARCHIVE_DATABASE file, attached read-only to every connection
+# as schema 'archive'.  Same columns as Transaction, not part of db.metadata.
+archive_transactions = db.Table(
+    'transaction', db.MetaData(),
+    *[db.Column(c.name, c.type, primary_key=c.primary_key) for c in Transaction.__table__.columns],
+    schema='archive'
+)
+db.Index('ix_archive_transaction_account_id_date', archive_transactions.c.account_id,
+         archive_transactions.c.date, archive_transactions.c.id)
+db.Index('ix_archive_transaction_category_id_date', archive_transactions.c.category_id,
+         archive_transactions.c.date, archive_transactions.c.id)
+db.Index('ix_archive_transaction_date', archive_transactions.c.date, archive_transactions.c.id)
+
+
+def archive_attached():
+    path = app.config['ARCHIVE_DATABASE']
+    return bool(path) and os.path.exists(path)
+
+
+def archive_cutoff():
+    """
+    Looked up once per request, the archive only moves between requests.
+    :return: Latest archive cutoff of any account, None if there is no
+    archive attached or nothing was archived yet.
+    """
+    if not archive_attached():
+        return None
+    if has_request_context() and 'archive_cutoff' in g:
+        return g.archive_cutoff
+
+    cutoff = db.session.query(db.func.max(Account.archived_before)).scalar()
+    if has_request_context():
+        g.archive_cutoff = cutoff
+    return cutoff
+
+
+@event.listens_for(Engine, 'connect')
+def _attach_archive(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection) and archive_attached():
+        dbapi_connection.execute("ATTACH DATABASE ? AS archive", (
+            'file:{}?mode=ro'.format(os.path.abspath(app.config['ARCHIVE_DATABASE'])),))
+
+
+def as_date(value):
+    """
+    :return: datetime.date of a date or datetime
+    """
+    return datetime.date(value.year, value.month, value.day)
+
+
+class TransactionSummary(db.Model):
+    """
+    Rollup of transaction totals per account, month and category.
+    Kept up to date by Account.add_transaction(s) and remove_transaction in
+    the same database transaction, so summaries never scan Transaction.
+    Uncategorized transactions are rolled up under the empty string.
+
+    Every write bumps the 'summary:YYYY-MM' DataVersion of the months it
+    touched, and rebuild bumps 'summary', so cached reports can tell which
+    months changed, see month_versions.
+    """
+    __tablename__ = 'transaction_summary'
+    __table_args__ = (
+        db.UniqueConstraint('account_id', 'month', 'category'),
+        # Cross-account reports group by month and category over a range.
+        db.Index('ix_transaction_summary_month_category', 'month', 'category'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
+    # First day of the month
+    month = db.Column(db.Date, nullable=False)
+    category = db.Column(db.String(64), nullable=False)
+
+    debits = db.Column(db.Integer, nullable=False, default=0)
+    credits = db.Column(db.Integer, nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    class Deltas(object):
+        """ Changes to summary rows, accumulated in memory for apply_deltas. """
+        def __init__(self):
+            self.rows = {}
+
+        def add(self, account_id, date, category, type, amount, count=1):
+            key = (account_id, datetime.date(date.year, date.month, 1), category or '')
+            debits, credits, n = self.rows.get(key, (0, 0, 0))
+            if type == "credit":
+                credits += amount
+            else:
+                debits += amount
+            self.rows[key] = (debits, credits, n + count)
+
+    @staticmethod
+    def apply(account_id, date, category, type, amount, count=1):
+        """
+        Add one transaction to the rollup.  Pass a negative amount and count
+        to take one out again.
+        """
+        deltas = TransactionSummary.Deltas()
+        deltas.add(account_id, date, category, type, amount, count)
+        TransactionSummary.apply_deltas(deltas)
+
+    @staticmethod
+    def apply_deltas(deltas):
+        """
+        Write accumulated changes with two executemany statements: create any
+        missing rows, then increment them in SQL so concurrent writers don't
+        overwrite each other.
+        Caller is required to commit.
+        :param deltas: TransactionSummary.Deltas
+        """
+        if not deltas.rows:
+            return
+
+        DataVersion.bump_all(sorted(set(
+            TransactionSummary.version_name(month) for _, month, _ in deltas.rows)))
+
+        table = TransactionSummary.__table__
+        keys = [{
+            'b_account_id': account_id,
+            'b_month': month,
+            'b_category': category,
+            'b_debits': debits,
+            'b_credits': credits,
+            'b_count': count,
+        } for (account_id, month, category), (debits, credits, count) in deltas.rows.items()]
+
+        db.session.execute(
+            table.insert().prefix_with('OR IGNORE', dialect='sqlite').values(
+                account_id=db.bindparam('b_account_id'),
+                month=db.bindparam('b_month'),
+                category=db.bindparam('b_category'),
+                debits=0, credits=0, count=0,
+            ), keys)
+
+        db.session.execute(
+            table.update().where(db.and_(
+                table.c.account_id == db.bindparam('b_account_id'),
+                table.c.month == db.bindparam('b_month'),
+                table.c.category == db.bindparam('b_category'),
+            )).values(
+                debits=table.c.debits + db.bindparam('b_debits'),
+                credits=table.c.credits + db.bindparam('b_credits'),
+                count=table.c.count + db.bindparam('b_count'),
+            ), keys)
+
+    @staticmethod
+    def version_name(month):
+        """
+        :return: DataVersion name of the month containing date month
+        """
+        return month.strftime('summary:%Y-%m')
+
+    @staticmethod
+    def month_versions(month_from=None, month_to=None):
+        """
+        :param month_from: First month (a date in it), unbounded if None
+        :param month_to: Last month, unbounded if None
+        :return: Tuple of (name, version) of 'summary' and the months in
+        range that were ever written.  Changes whenever the rollup of any
+        of those months does.
+        """
+        first = TransactionSummary.version_name(month_from) if month_from else 'summary:'
+        last = TransactionSummary.version_name(month_to) if month_to else 'summary:~'
+        return (('summary', DataVersion.get('summary')),) + tuple(DataVersion.get_range(first, last))
+
+    @staticmethod
+    def cashflow(month_from=None, month_to=None, account_ids=None):
+        """
+        Debits, credits and count per month and category across accounts,
+        in one GROUP BY over the rollup.
+        :param month_from: First month (a date in it), unbounded if None
+        :param month_to: Last month, unbounded if None
+        :param account_ids: Accounts to include, all if None.
+        :return: List of (month, category, debits, credits, count) ordered
+        by month and category, category is '' for uncategorized.
+        """
+        summary = TransactionSummary.__table__
+        count = db.func.sum(summary.c.count)
+        query = db.select([
+            summary.c.month,
+            summary.c.category,
+            db.func.sum(summary.c.debits),
+            db.func.sum(summary.c.credits),
+            count,
+        ])
+        if month_from is not None:
+            query = query.where(summary.c.month >= datetime.date(month_from.year, month_from.month, 1))
+        if month_to is not None:
+            query = query.where(summary.c.month <= datetime.date(month_to.year, month_to.month, 1))
+        if account_ids is not None:
+            query = query.where(summary.c.account_id.in_(account_ids))
+        query = query.group_by(summary.c.month, summary.c.category)\
+            .having(count != 0)\
+            .order_by(summary.c.month, summary.c.category)
+
+        return db.session.execute(query).fetchall()
+
+    @staticmethod
+    def get_for_account(account_id):
+        """
+        :return: Non-empty summary rows for account, ordered by month and category.
+        """
+        return TransactionSummary.query\
+            .filter(TransactionSummary.account_id == account_id,
+                    TransactionSummary.count != 0)\
+            .order_by(TransactionSummary.month, TransactionSummary.category)\
+            .all()
+
+    @staticmethod
+    def net_worth_by_month(account_ids=None):
+        """
+        Combined balance of the accounts at the end of every month with
+        activity, in one query: the opening balance plus a running sum of
+        the monthly rollup.
+        :param account_ids: Accounts to include, all if None.
+        :return: List of (month, balance), oldest first
+        """
+        summary = TransactionSummary.__table__
+        account = Account.__table__
+        net = summary.c.credits - summary.c.debits
+
+        current = db.select([db.func.coalesce(db.func.sum(account.c.balance), 0)])
+        total_net = db.select([db.func.coalesce(db.func.sum(net), 0)])
+        if account_ids is not None:
+            current = current.where(account.c.id.in_(account_ids))
+            total_net = total_net.where(summary.c.account_id.in_(account_ids))
+
+        opening = current.as_scalar() - total_net.correlate(None).as_scalar()
+        query = db.select([
+            summary.c.month,
+            opening + db.func.sum(db.func.sum(net)).over(order_by=summary.c.month),
+        ])
+        if account_ids is not None:
+            query = query.where(summary.c.account_id.in_(account_ids))
+        query = query.group_by(summary.c.month).order_by(summary.c.month)
+
+        return [(month, balance) for month, balance in db.session.execute(query)]
+
+    @staticmethod
+    def rebuild():
+        """
+        Recompute the whole rollup from Transaction, archived rows included,
+        for backfilling existing databases.  Caller is required to commit.
+        :return: Number of summary rows written
+        """
+        table = TransactionSummary.__table__
+        source = Transaction.storage()
+        is_credit = source.c.type == "credit"
+
+        db.session.execute(table.delete())
+        DataVersion.bump('summary')
+        result = db.session.execute(table.insert().from_select(
+            ['account_id', 'month', 'category', 'debits', 'credits', 'count'],
+            db.select([
+                source.c.account_id,
+                db.func.date(source.c.date, 'start of month'),
+                db.func.coalesce(Category.category, ''),
+                db.func.sum(db.case([(is_credit, 0)], else_=source.c.amount)),
+                db.func.sum(db.case([(is_credit, source.c.amount)], else_=0)),
+                db.func.count(source.c.id),
+            ]).select_from(
+                source.outerjoin(Category.__table__, Category.id == source.c.category_id)
+            ).group_by(
+                source.c.account_id,
+                db.func.date(source.c.date, 'start of month'),
+                source.c.category_id,
+                Category.category,
+            )
+        ))
+
+        return result.rowcount
+
+    def as_dict(self):
+        return {
+            'month': self.month.strftime("%Y-%m"),
+            'category': self.category or None,
+            'debits': self.debits,
+            'credits': self.credits,
+            'count': self.count,
+        }
+
+    def __repr__(self):
+        return "<TransactionSummary account_id: {}, month: {}, category: {}, " \
+               "debits: {}, credits: {}, count: {} >".format(
+            self.account_id,
+            self.month,
+            self.category,
+            self.debits,
+            self.credits,
+            self.count
+        )
@@ -0,0 +1,109 @@
+"""
+Opt-in SQL diagnostics hooked into the engine's cursor events.
+
+SLOW_QUERY_SECONDS logs every statement slower than that many seconds with
+its parameters and the route that ran it.
+
+REPEATED_QUERY_LIMIT flags requests that run the same statement shape more
+than that many times, the usual sign of a query in a loop (N+1).  This is a
+warning in the log, or a RepeatedQueryError when REPEATED_QUERY_RAISE is
+set, which the tests use to fail on such patterns.
+
+The cursor listeners are only registered while one of these is set, checked
+again at the start of every request.
+"""
+import re
+import logging
+from timeit import default_timer
+
+from flask import g, request, has_request_context
+
+from books_api import app
+from books_api.engine_events import set_listeners
+
+logger = logging.getLogger(__name__)
+
+# Longest parameter list repr written to the log
+MAX_PARAMETERS_LENGTH = 500
+
+_whitespace = re.compile(r'\s+')
+_placeholder_list = re.compile(r'\(\?(?:, \?)+\)')
+
+
+class RepeatedQueryError(Exception):
+    pass
+
+
+def statement_shape(statement):
+    """
+    Normalise a statement so different IN list lengths count as the same query.
+    """
+    return _placeholder_list.sub('(?...)', _whitespace.sub(' ', statement.strip()))
+
+
+def describe_origin():
+    if not has_request_context():
+        return "outside request"
+    route = request.url_rule.rule if request.url_rule is not None else request.path
+    return "{} {}".format(request.method, route)
+
+
+def format_parameters(parameters):
+    text = repr(parameters)
+    if len(text) > MAX_PARAMETERS_LENGTH:
+        text = text[:MAX_PARAMETERS_LENGTH] + "..."
+    return text
+
+
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('querylog_start', []).append(default_timer())
+
+
+def _drop_timer(exception_context):
+    # after_cursor_execute doesn't run for a failed statement
+    conn = exception_context.connection
+    starts = conn.info.get('querylog_start') if conn is not None else None
+    if starts:
+        starts.pop()
+
+
+def _check_statement(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('querylog_start')
+    if starts:
+        elapsed = default_timer() - starts.pop()
+        threshold = app.config.get('SLOW_QUERY_SECONDS')
+        if threshold is not None and elapsed >= threshold:
+            logger.warning("Slow query (%.3fs) from %s: %s parameters=%s",
+                           elapsed, describe_origin(), statement, format_parameters(parameters))
+
+    limit = app.config.get('REPEATED_QUERY_LIMIT')
+    if limit is None or not has_request_context():
+        return
+
+    if 'querylog_shapes' not in g:
+        g.querylog_shapes = {}
+    shape = statement_shape(statement)
+    count = g.querylog_shapes.get(shape, 0) + 1
+    g.querylog_shapes[shape] = count
+
+    # Only report once per shape and request
+    if count == limit + 1:
+        message = "{} ran the same statement more than {} times: {}".format(
+            describe_origin(), limit, shape)
+        if app.config.get('REPEATED_QUERY_RAISE'):
+            raise RepeatedQueryError(message)
+        logger.warning(message)
+
+
+def sync_listeners():
+    """
+    Register the cursor listeners the current configuration needs.
+    """
+    slow = app.config.get('SLOW_QUERY_SECONDS') is not None
+    set_listeners([('before_cursor_execute', _start_timer), ('handle_error', _drop_timer)], slow)
+    set_listeners([('after_cursor_execute', _check_statement)],
+                  slow or app.config.get('REPEATED_QUERY_LIMIT') is not None)
+
+
+app.before_request(sync_listeners)
+sync_listeners()
@@ -0,0 +1,41 @@
+"""
+Parsing of query string arguments shared by the endpoints.  Malformed
+values abort the request with 400.
+"""
+import datetime
+
+from flask import request, abort
+
+
+def parse_date(value, name):
+    """
+    :param value: Date formatted as YYYY-MM-DD
+    :param name: Parameter name, for the error message
+    :return: datetime.date, aborts with 400 if value is malformed.
+    """
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+    except (ValueError, TypeError):
+        abort(400, "{} must be formatted as YYYY-MM-DD.".format(name))
+
+
+def parse_month(value, name):
+    """
+    :param value: Month formatted as YYYY-MM
+    :param name: Parameter name, for the error message
+    :return: datetime.date of the first day, aborts with 400 if value is malformed.
+    """
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m").date()
+    except (ValueError, TypeError):
+        abort(400, "{} must be formatted as YYYY-MM.".format(name))
+
+
+def int_args(name):
+    """
+    :return: List of the integer values of a repeatable parameter
+    """
+    try:
+        return [int(v) for v in request.args.getlist(name)]
+    except ValueError:
+        abort(400, "{} must be an integer.".format(name))
@@ -0,0 +1,34 @@
+"""
+JSON encoding for large list responses.
+Uses orjson when it is installed and falls back to the standard library.
+"""
+import json
+import datetime
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+def dumps(obj):
+    """
+    :param obj: dicts, lists, strings, numbers and dates
+    :return: Compact JSON document
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default)
+
+    return json.dumps(obj, default=_default, separators=(',', ':'))
+
+
+def json_response(obj, status=200):
+    return Response(dumps(obj), status=status, mimetype='application/json')
@@ -1,29 +1,200 @@
 #!flask/bin/python
 
+import csv
+import json
 import time
+import zlib
+import base64
+import binascii
 import datetime
 
 from flask import Flask, jsonify, request, url_for, make_response, abort
+from flask import Response, stream_with_context
 
 import sqlalchemy.exc
 
 from books_api import app, db
-from .models import Category, Account, Transaction
+from .models import Category, Account, Transaction, TransactionSummary, DataVersion
 from .models import GenericBooksException, AccountException, CategoryException
+from .models import TransactionException, transaction_search, category_cache
+from .serialization import json_response
+from .group_commit import commit_write, GroupCommitTimeout
+from .cache import LRUCache
+from .request_args import parse_date, parse_month, int_args
+
+# TODO: fix formatting
+TRANSACTION_DATE_FORMAT = "%d/%m/%Y %H:%M:%S"
 
 # TODO: auth
 
+# JSON strings decode to unicode on Python 2
+text_types = (type(u''), str)
+
 
 def add_public_uri_to_account(account_dict):
     account_dict['uri'] = url_for('get_account', id=account_dict['id'])
     return account_dict
 
 
+def account_uri_template():
+    """
+    :return: Format string for account URIs, so lists don't call url_for per row.
+    """
+    return url_for('get_account', id=0).rsplit('/', 1)[0] + '/{}'
+
+
+def account_rows_as_dicts(rows):
+    uri = account_uri_template()
+    columns = Account.row_columns
+    accounts = []
+    for row in rows:
+        account = dict(zip(columns, row))
+        account['uri'] = uri.format(account['id'])
+        accounts.append(account)
+
+    return accounts
+
+
+def transaction_page(query, limit, sort='date', *extra):
+    """
+    Serialize one page of a transaction query as plain rows.
+    :param query: Transaction query limited to limit + 1 rows, the extra
+    row tells whether there is another page.
+    :param extra: Columns to select beyond row_columns, e.g. one the page
+    is sorted by.  They are used for the cursor but not returned.
+    :return: Response with transactions and the cursor of the next page
+    """
+    rows = Transaction.as_rows(query, *extra).all()
+    next_cursor = encode_cursor(rows[limit - 1], sort) if len(rows) > limit else None
+    columns = Transaction.row_columns
+
+    return json_response({
+        "transactions": [dict(zip(columns, row)) for row in Transaction.resolve_categories(rows[:limit])],
+        "next": next_cursor,
+    })
+
+
+def make_etag(*parts):
+    """
+    :param parts: Resource name and version counters
+    :return: ETag value for the resource, varying with the query string
+    """
+    query = zlib.crc32(request.query_string) & 0xffffffff
+    return "-".join(str(p) for p in parts + (query,))
+
+
+def conditional_response(etag, build):
+    """
+    Answer with 304 if the client already has etag, so unchanged resources
+    are never loaded or serialized.
+    :param etag: Current ETag, see make_etag
+    :param build: Callable returning the full response
+    :return: Response tagged with etag
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+    else:
+        response = build()
+
+    # Weak, as the body may be re-encoded (e.g. compressed) on the way out.
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    return response
+
+
+def parse_transaction(body):
+    """
+    :param body: Transaction dict from a request body
+    :return: Dict of date, description, amount, type and category,
+    with the date parsed and the amount converted to cents.
+    Raises TransactionException if a field is missing or invalid.
+    """
+    try:
+        fields = {
+            'date': body['date'],
+            'description': body['description'],
+            'amount': body['amount'],
+            'type': body['type'],
+            'category': body['category'],
+        }
+    except (KeyError, TypeError):
+        raise TransactionException("Transaction must contain date, description, amount, type, and category")
+
+    try:
+        fields['date'] = datetime.datetime.strptime(fields['date'], TRANSACTION_DATE_FORMAT)
+    except (ValueError, TypeError):
+        raise TransactionException("Date must be formatted as '{}'".format(TRANSACTION_DATE_FORMAT))
+
+    if fields['category'] is not None and not isinstance(fields['category'], text_types):
+        raise TransactionException("Category must be a string.")
+
+    fields['amount'] = Transaction.validate(**fields)
+    return fields
+
+
+def encode_cursor(transaction, sort='date'):
+    """
+    Opaque pagination cursor pointing just past transaction.
+    :param transaction: Last transaction of the current page.
+    :param sort: Column the page is sorted by.
+    :return: urlsafe string
+    """
+    value = getattr(transaction, sort)
+    if isinstance(value, datetime.date):
+        value = value.isoformat()
+    elif isinstance(value, float):
+        # repr round-trips exactly
+        value = repr(value)
+
+    key = "{}:{}:{}".format(sort, value, transaction.id)
+    return base64.urlsafe_b64encode(key.encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor, sort='date'):
+    """
+    :param cursor: Cursor returned by encode_cursor
+    :param sort: Column the page is sorted by, must match the cursor.
+    :return: (value, id) tuple, aborts with 400 if cursor is malformed.
+    """
+    try:
+        key = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii')
+        cursor_sort, value, id = key.split(':')
+        if cursor_sort != sort:
+            raise ValueError("cursor is for a different sort order")
+        if sort == 'date':
+            value = datetime.datetime.strptime(value, "%Y-%m-%d").date()
+        elif sort == 'rank':
+            value = float(value)
+        else:
+            value = int(value)
+        return value, int(id)
+    except (ValueError, TypeError, UnicodeError, binascii.Error):
+        abort(400, "Invalid cursor.")
+
+
+def get_page_limit():
+    """
+    :return: 'limit' query parameter, bounded by MAX_PAGE_SIZE.
+    """
+    try:
+        limit = int(request.args.get('limit', app.config['DEFAULT_PAGE_SIZE']))
+    except ValueError:
+        abort(400, "limit must be an integer.")
+
+    if limit < 1:
+        abort(400, "limit must be positive.")
+
+    return min(limit, app.config['MAX_PAGE_SIZE'])
+
+
 @app.route("/categories", methods=['GET'])
 def get_categories():
-    return jsonify({
-        'categories': Category.get_all_categories()
-    })
+    def build():
+        return jsonify({
+            'categories': Category.get_all_categories()
+        })
+
+    return conditional_response(make_etag('categories', DataVersion.get('categories')), build)
 
 @app.route('/categories', methods=['PUT'])
 def add_categories():
@@ -36,14 +207,16 @@ def add_categories():
             ...
         ]
     """
-    if not request.json or "categories" not in request.json:
+    if not isinstance(request.json, dict) or "categories" not in request.json:
         abort(400, "New categories must contain list of categories.")
 
     new_categories = request.json.get('categories')
-    for new_category in [c for c in new_categories if not Category.is_category(c)]:
-        db.session.add(Category(category=new_category))
+    if not isinstance(new_categories, list) or \
+            not all(isinstance(c, text_types) and c for c in new_categories):
+        abort(400, "New categories must contain list of categories.")
 
     try:
+        Category.add_categories(new_categories)
         db.session.commit()
     except sqlalchemy.exc.SQLAlchemyError as e:
         print("add_category error: {}".format(e))
@@ -59,44 +232,321 @@ def add_categories():
 def get_accounts():
     description = request.args.get('description')
 
-    if description:
-        account = Account.get_by_name(description)
-        accounts = [account.as_dict()] if account else []
-    else:
-        accounts = [acct.as_dict() for acct in Account.get_all()]
+    def build():
+        return json_response({
+            "accounts": account_rows_as_dicts(Account.get_rows(description=description or None))
+        })
 
-    return jsonify({
-       "accounts": map(add_public_uri_to_account, accounts)
-    })
+    return conditional_response(make_etag('accounts', DataVersion.get('accounts')), build)
 
 
 @app.route("/accounts/<int:id>", methods=['GET'])
 def get_account(id):
-    account = Account.get_by_id(id)
+    version = Account.get_version(id)
+    if version is None:
+        abort(404, "Account does not exist.")
 
-    if account:
+    def build():
         return jsonify({
-            "account": add_public_uri_to_account(account.as_dict())
+            "account": add_public_uri_to_account(Account.get_by_id(id).as_dict())
         })
-    else:
-        abort(404, "Account does not exist.")
+
+    return conditional_response(make_etag('account', id, version), build)
+
+
+def _totals_by(rows, key):
+    totals = {}
+    for row in rows:
+        total = totals.setdefault(row[key], {key: row[key], 'debits': 0, 'credits': 0, 'count': 0})
+        for field in ('debits', 'credits', 'count'):
+            total[field] += row[field]
+
+    return [totals[k] for k in sorted(totals, key=lambda k: (k is not None, k))]
 
 
 @app.route("/accounts/<int:id>/summary", methods=['GET'])
 def get_account_summary(id):
-    abort(404, "Not implemented.")
+    account = Account.get_by_id(id)
+    if not account:
+        abort(404, "Account does not exist.")
+
+    rows = [row.as_dict() for row in TransactionSummary.get_for_account(id)]
+
+    return jsonify({
+        "summary": {
+            "account_id": id,
+            "months": _totals_by(rows, 'month'),
+            "categories": _totals_by(rows, 'category'),
+            "rows": rows,
+        }
+    })
+
+
+@app.route("/accounts/<int:id>/balance", methods=['GET'])
+def get_account_balance(id):
+    """
+    Balance at the end of the day given by 'at' (YYYY-MM-DD), today by default.
+    """
+    version = Account.get_version(id)
+    if version is None:
+        abort(404, "Account does not exist.")
+
+    at = request.args.get('at')
+    at = parse_date(at, 'at') if at else datetime.date.today()
+
+    def build():
+        return jsonify({
+            "balance": {
+                "account_id": id,
+                "at": at.isoformat(),
+                "balance": Account.balance_at(id, at),
+            }
+        })
+
+    # 'at' defaults to today, so the resolved date and not just the query
+    # string decides the response.
+    return conditional_response(make_etag('account', id, version, 'balance', at.isoformat()), build)
+
+
+@app.route("/networth", methods=['GET'])
+def get_net_worth():
+    """
+    Combined balance at the end of each month with activity.
+    Repeat 'account_id' to only include some accounts.
+    """
+    account_ids = int_args('account_id') or None
+
+    def build():
+        return json_response({
+            "net_worth": [{"month": month.strftime("%Y-%m"), "balance": balance}
+                          for month, balance in TransactionSummary.net_worth_by_month(account_ids)]
+        })
+
+    # TransactionSummary.rebuild changes the rollup without touching accounts.
+    return conditional_response(make_etag('networth', DataVersion.get('accounts'),
+                                          DataVersion.get('summary')), build)
+
+
+# Cashflow reports by parameters and the versions of the months they cover,
+# a write only makes the reports including its month miss.
+cashflow_cache = LRUCache(app.config.get('CASHFLOW_CACHE_SIZE', 256))
+
+
+def build_cashflow(month_from, month_to, account_ids):
+    months = []
+    for month, category, debits, credits, count in TransactionSummary.cashflow(
+            month_from, month_to, account_ids):
+        month = month.strftime("%Y-%m")
+        if not months or months[-1]['month'] != month:
+            months.append({"month": month, "debits": 0, "credits": 0, "count": 0, "categories": []})
+        total = months[-1]
+        total['debits'] += debits
+        total['credits'] += credits
+        total['count'] += count
+        total['categories'].append({"category": category or None, "debits": debits,
+                                    "credits": credits, "count": count})
+
+    return {
+        "month_from": month_from.strftime("%Y-%m") if month_from else None,
+        "month_to": month_to.strftime("%Y-%m") if month_to else None,
+        "months": months,
+    }
+
+
+@app.route("/reports/cashflow", methods=['GET'])
+def get_cashflow_report():
+    """
+    Debits, credits and counts per month and category across accounts.
+    Optional 'month_from' and 'month_to' (YYYY-MM, inclusive), repeat
+    'account_id' to only include some accounts.
+    """
+    month_from, month_to = [parse_month(request.args[name], name) if name in request.args else None
+                            for name in ('month_from', 'month_to')]
+    account_ids = sorted(set(int_args('account_id'))) or None
+
+    key = (month_from, month_to, tuple(account_ids or ()),
+           TransactionSummary.month_versions(month_from, month_to))
+    report = cashflow_cache.get(key)
+    if report is None:
+        report = build_cashflow(month_from, month_to, account_ids)
+        cashflow_cache.put(key, report)
+
+    return json_response({"cashflow": report})
 
 
 @app.route("/accounts/<int:id>/transactions", methods=['GET'])
 def get_account_transactions(id):
+    version = Account.get_version(id)
+    if version is None:
+        abort(404, "Account does not exist.")
+
+    limit = get_page_limit()
+    cursor = request.args.get('next')
+    after = decode_cursor(cursor) if cursor else None
+
+    def build():
+        # Fetch one extra row to find out if there is another page.
+        return transaction_page(
+            Transaction.filter_query(account_id=id, limit=limit + 1, after=after), limit)
+
+    return conditional_response(make_etag('account', id, version, 'transactions'), build)
+
+
+class _LineBuffer(object):
+    """ File-like sink so csv.writer output can be yielded line by line. """
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def drain(self):
+        lines, self.lines = self.lines, []
+        return "".join(lines)
+
+
+def _ndjson_lines(rows):
+    columns = Transaction.row_columns
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), default=str) + "\n"
+
+
+def _csv_lines(rows):
+    buf = _LineBuffer()
+    writer = csv.writer(buf)
+    writer.writerow(Transaction.row_columns)
+    for row in rows:
+        writer.writerow(row)
+        yield buf.drain()
+
+    yield buf.drain()
+
+
+export_formats = {
+    'ndjson': (_ndjson_lines, 'application/x-ndjson'),
+    'csv': (_csv_lines, 'text/csv'),
+}
+
+
+def export_transactions(account_id, filename):
+    """
+    Stream transactions in the format given by the 'format' query parameter.
+    :param account_id: Account to export, all accounts if None.
+    :param filename: Suggested download name, without extension.
+    :return: Streaming response
+    """
+    format = request.args.get('format', 'ndjson')
+    if format not in export_formats:
+        abort(400, "format must be one of {}".format(sorted(export_formats)))
+
+    serialize, mimetype = export_formats[format]
+    rows = Transaction.iter_rows(account_id=account_id,
+                                 batch_size=app.config['EXPORT_BATCH_SIZE'])
+
+    response = Response(stream_with_context(serialize(rows)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename={}.{}'.format(filename, format)
+    return response
+
+
+@app.route("/accounts/<int:id>/transactions/export", methods=['GET'])
+def export_account_transactions(id):
     account = Account.get_by_id(id)
     if not account:
         abort(404, "Account does not exist.")
 
-    transactions = account.get_transactions()
-    return jsonify({
-        "transactions": [transaction.as_dict() for transaction in transactions]
-    })
+    return export_transactions(id, "account-{}-transactions".format(id))
+
+
+@app.route("/transactions/export", methods=['GET'])
+def export_all_transactions():
+    return export_transactions(None, "transactions")
+
+
+def transaction_filters():
+    """
+    Transaction.filters from the query parameters, all optional:
+        account_id, category - repeat to match any of several
+        type, description - exact match
+        date_from, date_to - inclusive, YYYY-MM-DD
+        amount_min, amount_max - inclusive, in cents
+    :return: dict of filters for Transaction.filter_query
+    """
+    filters = {
+        'type': request.args.get('type'),
+        'description': request.args.get('description'),
+    }
+
+    # A single value uses equality so it can lead an index.
+    for name, plural, values in (('account_id', 'account_ids', int_args('account_id')),
+                                 ('category', 'categories', request.args.getlist('category'))):
+        if len(values) == 1:
+            filters[name] = values[0]
+        elif values:
+            filters[plural] = values
+
+    for name in ('date_from', 'date_to'):
+        if name in request.args:
+            filters[name] = parse_date(request.args[name], name)
+
+    for name in ('amount_min', 'amount_max'):
+        values = int_args(name)
+        if values:
+            filters[name] = values[0]
+
+    return filters
+
+
+@app.route("/transactions", methods=['GET'])
+def get_transactions():
+    """
+    List transactions across accounts.
+    Query parameters, all optional:
+        filters - see transaction_filters
+        sort - 'date' (default) or 'amount'
+        order - 'desc' (default) or 'asc'
+        limit, next - pagination, as for account transactions
+    """
+    sort = request.args.get('sort', 'date')
+    if sort not in Transaction.sort_columns:
+        abort(400, "sort must be one of {}".format(Transaction.sort_columns))
+
+    order = request.args.get('order', 'desc')
+    if order not in ('asc', 'desc'):
+        abort(400, "order must be 'asc' or 'desc'")
+
+    filters = transaction_filters()
+
+    limit = get_page_limit()
+    cursor = request.args.get('next')
+    after = decode_cursor(cursor, sort) if cursor else None
+
+    return transaction_page(Transaction.filter_query(
+        sort=sort, descending=(order == 'desc'), after=after, limit=limit + 1, **filters
+    ), limit, sort)
+
+
+@app.route("/transactions/search", methods=['GET'])
+def search_transactions():
+    """
+    Full-text search over descriptions, best matches first.
+    Query parameters:
+        q - required, words must all match: "quoted words" match as a
+            phrase, a trailing * matches any word starting with it
+        filters - optional, see transaction_filters
+        limit, next - pagination, as for account transactions
+    """
+    filters = transaction_filters()
+
+    limit = get_page_limit()
+    cursor = request.args.get('next')
+    after = decode_cursor(cursor, 'rank') if cursor else None
+
+    try:
+        query = Transaction.search_query(request.args.get('q'), after=after, limit=limit + 1, **filters)
+    except TransactionException as e:
+        abort(400, str(e))
+
+    return transaction_page(query, limit, 'rank', transaction_search.c.rank)
 
 
 @app.route("/accounts/<int:id>/transactions", methods=['PUT'])
@@ -105,39 +555,102 @@ def add_account_transaction(id):
         abort(400, "Invalid request format.")
 
     try:
-        # TODO: fix formatting
-        format = "%d/%m/%Y %H:%M:%S"
-        date = datetime.datetime.strptime(request.json['date'], format)
-        description = request.json['description']
-        amount = request.json['amount']
-        type = request.json['type']
-        category = request.json['category']
-    except KeyError as e:
-        abort(400, "Transaction must contain date, description, amount, type, and category")
+        fields = parse_transaction(request.json)
+    except TransactionException as e:
+        abort(400, str(e))
+
+    def write():
+        new_transaction = Account.insert_transaction(id, **fields)
+        db.session.add(new_transaction)
+        return new_transaction
+
+    try:
+        transaction = commit_write(write, Transaction.as_dict)
+    except AccountException as e:
+        abort(404, str(e))
+    except (TransactionException, CategoryException) as e:
+        abort(400, str(e))
+    except GroupCommitTimeout as e:
+        abort(503, str(e))
+    except Exception as e:
+        # TODO: move to sqlalchemy specific exception
+        abort(500, "Error adding transaction: {}".format(e))
+
+
+    return jsonify({
+        'transaction': transaction
+    })
+
+@app.route("/accounts/<int:id>/transactions/batch", methods=['PUT'])
+def add_account_transactions(id):
+    """
+    Expects format:
+    {
+        "transactions": [
+            {"date": ..., "description": ..., "amount": ..., "type": ..., "category": ...},
+            ...
+        ]
+    }
+    All transactions are validated before any is written.  If one is invalid
+    nothing is inserted and the per-item results say which ones failed.
+    """
+    if not isinstance(request.json, dict) or not isinstance(request.json.get('transactions'), list):
+        abort(400, "Batch must contain list of transactions.")
+
+    items = request.json['transactions']
+    if len(items) > app.config['MAX_BATCH_SIZE']:
+        abort(400, "Batch is limited to {} transactions.".format(app.config['MAX_BATCH_SIZE']))
+
+    results = []
+    transactions = []
+    for index, item in enumerate(items):
+        try:
+            transactions.append(parse_transaction(item))
+            results.append({'index': index, 'status': 'ok'})
+        except TransactionException as e:
+            results.append({'index': index, 'status': 'error', 'message': str(e)})
+
+    # One cache lookup for the whole batch, not one per item.
+    known = category_cache.get()
+    for result in results:
+        if result['status'] != 'ok':
+            continue
+        category = items[result['index']].get('category')
+        if category is not None and category not in known:
+            result.update(status='error', message="Category '{}' does not exist.".format(category))
+
+    if any(result['status'] != 'ok' for result in results):
+        return make_response(jsonify({
+            'error': 'Bad Request',
+            'message': "Batch rejected, no transactions were added.",
+            'results': results,
+        }), 400)
 
     account = Account.get_by_id(id)
     if not account:
         abort(404, "Account does not exist.")
 
     try:
-        new_transaction = account.add_transaction(
-            date=date,
-            description=description,
-            amount=amount,
-            type=type,
-            category=category,
-        )
-        db.session.add(new_transaction)
+        count = account.add_transactions(transactions)
+        db.session.add(account)
         db.session.commit()
-    except Exception as e:
-        # TODO: move to sqlalchemy specific exception
-        abort(500, "Error adding transaction: {}".format(e))
+    except (TransactionException, CategoryException) as e:
+        db.session.rollback()
+        abort(400, str(e))
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        db.session.rollback()
+        abort(500, "Error adding transactions: {}".format(e))
 
+    for result in results:
+        result['status'] = 'created'
 
     return jsonify({
-        'transaction': new_transaction.as_dict()
+        'count': count,
+        'balance': account.balance,
+        'results': results,
     })
 
+
 @app.route("/accounts", methods=['PUT'])
 def add_account():
     if not request.json:
@@ -186,3 +699,8 @@ def not_found(error):
 def not_found(error):
     return make_response(jsonify({'error': 'An internal error occurred.',
                                   'message': error.description}), 500)
+
+@app.errorhandler(503)
+def unavailable(error):
+    return make_response(jsonify({'error': 'Service unavailable, retry later.',
+                                  'message': error.description}), 503)
@@ -1,9 +1,21 @@
 #!/usr/bin/python
 
+import os
+import re
 import sys
+import csv
+import time
+import hashlib
 import requests
 import json
+import argparse
 import datetime
+import threading
+from decimal import Decimal, InvalidOperation
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from requests.adapters import HTTPAdapter
 
 base_url = "http://localhost:5000"
 
@@ -18,6 +30,63 @@ class BooksAPIException(Exception):
 
 
 
+class ResponseCache(object):
+    """
+    Bounded LRU of GET responses with their validators (ETag and
+    Last-Modified), used by Book to revalidate instead of refetching.
+    """
+    def __init__(self, size, max_age=0):
+        """
+        :param size: Maximum number of responses kept
+        :param max_age: Seconds a response is used without revalidating
+        """
+        self.size = size
+        self.max_age = max_age
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: dict with etag, last_modified, content and stored_at, or None
+        """
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is not None:
+                self.__entries[key] = entry
+            return entry
+
+    def put(self, key, etag, last_modified, content):
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = {
+                'etag': etag,
+                'last_modified': last_modified,
+                'content': content,
+                'stored_at': time.time(),
+            }
+            while len(self.__entries) > self.size:
+                self.__entries.popitem(last=False)
+
+    def touch(self, key):
+        with self.__lock:
+            if key in self.__entries:
+                self.__entries[key]['stored_at'] = time.time()
+
+    def is_fresh(self, entry):
+        return time.time() - entry['stored_at'] < self.max_age
+
+    def invalidate(self, url, subtree=False):
+        """
+        Drop responses for url with any query string, and everything
+        below it if subtree is set.
+        """
+        with self.__lock:
+            for key in list(self.__entries):
+                if (key == url or key.startswith(url + '?')
+                        or (subtree and key.startswith(url + '/'))):
+                    del self.__entries[key]
+
+
 class Book(object):
     """ Actions:
         - connect to specific book
@@ -27,8 +96,95 @@ class Book(object):
         - remove an account
         - get transaction summary
     """
-    def __init__(self, endpoint):
+    def __init__(self, endpoint, pool_size=10, timeout=30, workers=4,
+                 cache_size=0, cache_max_age=0):
+        """
+        :param endpoint: Base url of the books api
+        :param pool_size: Keep-alive connections kept open to the server
+        :param timeout: Seconds to wait for the server on each request
+        :param workers: Threads used by the batch helpers
+        :param cache_size: Responses kept for revalidation, 0 disables the cache
+        :param cache_max_age: Seconds a cached response is used without
+        asking the server
+        """
         self.endpoint = endpoint
+        self.timeout = timeout
+        self.workers = workers
+        self.cache = ResponseCache(cache_size, cache_max_age) if cache_size else None
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.__pool = None
+
+    def close(self):
+        """
+        Release pooled connections and worker threads.
+        """
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __get(self, url, **kwargs):
+        return self.session.get(url, timeout=self.timeout, **kwargs)
+
+    def __put(self, url, **kwargs):
+        return self.session.put(url, timeout=self.timeout, **kwargs)
+
+    def __get_json(self, url, params=None):
+        """
+        GET url, revalidating a cached copy if there is one.
+        :return: (status code, decoded json body)
+        """
+        if self.cache is None:
+            r = self.__get(url, params=params)
+            return r.status_code, r.json()
+
+        key = requests.Request('GET', url, params=params).prepare().url
+        entry = self.cache.get(key)
+        headers = {}
+        if entry is not None:
+            if self.cache.is_fresh(entry):
+                return 200, json.loads(entry['content'])
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        r = self.__get(url, params=params, headers=headers)
+        if r.status_code == 304 and entry is not None:
+            self.cache.touch(key)
+            return 200, json.loads(entry['content'])
+
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+        if r.status_code == 200 and (etag or last_modified):
+            self.cache.put(key, etag, last_modified, r.text)
+
+        return r.status_code, r.json()
+
+    def __invalidate(self, uri, subtree=False):
+        if self.cache is not None:
+            self.cache.invalidate(self.__url(uri), subtree)
+
+    def __map(self, func, items):
+        """
+        Run func over items on the worker threads, results in order.
+        Raises the first exception hit by any call.
+        """
+        if self.__pool is None:
+            self.__pool = ThreadPool(self.workers)
+        return self.__pool.map(func, items)
 
     def __url(self, *args):
         """
@@ -39,12 +195,11 @@ class Book(object):
         return self.endpoint + "/".join(args)
 
     def get_accounts(self):
-        r = requests.get(self.__url('/accounts'))
-        resp = r.json()
+        status_code, resp = self.__get_json(self.__url('/accounts'))
 
-        if r.status_code != 200:
+        if status_code != 200:
             raise BooksAPIException("Failure [{}]: {}".format(
-                r.status_code, resp
+                status_code, resp
             ))
 
         # TODO: what if 'accounts' not in resp?
@@ -58,7 +213,8 @@ class Book(object):
             "balance": initial_balance,
         }
 
-        r = requests.put(self.__url("/accounts"), json=new_account)
+        r = self.__put(self.__url("/accounts"), json=new_account)
+        self.__invalidate('/accounts')
 
         if r.status_code != 200:
             raise BooksAPIException("Failed to add account {} [{}]: {}".format(
@@ -100,7 +256,8 @@ class Book(object):
 
 
         uri = self.__url(account['uri'], 'transactions')
-        r = requests.put(uri, json=request_body)
+        r = self.__put(uri, json=request_body)
+        self.__invalidate_account(account)
         if r.status_code != 200:
             raise BooksAPIException("Failed to transaction '{}' to account {} [{}]: {}".format(
                 request_body['description'], account['description'], r.status_code, r.json())
@@ -108,32 +265,354 @@ class Book(object):
 
         return r.json()['transaction']
 
-    def get_transactions_for_account(self, account):
+    def get_transactions_for_account(self, account, page_size=None):
+        """
+        Fetch all transactions for account, following pagination cursors.
+        :param account: account dict returned from get_accounts
+        :param page_size: transactions per request, server default if None
+        :return: list of transaction dicts, newest first
+        """
         uri = self.__url(account['uri'], 'transactions')
-        r = requests.get(uri)
+        params = {}
+        if page_size:
+            params['limit'] = page_size
+
+        transactions = []
+        while True:
+            status_code, resp = self.__get_json(uri, params=params)
+            if status_code != 200:
+                raise BooksAPIException("Failed to get transactions for account {} [{}]: {}".format(
+                    account['description'], status_code, resp)
+                )
+
+            transactions.extend(resp['transactions'])
+
+            if not resp.get('next'):
+                return transactions
+
+            params['next'] = resp['next']
+
+
+
+    def get_transactions_for_accounts(self, accounts, page_size=None):
+        """
+        Fetch transactions for many accounts concurrently.
+        :param accounts: list of account dicts returned from get_accounts
+        :return: dict of account id to list of transaction dicts
+        """
+        transactions = self.__map(
+            lambda account: self.get_transactions_for_account(account, page_size), accounts)
+        return dict(zip([a['id'] for a in accounts], transactions))
+
+    def add_transactions_to_account(self, account, transactions, batch_size=500):
+        """
+        Add many transactions through the batch endpoint, sending batches
+        concurrently.  Each batch is all or nothing on the server.
+        :param account: account dict returned from get_accounts
+        :param transactions: list of transaction dicts, see add_transaction_to_account
+        :param batch_size: transactions per request
+        :return: Number of transactions added
+            Throws BooksAPIException if any batch is rejected
+        """
+        batches = [transactions[i:i + batch_size] for i in range(0, len(transactions), batch_size)]
+
+        return sum(self.__map(lambda batch: self.add_transaction_batch(account, batch), batches))
+
+    def add_transaction_batch(self, account, transactions):
+        """
+        Add transactions in one request to the batch endpoint.
+        The server adds all of them or none.
+        :return: Number of transactions added
+            Throws BooksAPIException if the batch is rejected
+        """
+        uri = self.__url(account['uri'], 'transactions', 'batch')
+        r = self.__put(uri, json={"transactions": transactions})
+        self.__invalidate_account(account)
+
         if r.status_code != 200:
-            raise BooksAPIException("Failed to get transactions for account {} [{}]: {}".format(
+            raise BooksAPIException("Failed to add batch to account {} [{}]: {}".format(
                 account['description'], r.status_code, r.json())
             )
 
-        resp = r.json()
-
-        return resp['transactions']
-
+        return r.json()['count']
 
+    def __invalidate_account(self, account):
+        # Balances show up in the account list as well as the account itself.
+        self.__invalidate('/accounts')
+        self.__invalidate(account['uri'], subtree=True)
 
     def get_categories(self):
-        r = requests.get(self.__url('/categories'))
-        resp = r.json()
+        status_code, resp = self.__get_json(self.__url('/categories'))
 
-        if r.status_code != 200:
+        if status_code != 200:
             raise BooksAPIException("Failure [{}]: {}".format(
-                r.status_code, resp
+                status_code, resp
             ))
 
 
         return resp['categories']
 
+    def add_categories(self, categories):
+        """
+        Create categories, ones that already exist are left alone.
+        :param categories: list of category descriptions
+            Throws BooksAPIException on error
+        """
+        r = self.__put(self.__url('/categories'), json={"categories": list(categories)})
+        self.__invalidate('/categories')
+
+        if r.status_code != 200:
+            raise BooksAPIException("Failed to add categories [{}]: {}".format(
+                r.status_code, r.json())
+            )
+
+
+
+# Date format expected by the transaction endpoints
+api_date_format = "%d/%m/%Y %H:%M:%S"
+
+
+def amount_to_cents(amount):
+    """
+    :param amount: Decimal string such as '-12.34' or '1,000.00'
+    :return: (cents, type), negative amounts are debits.
+    """
+    try:
+        cents = int(Decimal(amount.replace(',', '').strip()) * 100)
+    except InvalidOperation:
+        raise BooksAPIException("Invalid amount '{}'".format(amount))
+
+    return abs(cents), "debit" if cents < 0 else "credit"
+
+
+def read_csv_statement(lines, date_column, description_column, amount_column,
+                       date_format, category_column=None, default_category="none"):
+    """
+    Read transactions from a CSV statement with a header row.
+    :param lines: Open file or other iterable of lines
+    :param date_format: strptime format of the date column
+    :return: Iterator of transaction dicts ready for the batch endpoint
+    """
+    for row in csv.DictReader(lines):
+        try:
+            date = datetime.datetime.strptime(row[date_column].strip(), date_format)
+            cents, type = amount_to_cents(row[amount_column])
+        except (KeyError, ValueError) as e:
+            raise BooksAPIException("Bad statement row {}: {}".format(row, e))
+
+        category = row.get(category_column) if category_column else None
+        yield {
+            "date": date.strftime(api_date_format),
+            "description": row[description_column].strip()[:64],
+            "amount": cents,
+            "type": type,
+            "category": category or default_category,
+        }
+
+
+ofx_tag = re.compile(r"<(/?)(\w+)>([^<\r\n]*)")
+
+
+def read_ofx_statement(lines, default_category="none"):
+    """
+    Read <STMTTRN> entries from an OFX (SGML or XML) statement.  Tags are
+    read as one stream, so transactions may share a line or span several.
+    :param lines: Open file or other iterable of lines
+    :return: Iterator of transaction dicts ready for the batch endpoint
+    """
+    fields = None
+    for line in lines:
+        for closing, tag, value in ofx_tag.findall(line):
+            tag = tag.upper()
+            if tag != "STMTTRN":
+                if fields is not None and not closing:
+                    fields[tag] = value.strip()
+                continue
+
+            if not closing:
+                fields = {}
+                continue
+
+            if fields is None:
+                continue
+            try:
+                date = datetime.datetime.strptime(fields["DTPOSTED"][:8], "%Y%m%d")
+                cents, type = amount_to_cents(fields["TRNAMT"])
+            except (KeyError, ValueError) as e:
+                raise BooksAPIException("Bad OFX transaction {}: {}".format(fields, e))
+
+            yield {
+                "date": date.strftime(api_date_format),
+                "description": (fields.get("NAME") or fields.get("MEMO") or "unknown")[:64],
+                "amount": cents,
+                "type": type,
+                "category": default_category,
+            }
+            fields = None
+
+
+def chunked(items, size):
+    """
+    Group an iterator into lists of size items, without reading ahead
+    further than one chunk.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def statement_fingerprint(path):
+    """
+    :return: SHA-1 of the file's content, identifies one statement
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ImportState(object):
+    """
+    Chunks of a statement that were already uploaded, saved after every
+    round so an interrupted import can resume without duplicates.
+    State saved for different content (fingerprint) is ignored, and the
+    file is removed once the import is complete.
+    """
+    def __init__(self, path, chunk_size, fingerprint=None):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.fingerprint = fingerprint
+        self.done = set()
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state.get('fingerprint') != fingerprint:
+                return
+            if state['chunk_size'] != chunk_size:
+                raise BooksAPIException("{} was written with chunk size {}, resume with the same size".format(
+                    path, state['chunk_size']))
+            self.done = set(state['done'])
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({'chunk_size': self.chunk_size, 'fingerprint': self.fingerprint,
+                       'done': sorted(self.done)}, f)
+        os.rename(tmp_path, self.path)
+
+    def finish(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def import_statement(book, account, transactions, chunk_size=500, connections=4,
+                     state_path=None, progress=sys.stderr, fingerprint=None,
+                     create_categories=False):
+    """
+    Upload transactions to account in chunks over several connections.
+    Categories the statement uses must exist, the server rejects unknown
+    ones.  They are checked before each round of chunks is sent, so an
+    import stopped by one keeps what was uploaded before it and resumes.
+    :param book: Book to upload through
+    :param transactions: Iterator of transaction dicts, e.g. read_csv_statement
+    :param chunk_size: Transactions per batch request
+    :param connections: Batches uploaded at the same time
+    :param state_path: File recording finished chunks, for resuming.
+    Removed once every chunk is uploaded.
+    :param progress: Stream for progress output, None for silence
+    :param fingerprint: Identifies the statement's content, state saved for
+    another fingerprint is not resumed, see statement_fingerprint
+    :param create_categories: Create the unknown categories instead of
+    stopping at them
+    :return: Number of transactions uploaded by this run
+        Throws BooksAPIException for unknown categories
+    """
+    state = ImportState(state_path, chunk_size, fingerprint)
+    categories = set(book.get_categories())
+    pool = ThreadPool(connections)
+    start = time.time()
+    added = 0
+
+    try:
+        pending = ((i, chunk) for i, chunk in enumerate(chunked(transactions, chunk_size))
+                   if i not in state.done)
+        for window in chunked(pending, connections):
+            # The batch endpoint rejects a whole chunk for an unknown category.
+            unknown = set(t['category'] for _, chunk in window for t in chunk) - categories
+            if unknown and not create_categories:
+                raise BooksAPIException("Unknown categories: {}. Add them first or use "
+                                        "--create-categories".format(", ".join(sorted(unknown))))
+            if unknown:
+                book.add_categories(sorted(unknown))
+                categories.update(unknown)
+
+            uploads = [(index, pool.apply_async(book.add_transaction_batch, (account, chunk)))
+                       for index, chunk in window]
+
+            # Record every chunk that made it, even if another one failed.
+            errors = []
+            for index, upload in uploads:
+                try:
+                    added += upload.get()
+                    state.done.add(index)
+                except Exception as e:
+                    errors.append(e)
+            state.save()
+
+            if errors:
+                raise errors[0]
+
+            if progress is not None:
+                elapsed = max(time.time() - start, 1e-6)
+                progress.write("\r{} transactions, {:.0f}/s".format(added, added / elapsed))
+                progress.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    state.finish()
+    if progress is not None:
+        progress.write("\n")
+
+    return added
+
+
+def find_account(book, name):
+    for account in book.get_accounts():
+        if name in (str(account['id']), account['description']):
+            return account
+    raise BooksAPIException("No account '{}'".format(name))
+
+
+def import_command(args):
+    book = Book(args.url, pool_size=args.connections, workers=args.connections)
+    account = find_account(book, args.account)
+
+    with open(args.statement) as f:
+        if args.format == "ofx":
+            transactions = read_ofx_statement(f, args.default_category)
+        else:
+            transactions = read_csv_statement(
+                f, args.date_column, args.description_column, args.amount_column,
+                args.date_format, args.category_column, args.default_category)
+
+        state_path = args.state or args.statement + ".import-state"
+        added = import_statement(book, account, transactions, args.chunk_size,
+                                 args.connections, state_path,
+                                 fingerprint=statement_fingerprint(args.statement),
+                                 create_categories=args.create_categories)
+
+    print("Imported {} transactions into {}".format(added, account['description']))
+    book.close()
 
 
 def get_accounts():
@@ -171,8 +650,40 @@ def add_categories(categories):
     return r.status_code, r.json()
 
 
-def main():
-    books_api = Book(base_url)
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Books api client")
+    parser.add_argument("--url", default=base_url, help="Books api base url")
+    commands = parser.add_subparsers(dest="command")
+
+    commands.add_parser("demo", help="List accounts and add a sample transaction")
+
+    statement = commands.add_parser("import", help="Upload a bank statement")
+    statement.add_argument("account", help="Account id or description")
+    statement.add_argument("statement", help="CSV or OFX file")
+    statement.add_argument("--format", choices=["csv", "ofx"], default="csv")
+    statement.add_argument("--date-column", default="Date")
+    statement.add_argument("--date-format", default="%m/%d/%Y")
+    statement.add_argument("--description-column", default="Description")
+    statement.add_argument("--amount-column", default="Amount",
+                           help="Signed amount, negative for debits")
+    statement.add_argument("--category-column")
+    statement.add_argument("--default-category", default="none")
+    statement.add_argument("--chunk-size", type=int, default=500)
+    statement.add_argument("--connections", type=int, default=4)
+    statement.add_argument("--state", help="Resume file, defaults to <statement>.import-state")
+    statement.add_argument("--create-categories", action="store_true",
+                           help="Create categories the statement uses that don't exist")
+
+    return parser.parse_args(argv or ["demo"])
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.command == "import":
+        import_command(args)
+        sys.exit(0)
+
+    books_api = Book(args.url)
     print "\n".join([str(a) for a in books_api.get_accounts()])
     print books_api.get_categories()
 
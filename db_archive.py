@@ -0,0 +1,17 @@
+#!flask/bin/python
+"""
+Move transactions dated before a cutoff into the archive database
+(ARCHIVE_DATABASE in public_config.py).
+
+    db_archive.py 2015-01-01
+"""
+import sys
+import datetime
+
+from books_api.archive import archive_before
+
+if len(sys.argv) != 2:
+    sys.exit(__doc__)
+
+cutoff = datetime.datetime.strptime(sys.argv[1], "%Y-%m-%d").date()
+print('Archived {} transactions before {}'.format(archive_before(cutoff), cutoff))
@@ -0,0 +1,12 @@
+#!flask/bin/python
+"""
+Backfill the transaction_summary rollup table from existing transactions.
+Safe to re-run, the table is recomputed from scratch.
+"""
+from books_api import db
+from books_api.models import TransactionSummary
+
+db.create_all()
+rows = TransactionSummary.rebuild()
+db.session.commit()
+print('Rebuilt transaction summary: {} rows'.format(rows))
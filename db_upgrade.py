@@ -0,0 +1,10 @@
+#!flask/bin/python
+"""
+Bring an existing database up to date with the current models.
+Safe to re-run, every step checks the schema before changing it.
+"""
+from books_api import db
+from books_api.migrations import upgrade
+
+for description, result in upgrade(db.engine):
+    print('{}: {}'.format(description, result))
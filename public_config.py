@@ -16,6 +16,65 @@ DEFAULT_CATEGORIES = [
     "gas",
 ]
 
+# Transaction listings are paginated, see GET /accounts/<id>/transactions
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Largest batch accepted by PUT /accounts/<id>/transactions/batch
+MAX_BATCH_SIZE = 5000
+
+# Rows fetched per round trip when streaming exports
+EXPORT_BATCH_SIZE = 1000
+
+# Seconds to trust the in-process category cache before checking
+# data_version again, 0 checks on every read.
+CATEGORY_CACHE_CHECK_INTERVAL = 0
+
+# Cached /reports/cashflow results kept per process
+CASHFLOW_CACHE_SIZE = 256
+
+# Response compression, negotiated with Accept-Encoding.
+# Brotli is only offered if the brotli package is installed.
+COMPRESSION_ENABLED = True
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_LEVEL = 6
+COMPRESSION_BROTLI_QUALITY = 4
+COMPRESSION_MIMETYPES = [
+    'application/json',
+    'application/x-ndjson',
+    'text/csv',
+]
+
+# Per-route latency, status and SQL metrics served on GET /metrics
+METRICS_ENABLED = True
+
+# Opt-in SQL diagnostics, see books_api/querylog.py. None disables.
+# Log statements slower than this many seconds
+SLOW_QUERY_SECONDS = None
+# Flag requests running one statement shape more than this many times,
+# raising instead of logging when REPEATED_QUERY_RAISE is set.
+REPEATED_QUERY_LIMIT = None
+REPEATED_QUERY_RAISE = False
+
+# Commit single transaction writes from concurrent requests together in
+# one database transaction, see books_api/group_commit.py.
+GROUP_COMMIT_ENABLED = False
+GROUP_COMMIT_MAX_ITEMS = 100
+# Seconds the writer waits for more writes before committing a group
+GROUP_COMMIT_MAX_DELAY = 0.002
+# Seconds a request waits for its write to be committed
+GROUP_COMMIT_TIMEOUT = 30
+
+# SQLite file holding transactions moved out by db_archive.py, attached
+# read-only and queried only when a date range reaches before the cutoff.
+ARCHIVE_DATABASE = os.path.join(basedir, 'books_archive.db')
+
+# Memory-mapped columnar copy of all transactions behind GET /analytics,
+# see books_api/analytics.py.  Needs numpy, None disables.
+ANALYTICS_SNAPSHOT_DIR = os.path.join(basedir, 'analytics_snapshot')
+# Longest date range GET /analytics?window= answers with daily totals
+ANALYTICS_MAX_DAYS = 3660
+
 # TODO: get this working
 APPLICATION_ROOT = "/books/api/v0.1"
 
@@ -1,14 +1,892 @@
 #!flask/env/python
 
+import io
 import os
+import gzip
+import json
+import time
+import shutil
+import logging
 import datetime
+import threading
+import tempfile
 import unittest
 
-import boots_api_client
+import sqlalchemy.exc
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from books_api import app, db
+from books_api import compression, metrics, querylog, views
+from books_api.analytics import snapshot
+from books_api.metrics import registry
+from books_api.views import cashflow_cache
+from books_api.models import Category, Account, Transaction, AccountException, TransactionSummary
+from books_api.group_commit import GroupCommitWriter, PendingWrite, GroupCommitTimeout
+from books_api.querylog import RepeatedQueryError, statement_shape
+from public_config import basedir
+
 
 class APITest(unittest.TestCase):
     def setUp(self):
-        print "Setting up"
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'test.db')
+        # Fail any request that runs a query in a loop
+        app.config['REPEATED_QUERY_LIMIT'] = 10
+        app.config['REPEATED_QUERY_RAISE'] = True
+
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        app.config['REPEATED_QUERY_LIMIT'] = None
+        db.session.remove()
+        db.drop_all()
+
+    def get_json(self, uri, **kwargs):
+        r = self.app.get(uri, **kwargs)
+        return r.status_code, json.loads(r.data.decode('utf-8'))
+
+    def put_json(self, uri, body):
+        r = self.app.put(uri, data=json.dumps(body), content_type='application/json')
+        return r.status_code, json.loads(r.data.decode('utf-8'))
+
+    def add_account(self, description, type="checking", transactions=()):
+        account = Account(description=description, type=type)
+        db.session.add(account)
+        Category.add_categories(sorted(set(tx[4] for tx in transactions if tx[4] is not None)))
+        db.session.commit()
+
+        for tx in transactions:
+            db.session.add(account.add_transaction(*tx))
+        db.session.add(account)
+        db.session.commit()
+
+        return account
+
+
+class CategoriesAPITest(APITest):
+    def test_add_overlapping_categories(self):
+        code, resp = self.put_json('/categories', {"categories": ["gas", "rent"]})
+        assert code == 200, resp
+
+        code, resp = self.put_json('/categories', {"categories": ["rent", "dining", "dining"]})
+        assert code == 200, resp
+
+        code, resp = self.get_json('/categories')
+        assert sorted(resp['categories']) == ["dining", "gas", "rent"], resp
+
+    def test_conditional_get(self):
+        self.put_json('/categories', {"categories": ["gas"]})
+        etag = self.app.get('/categories').headers['ETag']
+
+        r = self.app.get('/categories', headers={'If-None-Match': etag})
+        assert r.status_code == 304
+
+        self.put_json('/categories', {"categories": ["rent"]})
+        r = self.app.get('/categories', headers={'If-None-Match': etag})
+        assert r.status_code == 200 and r.headers['ETag'] != etag
+
+    def test_invalid_categories(self):
+        code, resp = self.put_json('/categories', {"categories": "gas"})
+        assert code == 400, resp
+
+        for categories in ([{"a": 1}], ["gas", 1], ["gas", ""], [["gas"]]):
+            code, resp = self.put_json('/categories', {"categories": categories})
+            assert code == 400, (categories, resp)
+
+        code, resp = self.put_json('/categories', ["categories"])
+        assert code == 400, resp
+
+
+class AccountsAPITest(APITest):
+    def test_list_matches_single_account(self):
+        self.add_account("Account1", transactions=[
+            (datetime.date(2016, 1, 1), "place #1", 100, "debit", "gas"),
+        ])
+        self.add_account("Account2", type="savings")
+
+        code, resp = self.get_json('/accounts')
+        assert code == 200, resp
+        assert [a['description'] for a in resp['accounts']] == ["Account1", "Account2"], resp
+
+        for account in resp['accounts']:
+            code, single = self.get_json('/accounts/{}'.format(account['id']))
+            assert code == 200 and single['account'] == account, (account, single)
+
+        code, resp = self.get_json('/accounts', query_string={'description': 'Account2'})
+        assert [a['type'] for a in resp['accounts']] == ["savings"], resp
+
+
+class AccountTransactionsAPITest(APITest):
+    def test_pagination(self):
+        transactions = [
+            (datetime.date(2016, 1, 1 + i % 5), "place #{}".format(i), 10 + i, "debit", "gas")
+            for i in range(12)
+        ]
+        account = self.add_account("Account1", transactions=transactions)
+        uri = '/accounts/{}/transactions'.format(account.id)
+
+        seen = []
+        query = {'limit': 5}
+        while True:
+            code, resp = self.get_json(uri, query_string=query)
+            assert code == 200, resp
+            assert len(resp['transactions']) <= 5
+            seen.extend(resp['transactions'])
+            if not resp['next']:
+                break
+            query['next'] = resp['next']
+
+        keys = [(t['date'], t['id']) for t in seen]
+        assert len(seen) == len(transactions), "Pages dropped or repeated transactions"
+        assert keys == sorted(keys, reverse=True), "Pages not ordered by (date, id)"
+
+    def test_conditional_get(self):
+        account = self.add_account("Account1", transactions=[
+            (datetime.date(2016, 1, 1), "place #1", 100, "debit", "gas"),
+        ])
+
+        for uri in ('/accounts', '/accounts/{}'.format(account.id),
+                    '/accounts/{}/transactions'.format(account.id)):
+            r = self.app.get(uri)
+            etag = r.headers['ETag']
+            assert r.status_code == 200 and etag, uri
+
+            r = self.app.get(uri, headers={'If-None-Match': etag})
+            assert r.status_code == 304 and not r.data, "{} not cached".format(uri)
+
+            code, resp = self.put_json('/accounts/{}/transactions'.format(account.id), {
+                "date": "02/01/2016 10:00:00", "description": "place #2",
+                "amount": 5, "type": "debit", "category": "gas"})
+            assert code == 200, resp
+
+            r = self.app.get(uri, headers={'If-None-Match': etag})
+            assert r.status_code == 200 and r.headers['ETag'] != etag, "{} stale after write".format(uri)
+
+    def test_added_transaction_date(self):
+        account = self.add_account("Account1", transactions=[
+            (datetime.date(2016, 1, 1), "place #1", 100, "debit", "gas"),
+        ]).id
+        for group_commit in (False, True):
+            app.config['GROUP_COMMIT_ENABLED'] = group_commit
+            try:
+                code, resp = self.put_json('/accounts/{}/transactions'.format(account), {
+                    "date": "02/01/2016 10:00:00", "description": "place #2",
+                    "amount": 5, "type": "debit", "category": "gas"})
+            finally:
+                app.config['GROUP_COMMIT_ENABLED'] = False
+            assert code == 200 and resp['transaction']['date'] == "2016-01-02", resp
+
+    def test_invalid_cursor(self):
+        account = self.add_account("Account1")
+        code, resp = self.get_json('/accounts/{}/transactions'.format(account.id),
+                                   query_string={'next': 'garbage'})
+        assert code == 400, resp
+
+    def test_summary(self):
+        account = self.add_account("Account1", transactions=[
+            (datetime.date(2016, 1, 1), "place #1", 100, "debit", "gas"),
+            (datetime.date(2016, 1, 9), "place #2", 500, "credit", "paycheck"),
+            (datetime.date(2016, 2, 3), "place #3", 20, "debit", "gas"),
+        ])
+
+        code, resp = self.get_json('/accounts/{}/summary'.format(account.id))
+        assert code == 200, resp
+        summary = resp['summary']
+        assert summary['months'] == [
+            {'month': '2016-01', 'debits': 100, 'credits': 500, 'count': 2},
+            {'month': '2016-02', 'debits': 20, 'credits': 0, 'count': 1},
+        ], summary['months']
+        assert summary['categories'] == [
+            {'category': 'gas', 'debits': 120, 'credits': 0, 'count': 2},
+            {'category': 'paycheck', 'debits': 0, 'credits': 500, 'count': 1},
+        ], summary['categories']
+
+        code, resp = self.get_json('/accounts/1000/summary')
+        assert code == 404
+
+
+class TransactionsAPITest(APITest):
+    def setUp(self):
+        super(TransactionsAPITest, self).setUp()
+        self.account1 = self.add_account("Account1", transactions=[
+            (datetime.date(2016, 1, 1 + i), "place #{}".format(i), 10 * i, "debit",
+             "gas" if i % 2 else "dining")
+            for i in range(10)
+        ]).id
+        self.account2 = self.add_account("Account2", transactions=[
+            (datetime.date(2016, 2, 1), "paycheck", 1000, "credit", "paycheck"),
+        ]).id
+
+    def test_filters(self):
+        code, resp = self.get_json('/transactions', query_string={
+            'date_from': '2016-01-03', 'date_to': '2016-01-08', 'category': 'gas', 'amount_min': 40,
+        })
+        assert code == 200, resp
+        assert [t['description'] for t in resp['transactions']] == ["place #7", "place #5"], resp
+
+        code, resp = self.get_json('/transactions', query_string=[
+            ('account_id', self.account2), ('account_id', 1000)])
+        assert [t['description'] for t in resp['transactions']] == ["paycheck"], resp
+
+    def test_sort_by_amount_pages(self):
+        query = {'sort': 'amount', 'order': 'asc', 'limit': 4}
+        amounts = []
+        while True:
+            code, resp = self.get_json('/transactions', query_string=query)
+            assert code == 200, resp
+            amounts.extend(t['amount'] for t in resp['transactions'])
+            if not resp['next']:
+                break
+            query['next'] = resp['next']
+
+        assert amounts == sorted(amounts) and len(amounts) == 11, amounts
+
+    def test_bad_parameters(self):
+        for query in ({'sort': 'description'}, {'date_from': '01/01/2016'}, {'amount_min': 'x'}):
+            code, resp = self.get_json('/transactions', query_string=query)
+            assert code == 400, (query, resp)
+
+
+class BatchTransactionsAPITest(APITest):
+    def setUp(self):
+        super(BatchTransactionsAPITest, self).setUp()
+        db.session.add(Category(category="gas"))
+        db.session.commit()
+
+    @staticmethod
+    def transaction(amount, type="debit", category="gas", date="01/02/2016 10:00:00"):
+        return {
+            "date": date,
+            "description": "place",
+            "amount": amount,
+            "type": type,
+            "category": category,
+        }
+
+    def test_batch_add(self):
+        account = self.add_account("Account1")
+        batch = [self.transaction(100), self.transaction(30, type="credit"), self.transaction(5)]
+
+        code, resp = self.put_json('/accounts/{}/transactions/batch'.format(account.id),
+                                   {"transactions": batch})
+        assert code == 200, resp
+        assert resp['count'] == 3 and resp['balance'] == -100 + 30 - 5, resp
+        assert [r['status'] for r in resp['results']] == ['created'] * 3
+
+        account = Account.get_by_id(account.id)
+        assert account.balance == -75 and len(account.get_transactions()) == 3
+
+    def test_single_add_rejects_unknown_category(self):
+        account_id = self.add_account("Account1").id
+        code, resp = self.put_json('/accounts/{}/transactions'.format(account_id),
+                                   self.transaction(100, category="gsa"))
+        assert code == 400, resp
+        assert resp['message'] == "Category 'gsa' does not exist.", resp
+
+        code, resp = self.get_json('/categories')
+        assert "gsa" not in resp['categories'], resp
+        assert Account.get_by_id(account_id).balance == 0
+
+    def test_large_batch_checks_categories_once(self):
+        # More items than REPEATED_QUERY_LIMIT, a lookup per item would raise.
+        account = self.add_account("Account1")
+        batch = [self.transaction(i) for i in range(1, 31)]
+
+        code, resp = self.put_json('/accounts/{}/transactions/batch'.format(account.id),
+                                   {"transactions": batch})
+        assert code == 200, resp
+        assert resp['count'] == 30, resp
+
+    def test_batch_rejected_as_a_whole(self):
+        account = self.add_account("Account1")
+        batch = [
+            self.transaction(100),
+            self.transaction("ten"),
+            self.transaction(5, category="unknown"),
+            self.transaction(5, date="2016-01-01"),
+        ]
+
+        code, resp = self.put_json('/accounts/{}/transactions/batch'.format(account.id),
+                                   {"transactions": batch})
+        assert code == 400, resp
+        assert [r['status'] for r in resp['results']] == ['ok', 'error', 'error', 'error'], resp
+
+        account = Account.get_by_id(account.id)
+        assert account.balance == 0 and not account.get_transactions(), "Rejected batch was written"
+
+
+    def test_malformed_batch(self):
+        uri = '/accounts/{}/transactions/batch'.format(self.add_account("Account1").id)
+        for body in ([self.transaction(100)], "transactions", {"transactions": {}}):
+            code, resp = self.put_json(uri, body)
+            assert code == 400, (body, resp)
+
+        code, resp = self.put_json(uri, {"transactions": ["place", self.transaction(5, category=["gas"])]})
+        assert code == 400, resp
+        assert [r['status'] for r in resp['results']] == ['error', 'error'], resp
+
+
+class ExportAPITest(APITest):
+    def setUp(self):
+        super(ExportAPITest, self).setUp()
+        self.account1 = self.add_account("Account1", transactions=[
+            (datetime.date(2016, 1, 2), "place #1", 100, "debit", "gas"),
+            (datetime.date(2016, 1, 1), "place #2", 50, "credit", "paycheck"),
+        ]).id
+        self.add_account("Account2", transactions=[
+            (datetime.date(2016, 1, 3), "place #3", 25, "debit", "gas"),
+        ])
+
+    def test_ndjson_export(self):
+        r = self.app.get('/accounts/{}/transactions/export'.format(self.account1), buffered=True)
+        assert r.status_code == 200 and r.mimetype == 'application/x-ndjson'
+
+        rows = [json.loads(line) for line in r.data.decode('utf-8').splitlines()]
+        assert [row['description'] for row in rows] == ["place #2", "place #1"], rows
+        assert rows[0]['date'] == "2016-01-01" and rows[0]['account_id'] == self.account1
+
+    def test_csv_export_all_accounts(self):
+        r = self.app.get('/transactions/export', query_string={'format': 'csv'}, buffered=True)
+        assert r.status_code == 200 and r.mimetype == 'text/csv'
+
+        lines = r.data.decode('utf-8').splitlines()
+        assert lines[0] == ",".join(Transaction.row_columns)
+        assert len(lines) == 1 + 3, lines
+
+    def test_unknown_format(self):
+        r = self.app.get('/transactions/export', query_string={'format': 'xml'})
+        assert r.status_code == 400
+
+
+class CompressionAPITest(APITest):
+    def setUp(self):
+        super(CompressionAPITest, self).setUp()
+        self.account = self.add_account("Account1", transactions=[
+            (datetime.date(2016, 1, 1), "place #{}".format(i), i, "debit", "gas")
+            for i in range(50)
+        ]).id
+
+    def test_gzip_listing(self):
+        uri = '/accounts/{}/transactions'.format(self.account)
+        plain = self.app.get(uri)
+
+        r = self.app.get(uri, headers={'Accept-Encoding': 'gzip'})
+        assert r.headers.get('Content-Encoding') == 'gzip' and 'Accept-Encoding' in r.headers['Vary']
+        assert len(r.data) < len(plain.data)
+        assert gzip.GzipFile(fileobj=io.BytesIO(r.data)).read() == plain.data
+
+    def test_choose_encoding(self):
+        def choose(header):
+            with app.test_request_context(headers={'Accept-Encoding': header}):
+                return compression.choose_encoding()
+
+        installed = compression.brotli
+        compression.brotli = object()
+        try:
+            assert choose('gzip, br') == 'br'
+            assert choose('gzip;q=1, br;q=0.1') == 'gzip'
+            assert choose('br;q=0, gzip;q=0.5') == 'gzip'
+            assert choose('br;q=0') is None
+            assert choose('*') == 'br'
+        finally:
+            compression.brotli = installed
+
+        assert choose('gzip;q=0') is None
+
+    def test_small_responses_not_compressed(self):
+        r = self.app.get('/accounts/{}'.format(self.account), headers={'Accept-Encoding': 'gzip'})
+        assert r.status_code == 200 and 'Content-Encoding' not in r.headers
+
+    def test_streamed_export(self):
+        uri = '/transactions/export'
+        plain = self.app.get(uri, buffered=True)
+
+        r = self.app.get(uri, headers={'Accept-Encoding': 'gzip'}, buffered=True)
+        assert r.headers.get('Content-Encoding') == 'gzip'
+        assert gzip.GzipFile(fileobj=io.BytesIO(r.data)).read() == plain.data
+
+
+class BalanceAPITest(APITest):
+    def setUp(self):
+        super(BalanceAPITest, self).setUp()
+        self.account = self.add_account("Account1", transactions=[
+            (datetime.date(2016, 1, 10), "place #1", 100, "debit", "gas"),
+            (datetime.date(2016, 2, 10), "place #2", 500, "credit", "paycheck"),
+        ]).id
+
+    def test_balance_at(self):
+        uri = '/accounts/{}/balance'.format(self.account)
+        code, resp = self.get_json(uri, query_string={'at': '2016-01-31'})
+        assert code == 200 and resp['balance']['balance'] == -100, resp
+
+        code, resp = self.get_json(uri)
+        assert resp['balance']['balance'] == 400, resp
+
+        code, resp = self.get_json(uri, query_string={'at': '31/01/2016'})
+        assert code == 400, resp
+
+        code, resp = self.get_json('/accounts/0/balance')
+        assert code == 404, resp
+
+    def test_back_dated_transaction_changes_balance(self):
+        uri = '/accounts/{}/balance'.format(self.account)
+        etag = self.app.get(uri, query_string={'at': '2016-02-28'}).headers['ETag']
+
+        code, resp = self.put_json('/accounts/{}/transactions'.format(self.account), {
+            "date": "01/01/2016 00:00:00", "description": "early", "amount": 25,
+            "type": "debit", "category": "gas",
+        })
+        assert code == 200, resp
+
+        r = self.app.get(uri, query_string={'at': '2016-02-28'}, headers={'If-None-Match': etag})
+        assert r.status_code == 200
+        assert json.loads(r.data.decode('utf-8'))['balance']['balance'] == 375
+
+    def test_default_balance_changes_with_the_day(self):
+        uri = '/accounts/{}/balance'.format(self.account)
+        etag = self.app.get(uri).headers['ETag']
+
+        class Tomorrow(datetime.date):
+            @classmethod
+            def today(cls):
+                return datetime.date.today() + datetime.timedelta(days=1)
+
+        class FakeDatetime(object):
+            date = Tomorrow
+            datetime = datetime.datetime
+
+        views.datetime = FakeDatetime
+        try:
+            r = self.app.get(uri, headers={'If-None-Match': etag})
+        finally:
+            views.datetime = datetime
+        assert r.status_code == 200
+        assert json.loads(r.data.decode('utf-8'))['balance']['at'] == Tomorrow.today().isoformat()
+
+    def test_net_worth(self):
+        code, resp = self.get_json('/networth')
+        assert code == 200, resp
+        assert resp['net_worth'] == [
+            {"month": "2016-01", "balance": -100},
+            {"month": "2016-02", "balance": 400},
+        ], resp
+
+    def test_net_worth_changes_after_summary_rebuild(self):
+        etag = self.app.get('/networth').headers['ETag']
+        TransactionSummary.rebuild()
+        db.session.commit()
+
+        r = self.app.get('/networth', headers={'If-None-Match': etag})
+        assert r.status_code == 200 and r.headers['ETag'] != etag
+
+
+class SearchAPITest(APITest):
+    def setUp(self):
+        super(SearchAPITest, self).setUp()
+        self.account = self.add_account("Account1", transactions=[
+            (datetime.date(2016, 1, 1 + i), "Amazon order #{}".format(i), i, "debit", "gas")
+            for i in range(5)
+        ] + [
+            (datetime.date(2016, 1, 10), "Amazon Amazon refund", 50, "credit", "gas"),
+            (datetime.date(2016, 1, 11), "Safeway", 50, "debit", "gas"),
+        ]).id
+
+    def test_ranked_pages(self):
+        code, resp = self.get_json('/transactions/search', query_string={'q': 'amazon', 'limit': 2})
+        assert code == 200, resp
+        # More occurrences in a shorter description rank first.
+        assert resp['transactions'][0]['description'] == "Amazon Amazon refund", resp
+
+        seen = [t['id'] for t in resp['transactions']]
+        while resp['next']:
+            code, resp = self.get_json('/transactions/search', query_string={
+                'q': 'amazon', 'limit': 2, 'next': resp['next']})
+            assert code == 200, resp
+            seen.extend(t['id'] for t in resp['transactions'])
+
+        assert len(seen) == 6 and len(set(seen)) == 6, seen
+
+    def test_prefix_phrase_and_filters(self):
+        code, resp = self.get_json('/transactions/search', query_string={
+            'q': 'ama* "order #3"', 'account_id': self.account})
+        assert [t['description'] for t in resp['transactions']] == ["Amazon order #3"], resp
+
+    def test_bad_queries(self):
+        code, resp = self.get_json('/transactions/search')
+        assert code == 400, resp
+
+        code, resp = self.get_json('/transactions/search', query_string={'q': 'a', 'next': 'bogus'})
+        assert code == 400, resp
+
+
+class GroupCommitAPITest(APITest):
+    def setUp(self):
+        super(GroupCommitAPITest, self).setUp()
+        app.config['GROUP_COMMIT_ENABLED'] = True
+        app.config['GROUP_COMMIT_MAX_DELAY'] = 0.05
+        self.account = self.add_account("Account1").id
+        Category.add_categories(["gas"])
+        db.session.commit()
 
     def tearDown(self):
-        print "Tearing down"
+        app.config['GROUP_COMMIT_ENABLED'] = False
+        app.config['GROUP_COMMIT_MAX_DELAY'] = 0.002
+        super(GroupCommitAPITest, self).tearDown()
+
+    def test_concurrent_writes(self):
+        statuses = []
+
+        def put(account, amount):
+            client = app.test_client()
+            r = client.put('/accounts/{}/transactions'.format(account), content_type='application/json',
+                           data=json.dumps({"date": "01/01/2016 00:00:00", "description": "place",
+                                            "amount": amount, "type": "credit", "category": "gas"}))
+            statuses.append((amount, r.status_code, json.loads(r.data.decode('utf-8'))))
+
+        threads = [threading.Thread(target=put, args=(self.account, i + 1)) for i in range(10)]
+        threads.append(threading.Thread(target=put, args=(0, 1000)))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for amount, code, resp in statuses:
+            if amount == 1000:
+                assert code == 404, resp
+            else:
+                assert code == 200 and resp['transaction']['amount'] == amount, resp
+
+        code, resp = self.get_json('/accounts/{}'.format(self.account))
+        assert resp['account']['balance'] == sum(range(1, 11)), resp
+
+    def test_failed_write_only_fails_itself(self):
+        def write(account_id):
+            def insert():
+                t = Account.insert_transaction(account_id, datetime.date(2016, 1, 1), "place",
+                                               10, "credit", "gas")
+                db.session.add(t)
+                return t
+            return insert
+
+        good = PendingWrite(write(self.account), Transaction.as_dict)
+        bad = PendingWrite(write(0), Transaction.as_dict)
+        with app.app_context():
+            GroupCommitWriter.commit_group([good, bad])
+
+        assert good.wait(1)['amount'] == 10
+        self.assertRaises(AccountException, bad.wait, 1)
+        assert Account.get_by_id(self.account).balance == 10
+
+
+    def test_timed_out_write_is_not_applied(self):
+        def insert():
+            t = Account.insert_transaction(self.account, datetime.date(2016, 1, 1), "place",
+                                           10, "credit", "gas")
+            db.session.add(t)
+            return t
+
+        # Withdrawn, the writer skips it
+        pending = PendingWrite(insert, Transaction.as_dict)
+        self.assertRaises(GroupCommitTimeout, pending.wait, 0.01)
+        assert not pending.claim()
+
+        # Already being written when the wait runs out: wait for the outcome
+        pending = PendingWrite(insert, Transaction.as_dict)
+        assert pending.claim()
+        timer = threading.Timer(0.05, lambda: pending.resolve({'amount': 10}))
+        timer.start()
+        assert pending.wait(0.01) == {'amount': 10}
+        timer.join()
+
+    def test_timed_out_write_answers_503(self):
+        app.config['GROUP_COMMIT_TIMEOUT'] = 0
+        app.config['GROUP_COMMIT_MAX_DELAY'] = 0.2
+        try:
+            code, resp = self.put_json('/accounts/{}/transactions'.format(self.account), {
+                "date": "01/01/2016 00:00:00", "description": "place",
+                "amount": 10, "type": "credit", "category": "gas"})
+        finally:
+            app.config['GROUP_COMMIT_TIMEOUT'] = 30
+        assert code == 503, resp
+        time.sleep(0.3)
+        assert Account.get_by_id(self.account).balance == 0
+
+
+class MetricsAPITest(APITest):
+    def test_metrics(self):
+        account = self.add_account("Account1", transactions=[
+            (datetime.date(2016, 1, 1), "place", 10, "debit", "gas"),
+        ]).id
+        self.app.get('/accounts/{}/transactions'.format(account))
+        self.app.get('/accounts/0')
+
+        r = self.app.get('/metrics')
+        assert r.status_code == 200 and r.mimetype == 'text/plain'
+        text = r.data.decode('utf-8')
+
+        labels = 'method="GET",route="/accounts/<int:id>/transactions"'
+        assert 'books_request_seconds_count{' + labels + '}' in text
+        assert 'books_request_seconds_bucket{' + labels + ',le="+Inf"}' in text
+        assert 'books_responses_total{' + labels + ',status="200"}' in text
+        assert 'route="/accounts/<int:id>",status="404"' in text
+        assert 'books_requests_in_flight 0' in text
+        assert 'books_request_sql_queries_bucket{' + labels in text
+        assert 'route="/metrics"' not in text
+
+    def test_streamed_response_recorded_when_closed(self):
+        self.add_account("Account1", transactions=[
+            (datetime.date(2016, 1, 1), "place", 10, "debit", "gas"),
+        ])
+        key = ('GET', '/transactions/export')
+
+        def recorded():
+            histogram = registry.latency.get(key)
+            return histogram.count if histogram is not None else 0
+
+        in_flight, count = registry.in_flight, recorded()
+        # Streamed until the server closes the response
+        r = self.app.get('/transactions/export')
+        assert registry.in_flight == in_flight + 1
+        assert recorded() == count
+
+        assert len(r.get_data().splitlines()) == 1
+        r.close()
+        assert registry.in_flight == in_flight
+        assert recorded() == count + 1
+        assert registry.statuses[key + (200,)] >= 1
+
+    def test_metrics_disabled(self):
+        app.config['METRICS_ENABLED'] = False
+        try:
+            assert self.app.get('/metrics').status_code == 404
+            assert not event.contains(Engine, 'before_cursor_execute', metrics._start_query_timer)
+        finally:
+            app.config['METRICS_ENABLED'] = True
+            metrics.sync_query_listeners()
+
+    def test_failed_statement_drops_its_timer(self):
+        with db.engine.connect() as connection:
+            for i in range(3):
+                self.assertRaises(sqlalchemy.exc.OperationalError, connection.execute,
+                                  "SELECT * FROM missing")
+            assert not connection.info.get('metrics_query_start')
+
+
+class QueryLogTest(APITest):
+    def test_repeated_query_raises(self):
+        @app.route('/test/repeated-query')
+        def repeated_query():
+            for i in range(11):
+                Account.get_by_id(i)
+            return "done"
+
+        self.assertRaises(RepeatedQueryError, self.app.get, '/test/repeated-query')
+
+    def test_in_lists_share_a_shape(self):
+        assert (statement_shape("SELECT * FROM t WHERE id IN (?, ?)") ==
+                statement_shape("SELECT *\n FROM t WHERE id IN (?, ?, ?)"))
+
+    def test_slow_query_logged(self):
+        app.config['SLOW_QUERY_SECONDS'] = 0
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        querylog.logger.addHandler(handler)
+        try:
+            self.app.get('/accounts')
+        finally:
+            querylog.logger.removeHandler(handler)
+            app.config['SLOW_QUERY_SECONDS'] = None
+
+        messages = [r.getMessage() for r in records]
+        assert any("GET /accounts" in m and "FROM account" in m for m in messages), messages
+
+    def test_listeners_follow_configuration(self):
+        app.config['REPEATED_QUERY_LIMIT'] = None
+        querylog.sync_listeners()
+        assert not event.contains(Engine, 'after_cursor_execute', querylog._check_statement)
+
+        app.config['SLOW_QUERY_SECONDS'] = 10
+        try:
+            querylog.sync_listeners()
+            assert event.contains(Engine, 'before_cursor_execute', querylog._start_timer)
+            with db.engine.connect() as connection:
+                self.assertRaises(sqlalchemy.exc.OperationalError, connection.execute,
+                                  "SELECT * FROM missing")
+                assert not connection.info.get('querylog_start')
+        finally:
+            app.config['SLOW_QUERY_SECONDS'] = None
+            querylog.sync_listeners()
+        assert not event.contains(Engine, 'before_cursor_execute', querylog._start_timer)
+
+
+class AnalyticsAPITest(APITest):
+    def setUp(self):
+        super(AnalyticsAPITest, self).setUp()
+        app.config['ANALYTICS_SNAPSHOT_DIR'] = tempfile.mkdtemp()
+        self.account1 = self.add_account("Account1", transactions=[
+            (datetime.date(2016, 1, 1), "place #1", 100, "debit", "gas"),
+            (datetime.date(2016, 1, 2), "place #2", 200, "debit", "gas"),
+            (datetime.date(2016, 1, 4), "place #3", 400, "debit", "gas"),
+            (datetime.date(2016, 2, 1), "salary", 1000, "credit", "income"),
+        ])
+        self.account2 = self.add_account("Account2", transactions=[
+            (datetime.date(2016, 1, 3), "place #4", 300, "debit", "gas"),
+        ])
+        self.account_ids = [self.account1.id, self.account2.id]
+
+    def tearDown(self):
+        shutil.rmtree(app.config['ANALYTICS_SNAPSHOT_DIR'])
+        super(AnalyticsAPITest, self).tearDown()
+
+    def groups(self, uri):
+        code, resp = self.get_json(uri)
+        assert code == 200, resp
+        return resp['analytics']['groups']
+
+    def test_group_by_category(self):
+        gas, income = self.groups('/analytics?percentile=50&percentile=75')
+
+        assert gas['category'] == 'gas'
+        assert (gas['count'], gas['total'], gas['min'], gas['max']) == (4, -1000, -400, -100)
+        assert gas['mean'] == -250
+        assert gas['percentiles'] == {'50': -250, '75': -175}
+        assert income['category'] == 'income' and income['total'] == 1000
+
+    def test_filters_and_group_by(self):
+        groups = self.groups('/analytics?group_by=account&category=gas&date_to=2016-01-03')
+        assert [(g['account'], g['total']) for g in groups] == \
+            [(self.account_ids[0], -300), (self.account_ids[1], -300)]
+
+        groups = self.groups('/analytics?group_by=month&account_id={}'.format(self.account_ids[0]))
+        assert [(g['month'], g['total']) for g in groups] == [('2016-01', -700), ('2016-02', 1000)]
+
+    def test_rolling_window(self):
+        code, resp = self.get_json('/analytics?window=2&account_id={}&date_to=2016-01-05'.format(
+            self.account_ids[0]))
+        assert code == 200, resp
+
+        days = resp['analytics']['rolling']['days']
+        assert [d['date'] for d in days] == ['2016-01-0{}'.format(i) for i in range(1, 6)]
+        assert [d['total'] for d in days] == [-100, -200, 0, -400, 0]
+        assert [d['window_total'] for d in days] == [-100, -300, -200, -400, -400]
+        assert [d['window_mean'] for d in days] == [-100, -150, -100, -200, -200]
+
+    def test_snapshot_follows_writes(self):
+        self.groups('/analytics')
+        generation = snapshot.read_meta()['generation']
+
+        account = Account.get_by_id(self.account_ids[1])
+        db.session.add(account.add_transaction(datetime.date(2016, 3, 1), "place #5", 50, "debit", "gas"))
+        db.session.add(account)
+        db.session.commit()
+        gas = self.groups('/analytics')[0]
+        assert gas['count'] == 5 and gas['total'] == -1050
+        # Appended to the same generation
+        assert snapshot.read_meta()['generation'] == generation
+
+        account = Account.get_by_id(self.account_ids[0])
+        record = account.remove_transaction(Transaction.query.filter_by(description="place #1").one())
+        db.session.delete(record)
+        db.session.add(account)
+        db.session.commit()
+        gas = self.groups('/analytics')[0]
+        assert gas['count'] == 4 and gas['total'] == -950
+        assert snapshot.read_meta()['generation'] == generation + 1
+        # Kept for workers that read meta.json before the rebuild
+        assert os.path.isdir(os.path.dirname(snapshot.column_path({'generation': generation}, 'id')))
+
+    def remove(self, description):
+        account = Account.query.filter_by(id=Transaction.query.filter_by(
+            description=description).one().account_id).one()
+        record = account.remove_transaction(Transaction.query.filter_by(description=description).one())
+        db.session.delete(record)
+        db.session.add(account)
+        db.session.commit()
+
+    def test_snapshot_rebuilt_twice_while_loading(self):
+        self.groups('/analytics')
+        with app.test_request_context():
+            old_meta, old_state = snapshot.read_meta(), snapshot.database_state()
+        for description in ("place #1", "place #2"):
+            self.remove(description)
+            self.groups('/analytics')
+        assert not os.path.isdir(os.path.dirname(snapshot.column_path(old_meta, 'id')))
+
+        # A worker that read meta.json and the database just before both
+        # rebuilds falls back to the current generation.
+        read_meta, metas = snapshot.read_meta, [old_meta]
+        snapshot.read_meta = lambda: metas.pop() if metas else read_meta()
+        snapshot.database_state = lambda: old_state
+        snapshot._mapped = None
+        try:
+            with app.test_request_context():
+                meta, arrays = snapshot.load()
+        finally:
+            del snapshot.read_meta, snapshot.database_state
+        assert meta['generation'] == old_meta['generation'] + 2
+        assert len(arrays['id']) == 3
+
+    def test_invalid_parameters(self):
+        for query in ('group_by=description', 'percentile=101', 'percentile=x', 'window=0',
+                      'window=7&date_from=1900-01-01&date_to=2016-01-01'):
+            assert self.app.get('/analytics?' + query).status_code == 400, query
+
+
+class CashflowAPITest(APITest):
+    def setUp(self):
+        super(CashflowAPITest, self).setUp()
+        cashflow_cache.clear()
+        self.add_account("Account1", transactions=[
+            (datetime.date(2016, 1, 1), "place #1", 100, "debit", "gas"),
+            (datetime.date(2016, 1, 5), "salary", 1000, "credit", "income"),
+            (datetime.date(2016, 2, 1), "place #2", 50, "debit", "gas"),
+        ])
+        self.account_id = self.add_account("Account2", transactions=[
+            (datetime.date(2016, 1, 9), "place #3", 30, "debit", "gas"),
+        ]).id
+
+    def cashflow(self, query=''):
+        code, resp = self.get_json('/reports/cashflow' + query)
+        assert code == 200, resp
+        return resp['cashflow']['months']
+
+    def test_report(self):
+        january, february = self.cashflow()
+        assert january == {
+            "month": "2016-01", "debits": 130, "credits": 1000, "count": 3,
+            "categories": [
+                {"category": "gas", "debits": 130, "credits": 0, "count": 2},
+                {"category": "income", "debits": 0, "credits": 1000, "count": 1},
+            ],
+        }, january
+        assert (february['month'], february['debits']) == ("2016-02", 50)
+
+        assert [m['month'] for m in self.cashflow('?month_from=2016-02')] == ["2016-02"]
+        january, = self.cashflow('?month_to=2016-01&account_id={}'.format(self.account_id))
+        assert (january['debits'], january['count']) == (30, 1)
+
+        assert self.app.get('/reports/cashflow?month_from=2016-1-1').status_code == 400
+
+    def test_writes_only_invalidate_their_months(self):
+        self.cashflow('?month_to=2016-01')
+        self.cashflow()
+        assert len(cashflow_cache) == 2
+
+        account = Account.get_by_id(self.account_id)
+        db.session.add(account.add_transaction(datetime.date(2016, 2, 20), "place #4", 5, "debit", "gas"))
+        db.session.add(account)
+        db.session.commit()
+
+        # January is served from the cache, the full report is recomputed.
+        self.cashflow('?month_to=2016-01')
+        assert len(cashflow_cache) == 2
+        february = self.cashflow()[1]
+        assert len(cashflow_cache) == 3
+        assert february['debits'] == 55
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,332 @@
+#!flask/env/python
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.compat import urlsplit
+from requests.structures import CaseInsensitiveDict
+
+from books_api import db
+from books_api.models import Transaction
+from books_api_client.books_cli_client import Book, ResponseCache
+from books_api_client.books_cli_client import BooksAPIException, ImportState
+from books_api_client.books_cli_client import read_csv_statement, read_ofx_statement
+from books_api_client.books_cli_client import chunked, import_statement, statement_fingerprint
+from tests.test_api import APITest
+
+
+class FakeBook(object):
+    """ Records uploads, failing the chunks whose first description is in fail. """
+    def __init__(self, fail=(), categories=("gas",)):
+        self.fail = set(fail)
+        self.uploaded = []
+        self.categories = list(categories)
+        self.added_categories = []
+        self._lock = threading.Lock()
+
+    def get_categories(self):
+        return list(self.categories)
+
+    def add_categories(self, categories):
+        self.added_categories.append(list(categories))
+        self.categories.extend(categories)
+
+    def add_transaction_batch(self, account, transactions):
+        if transactions[0]['description'] in self.fail:
+            raise BooksAPIException("Rejected")
+        with self._lock:
+            self.uploaded.extend(t['description'] for t in transactions)
+        return len(transactions)
+
+
+def statement(count, category="gas"):
+    return [{"date": "01/01/2016 00:00:00", "description": "place #{}".format(i),
+             "amount": 10, "type": "debit", "category": category} for i in range(count)]
+
+
+class FlaskAdapter(BaseAdapter):
+    """ Sends requests to the Flask test client, recording (method, path, status). """
+    def __init__(self, client):
+        super(FlaskAdapter, self).__init__()
+        self.client = client
+        self.sent = []
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        # Served from the root, like the development server
+        r = self.client.open(url.path, base_url="{}://{}/".format(url.scheme, url.netloc),
+                             method=request.method, query_string=url.query,
+                             headers=list(request.headers.items()), data=request.body)
+        with self._lock:
+            self.sent.append((request.method, url.path, r.status_code))
+
+        response = requests.Response()
+        response.status_code = r.status_code
+        response.headers = CaseInsensitiveDict(r.headers)
+        response._content = r.get_data()
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        self.closed = True
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = ResponseCache(2)
+        cache.put("a", "1", None, "{}")
+        cache.put("b", "2", None, "{}")
+        assert cache.get("a")['etag'] == "1"
+        cache.put("c", "3", None, "{}")
+
+        # b was used least recently
+        assert cache.get("b") is None
+        assert cache.get("a") is not None and cache.get("c") is not None
+
+    def test_max_age(self):
+        cache = ResponseCache(2, max_age=60)
+        cache.put("a", "1", None, "{}")
+        entry = cache.get("a")
+        assert cache.is_fresh(entry)
+
+        entry['stored_at'] -= 61
+        assert not cache.is_fresh(entry)
+        cache.touch("a")
+        assert cache.is_fresh(cache.get("a"))
+
+        assert not ResponseCache(2).is_fresh(entry)
+
+    def test_invalidate(self):
+        cache = ResponseCache(10)
+        for key in ("/accounts", "/accounts?description=x", "/accounts/1", "/accountsx"):
+            cache.put(key, "1", None, "{}")
+
+        cache.invalidate("/accounts")
+        assert [k for k in ("/accounts", "/accounts?description=x", "/accounts/1", "/accountsx")
+                if cache.get(k) is not None] == ["/accounts/1", "/accountsx"]
+        cache.invalidate("/accounts", subtree=True)
+        assert cache.get("/accounts/1") is None
+
+
+class BookTest(APITest):
+    """ Book against the Flask app, through the test client. """
+    endpoint = "http://books.test"
+
+    def setUp(self):
+        super(BookTest, self).setUp()
+        self.adapter = FlaskAdapter(self.app)
+        self.books = []
+
+    def tearDown(self):
+        for book in self.books:
+            book.close()
+        super(BookTest, self).tearDown()
+
+    def book(self, **kwargs):
+        book = Book(self.endpoint, **kwargs)
+        book.session.mount(self.endpoint, self.adapter)
+        self.books.append(book)
+        return book
+
+    def statuses(self, path):
+        return [status for method, p, status in self.adapter.sent if method == 'GET' and p == path]
+
+    def account(self, book, description="Account1"):
+        book.add_account(description, "checking")
+        return [a for a in book.get_accounts() if a['description'] == description][0]
+
+    def test_revalidates_with_etag(self):
+        book = self.book(cache_size=10)
+        self.account(book)
+        first = book.get_accounts()
+        second = book.get_accounts()
+
+        assert second == first
+        # Every read revalidates, unchanged responses come back empty
+        assert self.statuses('/accounts') == [200, 304, 304]
+
+    def test_max_age_skips_the_server(self):
+        book = self.book(cache_size=10, cache_max_age=60)
+        book.get_categories()
+        book.get_categories()
+        assert self.statuses('/categories') == [200]
+
+    def test_add_account_invalidates_accounts(self):
+        book = self.book(cache_size=10, cache_max_age=60)
+        assert book.get_accounts() == []
+
+        book.add_account("Account1", "checking")
+        assert [a['description'] for a in book.get_accounts()] == ["Account1"]
+        assert self.statuses('/accounts') == [200, 200]
+
+    def test_add_transaction_invalidates_account(self):
+        book = self.book(cache_size=10, cache_max_age=60)
+        book.add_categories(["gas"])
+        account = self.account(book)
+        assert book.get_transactions_for_account(account) == []
+
+        book.add_transaction_to_account(account, {
+            "date": "01/01/2016 00:00:00", "description": "place", "amount": 10,
+            "type": "debit", "category": "gas"})
+        assert [t['description'] for t in book.get_transactions_for_account(account)] == ["place"]
+        assert book.get_accounts()[0]['balance'] == -10
+
+    def test_batches_sent_on_pooled_session(self):
+        book = self.book(workers=2, pool_size=3)
+        adapter = book.session.get_adapter("http://elsewhere")
+        assert adapter is book.session.get_adapter("https://elsewhere")
+        assert adapter._pool_maxsize == 3
+
+        book.add_categories(["gas"])
+        account = self.account(book)
+        added = book.add_transactions_to_account(account, statement(5), batch_size=2)
+
+        assert added == 5
+        batches = [s for m, p, s in self.adapter.sent if p.endswith('/transactions/batch')]
+        assert batches == [200, 200, 200]
+        assert Transaction.query.count() == 5
+
+    def test_rejected_batch_raises(self):
+        book = self.book(workers=2)
+        account = self.account(book)
+        # The "gas" category was never created
+        self.assertRaises(BooksAPIException, book.add_transactions_to_account,
+                          account, statement(3), batch_size=2)
+        db.session.remove()
+        assert Transaction.query.count() == 0
+
+    def test_close(self):
+        with self.book(workers=2) as book:
+            book.add_categories(["gas"])
+            account = self.account(book)
+            book.get_transactions_for_accounts([account])
+        assert self.adapter.closed
+        assert book._Book__pool is None
+
+
+class StatementReaderTest(unittest.TestCase):
+    def test_csv_statement(self):
+        lines = [
+            "Date,Description,Amount,Category\n",
+            "01/02/2016,Gas station ,-12.34,gas\n",
+            "01/03/2016,Salary,\"1,000.00\",\n",
+        ]
+        rows = list(read_csv_statement(lines, "Date", "Description", "Amount", "%m/%d/%Y",
+                                       category_column="Category"))
+        assert rows == [
+            {"date": "02/01/2016 00:00:00", "description": "Gas station", "amount": 1234,
+             "type": "debit", "category": "gas"},
+            {"date": "03/01/2016 00:00:00", "description": "Salary", "amount": 100000,
+             "type": "credit", "category": "none"},
+        ], rows
+
+    def test_csv_statement_bad_row(self):
+        lines = ["Date,Description,Amount\n", "2016-01-02,Gas,-1.00\n"]
+        self.assertRaises(BooksAPIException, list,
+                          read_csv_statement(lines, "Date", "Description", "Amount", "%m/%d/%Y"))
+
+    def test_ofx_statement_sgml(self):
+        lines = [
+            "<BANKTRANLIST>\n",
+            "<STMTTRN>\n", "<DTPOSTED>20160102120000\n", "<TRNAMT>-5.00\n", "<NAME>Coffee\n",
+            "</STMTTRN>\n",
+            "<STMTTRN>\n", "<DTPOSTED>20160103\n", "<TRNAMT>20.50\n", "<MEMO>Refund\n",
+            "</STMTTRN>\n",
+        ]
+        rows = list(read_ofx_statement(lines))
+        assert [(r['date'], r['description'], r['amount'], r['type']) for r in rows] == [
+            ("02/01/2016 00:00:00", "Coffee", 500, "debit"),
+            ("03/01/2016 00:00:00", "Refund", 2050, "credit"),
+        ], rows
+
+    def test_ofx_statement_one_line(self):
+        line = ("<BANKTRANLIST><STMTTRN><DTPOSTED>20160102</DTPOSTED><TRNAMT>-5.00</TRNAMT>"
+                "<NAME>Coffee</NAME></STMTTRN><STMTTRN><DTPOSTED>20160103</DTPOSTED>"
+                "<TRNAMT>-7.00</TRNAMT><NAME>Lunch</NAME></STMTTRN></BANKTRANLIST>\n")
+        rows = list(read_ofx_statement([line]))
+        assert [(r['description'], r['amount']) for r in rows] == [("Coffee", 500), ("Lunch", 700)], rows
+
+    def test_chunked(self):
+        assert list(chunked(iter(range(7)), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+        assert list(chunked(iter(range(6)), 3)) == [[0, 1, 2], [3, 4, 5]]
+        assert list(chunked(iter([]), 3)) == []
+
+
+class ImportStatementTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state_path = os.path.join(self.directory, "statement.csv.import-state")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_resume_after_failure(self):
+        book = FakeBook(fail=["place #4"])
+        self.assertRaises(BooksAPIException, import_statement, book, {}, iter(statement(10)),
+                          chunk_size=2, connections=2, state_path=self.state_path,
+                          progress=None, fingerprint="a")
+        assert os.path.exists(self.state_path)
+        first = set(book.uploaded)
+        assert "place #4" not in first
+
+        book.fail = set()
+        added = import_statement(book, {}, iter(statement(10)), chunk_size=2, connections=2,
+                                 state_path=self.state_path, progress=None, fingerprint="a")
+        assert added == 10 - len(first)
+        assert sorted(book.uploaded) == sorted(t['description'] for t in statement(10))
+        # A finished import leaves no state behind
+        assert not os.path.exists(self.state_path)
+
+    def test_changed_statement_is_not_resumed(self):
+        state = ImportState(self.state_path, 2, "yesterday")
+        state.done.update([0, 1, 2])
+        state.save()
+
+        book = FakeBook()
+        added = import_statement(book, {}, iter(statement(6)), chunk_size=2, connections=2,
+                                 state_path=self.state_path, progress=None, fingerprint="today")
+        assert added == 6
+
+    def test_resume_with_other_chunk_size(self):
+        state = ImportState(self.state_path, 2, "a")
+        state.save()
+        self.assertRaises(BooksAPIException, ImportState, self.state_path, 3, "a")
+
+    def test_unknown_categories_rejected(self):
+        book = FakeBook()
+        self.assertRaises(BooksAPIException, import_statement, book, {},
+                          iter(statement(3, "gas") + statement(3, "rent")),
+                          chunk_size=2, connections=1, state_path=self.state_path, progress=None)
+        # Chunks before the unknown category are kept for resuming
+        assert book.uploaded == ["place #0", "place #1"], book.uploaded
+        assert book.added_categories == []
+        assert ImportState(self.state_path, 2).done == set([0])
+
+    def test_create_categories(self):
+        book = FakeBook()
+        import_statement(book, {}, iter(statement(3, "gas") + statement(3, "rent")),
+                         chunk_size=2, connections=1, progress=None, create_categories=True)
+        assert book.added_categories == [["rent"]], book.added_categories
+        assert len(book.uploaded) == 6
+
+    def test_statement_fingerprint(self):
+        path = os.path.join(self.directory, "statement.csv")
+        with open(path, "w") as f:
+            f.write("Date,Description,Amount\n")
+        fingerprint = statement_fingerprint(path)
+        with open(path, "a") as f:
+            f.write("01/02/2016,Gas,-1.00\n")
+        assert statement_fingerprint(path) != fingerprint
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,12 +3,18 @@
 import sys
 import os
 import datetime
+import threading
 import unittest
 
 import sqlalchemy.exc
+from sqlalchemy import event
 
 from books_api import app, db
+from books_api import migrations
+from books_api.archive import archive_before
 from books_api.models import Category, Account, Transaction, AccountException
+from books_api.models import TransactionSummary, DataVersion, TransactionException
+from books_api.models import search_expression, CategoryNotFoundException, archive_cutoff
 from public_config import basedir
 
 
@@ -49,6 +55,7 @@ def db_add_accounts(desc_type_pairs):
 
 def db_add_transactions(account, transaction_tuples):
     # [(datetime.date(2015, 1, 1), "place #1", 100, "debit", test_category), ...]
+    Category.add_categories(sorted(set(tx[4] for tx in transaction_tuples if tx[4] is not None)))
     tx_list = []
     for tx in transaction_tuples:
         transaction = account.add_transaction(*tx)
@@ -115,6 +122,64 @@ class CategoryModelTest(ModelTest):
             assert False, "is_category returned False for '{}'".format(categories[0])
 
 
+    @print_test_name
+    def test_add_categories(self):
+        categories = self.__class__.categories
+        add_categories(categories[:1])
+
+        added = Category.add_categories(categories + ['rent', 'rent'])
+        db.session.commit()
+
+        assert added == categories[1:] + ['rent'], "Unexpected new categories: {}".format(added)
+        assert sorted(Category.get_all_categories()) == sorted(categories + ['rent'])
+
+        # Already present categories are ignored, not an IntegrityError
+        assert Category.add_categories(categories) == []
+        db.session.commit()
+
+    @print_test_name
+    def test_category_cache_versioning(self):
+        categories = self.__class__.categories
+        add_categories(categories)
+        assert Category.get_all_categories() == categories
+
+        # Rows written behind the cache's back are not seen until the
+        # version changes, like a write from another worker process.
+        db.session.execute(Category.__table__.insert(), [{'category': 'rent'}])
+        db.session.commit()
+        assert not Category.is_category('rent'), "Category lookup was not served from cache"
+
+        DataVersion.bump('categories')
+        db.session.commit()
+        assert Category.is_category('rent'), "Cache did not notice version change"
+        assert Category.get_all_categories() == categories + ['rent']
+
+    @print_test_name
+    def test_category_names_checked_once_per_request(self):
+        add_categories(self.__class__.categories)
+        account, = db_add_accounts([('Wells Fargo', 'checking')])
+        transactions = db_add_transactions(account, [
+            (datetime.date(2016, 1, 1 + i), "place #{}".format(i), 10, "debit", 'gas')
+            for i in range(5)
+        ])
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with app.test_request_context():
+            Category.names_by_id()
+            event.listen(db.engine, 'before_cursor_execute', capture)
+            try:
+                names = [t.category for t in transactions]
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', capture)
+
+        assert names == ['gas'] * 5
+        assert not [s for s in statements if 'data_version' in s], statements
+        assert Category.names_by_id() is Category.names_by_id(), "Inverse map was rebuilt"
+
     @print_test_name
     def test_get_all_categories(self):
         categories = self.__class__.categories
@@ -129,7 +194,7 @@ class CategoryModelTest(ModelTest):
     @print_test_name
     def test_get_transactions(self):
         categories = self.__class__.categories
-        add_categories(categories)
+        add_categories(categories + ['grocery'])
 
         account, = db_add_accounts([('Wells Fargo', 'checking')])
         transactions2 = [
@@ -390,6 +455,644 @@ class AccountModelTest(ModelTest):
         except AccountException as e:
             pass
 
+    @print_test_name
+    def test_concurrent_balance_updates(self):
+        add_categories(["test"])
+        account, = db_add_accounts([("Account1", "checking")])
+        account_id = account.id
+        threads, per_thread = 8, 25
+        errors = []
+
+        def writer():
+            with app.app_context():
+                try:
+                    done = 0
+                    while done < per_thread:
+                        try:
+                            db.session.add(Account.insert_transaction(
+                                account_id, datetime.date(2016, 1, 1), "deposit", 1, "credit", "test"))
+                            db.session.commit()
+                            done += 1
+                        except sqlalchemy.exc.OperationalError:
+                            # SQLite busy timeout, try again
+                            db.session.rollback()
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    db.session.remove()
+
+        workers = [threading.Thread(target=writer) for _ in range(threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        assert not errors, errors
+
+        db.session.refresh(account)
+        assert account.balance == threads * per_thread, \
+            "Lost balance updates: {} != {}".format(account.balance, threads * per_thread)
+        assert len(account.get_transactions()) == threads * per_thread
+
+    @print_test_name
+    def test_insert_transaction_unknown_account(self):
+        add_categories(["test"])
+        try:
+            Account.insert_transaction(1000, datetime.date(2016, 1, 1), "place", 1, "debit", "test")
+            assert False, "Added transaction to an account that doesn't exist"
+        except AccountException as e:
+            pass
+
+    @print_test_name
+    def test_insert_transaction_unknown_category(self):
+        account, = db_add_accounts([("Account1", "checking")])
+        self.assertRaises(CategoryNotFoundException, Account.insert_transaction, account.id,
+                          datetime.date(2016, 1, 1), "place", 1, "debit", "typo")
+        db.session.rollback()
+
+        assert Account.get_by_id(account.id).balance == 0
+        assert not Category.is_category("typo"), "Unknown category was created"
+
+
+class TransactionFilterModelTest(ModelTest):
+    @print_test_name
+    def test_filters(self):
+        account1, account2 = db_add_accounts([("Account1", "checking"), ("Account2", "savings")])
+        db_add_transactions(account1, [
+            (datetime.date(2016, 1, 1), "refund", 0, "credit", "gas"),
+            (datetime.date(2016, 1, 2), "place #1", 100, "debit", "gas"),
+            (datetime.date(2016, 2, 1), "place #2", 250, "debit", "dining"),
+        ])
+        db_add_transactions(account2, [
+            (datetime.date(2016, 1, 15), "place #3", 75, "debit", "grocery"),
+        ])
+
+        def descriptions(**filters):
+            return [t.description for t in Transaction.get_transactions(**filters)]
+
+        assert descriptions(amount=0) == ["refund"], "amount=0 filter ignored"
+        assert descriptions(date_from=datetime.date(2016, 1, 2),
+                            date_to=datetime.date(2016, 1, 31)) == ["place #3", "place #1"]
+        assert descriptions(amount_min=75, amount_max=100, sort='amount',
+                            descending=False) == ["place #3", "place #1"]
+        assert descriptions(categories=["gas", "grocery"], type="debit") == ["place #3", "place #1"]
+        assert descriptions(account_ids=[account2.id]) == ["place #3"]
+
+        try:
+            Transaction.get_transactions(colour="red")
+            assert False, "Unknown filter accepted"
+        except TypeError as e:
+            pass
+
+
+class TransactionSummaryModelTest(ModelTest):
+    @staticmethod
+    def summary_rows(account):
+        return [(r.month, r.category, r.debits, r.credits, r.count)
+                for r in TransactionSummary.get_for_account(account.id)]
+
+    @print_test_name
+    def test_summary_maintained_on_add_and_remove(self):
+        account, = db_add_accounts([("Account1", "checking")])
+        added = db_add_transactions(account, [
+            (datetime.date(2016, 1, 1), "place #1", 100, "debit", "gas"),
+            (datetime.date(2016, 1, 20), "place #2", 40, "debit", "gas"),
+            (datetime.date(2016, 1, 5), "place #3", 500, "credit", "paycheck"),
+            (datetime.date(2016, 2, 3), "place #4", 10, "debit", "gas"),
+        ])
+        account.add_transactions([
+            {'date': datetime.date(2016, 2, 9), 'description': "place #5", 'amount': 7,
+             'type': "debit", 'category': None},
+            {'date': datetime.date(2016, 2, 10), 'description': "place #6", 'amount': 3,
+             'type': "debit", 'category': None},
+        ])
+        db.session.commit()
+
+        removed = account.remove_transaction(added[1])
+        db.session.delete(removed)
+        db.session.commit()
+
+        expected = [
+            (datetime.date(2016, 1, 1), "gas", 100, 0, 1),
+            (datetime.date(2016, 1, 1), "paycheck", 0, 500, 1),
+            (datetime.date(2016, 2, 1), "", 10, 0, 2),
+            (datetime.date(2016, 2, 1), "gas", 10, 0, 1),
+        ]
+        assert self.summary_rows(account) == expected, self.summary_rows(account)
+
+        # A rebuild from scratch must agree with the incremental rollup.
+        TransactionSummary.rebuild()
+        db.session.commit()
+        assert self.summary_rows(account) == expected, "Rebuilt summary differs"
+
+    @print_test_name
+    def test_month_versions_follow_writes(self):
+        account, = db_add_accounts([("Account1", "checking")])
+        db_add_transactions(account, [
+            (datetime.date(2016, 1, 1), "place #1", 100, "debit", "gas"),
+            (datetime.date(2016, 2, 3), "place #2", 10, "debit", "gas"),
+        ])
+        january = TransactionSummary.month_versions(datetime.date(2016, 1, 1), datetime.date(2016, 1, 1))
+        everything = TransactionSummary.month_versions()
+
+        db_add_transactions(account, [(datetime.date(2016, 2, 9), "place #3", 7, "debit", "gas")])
+        assert TransactionSummary.month_versions(
+            datetime.date(2016, 1, 1), datetime.date(2016, 1, 1)) == january
+        assert TransactionSummary.month_versions() != everything
+
+        TransactionSummary.rebuild()
+        db.session.commit()
+        assert TransactionSummary.month_versions(
+            datetime.date(2016, 1, 1), datetime.date(2016, 1, 1)) != january
+
+
+class RunningBalanceModelTest(ModelTest):
+    @staticmethod
+    def running_balances(account):
+        return [(str(t.date), t.description, t.balance_after)
+                for t in Transaction.filter_query(account_id=account.id, descending=False)]
+
+    @print_test_name
+    def test_back_dated_insert_and_remove(self):
+        account = Account(description="Account1", type="checking", balance=1000)
+        db_add_all([account])
+        added = db_add_transactions(account, [
+            (datetime.date(2016, 1, 10), "place #1", 100, "debit", None),
+            (datetime.date(2016, 1, 20), "place #2", 500, "credit", None),
+            # Back-dated, before both of the above
+            (datetime.date(2016, 1, 5), "place #3", 30, "debit", None),
+        ])
+        assert self.running_balances(account) == [
+            ("2016-01-05", "place #3", 970),
+            ("2016-01-10", "place #1", 870),
+            ("2016-01-20", "place #2", 1370),
+        ], self.running_balances(account)
+
+        account.add_transactions([
+            {'date': datetime.date(2016, 1, 10), 'description': "place #4", 'amount': 70,
+             'type': "debit", 'category': None},
+        ])
+        db.session.commit()
+
+        removed = account.remove_transaction(added[0])
+        db.session.delete(removed)
+        db.session.commit()
+
+        assert self.running_balances(account) == [
+            ("2016-01-05", "place #3", 970),
+            ("2016-01-10", "place #4", 900),
+            ("2016-01-20", "place #2", 1400),
+        ], self.running_balances(account)
+        assert Account.get_by_id(account.id).balance == 1400
+
+    @print_test_name
+    def test_balance_at(self):
+        account = Account(description="Account1", type="checking", balance=1000)
+        db_add_all([account])
+        db_add_transactions(account, [
+            (datetime.date(2016, 1, 10), "place #1", 100, "debit", None),
+            (datetime.date(2016, 1, 10), "place #2", 50, "debit", None),
+            (datetime.date(2016, 2, 1), "place #3", 500, "credit", None),
+        ])
+
+        assert Account.balance_at(account.id, datetime.date(2016, 1, 1)) == 1000
+        assert Account.balance_at(account.id, datetime.date(2016, 1, 10)) == 850
+        assert Account.balance_at(account.id, datetime.date(2016, 1, 31)) == 850
+        assert Account.balance_at(account.id, datetime.date(2017, 1, 1)) == 1350
+        assert Account.balance_at(0, datetime.date(2016, 1, 1)) is None
+
+    @print_test_name
+    def test_net_worth_by_month(self):
+        checking = Account(description="Account1", type="checking", balance=1000)
+        savings = Account(description="Account2", type="savings", balance=5000)
+        db_add_all([checking, savings])
+        db_add_transactions(checking, [
+            (datetime.date(2016, 1, 10), "place #1", 100, "debit", None),
+            (datetime.date(2016, 3, 1), "place #2", 500, "credit", None),
+        ])
+        db_add_transactions(savings, [
+            (datetime.date(2016, 1, 20), "place #3", 1000, "debit", None),
+        ])
+
+        assert TransactionSummary.net_worth_by_month() == [
+            (datetime.date(2016, 1, 1), 4900),
+            (datetime.date(2016, 3, 1), 5400),
+        ], TransactionSummary.net_worth_by_month()
+        assert TransactionSummary.net_worth_by_month([checking.id]) == [
+            (datetime.date(2016, 1, 1), 900),
+            (datetime.date(2016, 3, 1), 1400),
+        ]
+
+    @print_test_name
+    def test_upgrade_backfills_running_balances(self):
+        account, = db_add_accounts([("Account1", "checking")])
+        db_add_transactions(account, [
+            (datetime.date(2016, 1, 10), "place #1", 100, "debit", None),
+            (datetime.date(2016, 1, 20), "place #2", 500, "credit", None),
+        ])
+        db.session.execute(Transaction.__table__.update().values(balance_after=None))
+        db.session.commit()
+
+        results = dict(migrations.upgrade(db.engine))
+        assert results["backfill running balances"] == 2, results
+        assert [b for _, _, b in self.running_balances(account)] == [-100, 400]
+
+
+class TransactionSearchModelTest(ModelTest):
+    def setUp(self):
+        super(TransactionSearchModelTest, self).setUp()
+        self.account, = db_add_accounts([("Account1", "checking")])
+        db_add_transactions(self.account, [
+            (datetime.date(2016, 1, 1), "Amazon Marketplace", 100, "debit", None),
+            (datetime.date(2016, 1, 2), "Whole Foods Market", 100, "debit", None),
+            (datetime.date(2016, 1, 3), "Foods of the Whole World", 100, "debit", None),
+        ])
+        self.account.add_transactions([
+            {'date': datetime.date(2016, 1, 4), 'description': "AMAZON PRIME", 'amount': 5,
+             'type': "debit", 'category': None},
+        ])
+        db.session.commit()
+
+    @staticmethod
+    def search(text, **kwargs):
+        return sorted(t.description for t in Transaction.search_query(text, **kwargs))
+
+    @print_test_name
+    def test_search_expression(self):
+        assert search_expression('amaz* "whole foods"') == '"amaz"* "whole foods"'
+        assert search_expression('PG&E OR -x') == '"PG&E" "OR" "-x"'
+        self.assertRaises(TransactionException, search_expression, ' * "" ')
+
+    @print_test_name
+    def test_search(self):
+        assert self.search("amazon") == ["AMAZON PRIME", "Amazon Marketplace"]
+        assert self.search("amaz*") == ["AMAZON PRIME", "Amazon Marketplace"]
+        assert self.search('"whole foods"') == ["Whole Foods Market"]
+        assert self.search("whole foods") == ["Foods of the Whole World", "Whole Foods Market"]
+        assert self.search("amazon", date_from=datetime.date(2016, 1, 3)) == ["AMAZON PRIME"]
+        assert self.search("walmart") == []
+
+    @print_test_name
+    def test_index_follows_updates_and_deletes(self):
+        transaction = Transaction.get_transactions(description="Amazon Marketplace")[0]
+        transaction.description = "Walmart"
+        db.session.commit()
+        assert self.search("amazon") == ["AMAZON PRIME"]
+        assert self.search("walmart") == ["Walmart"]
+
+        db.session.delete(transaction)
+        db.session.commit()
+        assert self.search("walmart") == []
+
+    @print_test_name
+    def test_upgrade_creates_search_index(self):
+        db.session.execute("DROP TABLE transaction_search")
+        db.session.commit()
+
+        results = dict(migrations.upgrade(db.engine))
+        assert results["create search index"] is True, results
+        assert self.search("amazon") == ["AMAZON PRIME", "Amazon Marketplace"]
+
+        results = dict(migrations.upgrade(db.engine))
+        assert results["create search index"] is False, "Upgrade is not idempotent"
+
+
+class MigrationsModelTest(ModelTest):
+    def setUp(self):
+        super(MigrationsModelTest, self).setUp()
+        self.account, = db_add_accounts([("Account1", "checking")])
+        db_add_transactions(self.account, [
+            (datetime.date(2016, 1, 1 + i), "place #{}".format(i), 10, "debit", "gas")
+            for i in range(20)
+        ])
+
+    @print_test_name
+    def test_upgrade_backfills_category_ids(self):
+        # Recreate the old schema: descriptions in a text column, ids unset.
+        db.session.execute('ALTER TABLE "transaction" ADD COLUMN category VARCHAR(64)')
+        db.session.execute("CREATE INDEX ix_transaction_category_date "
+                           "ON \"transaction\" (category, date, id)")
+        db.session.execute('UPDATE "transaction" SET category = \'gas\', category_id = NULL')
+        db.session.execute('UPDATE "transaction" SET category = \'rent\' WHERE id = 1')
+        db.session.commit()
+
+        results = dict(migrations.upgrade(db.engine))
+        assert results["backfill category ids"] == 20, results
+        assert results["drop obsolete indexes"] == ["ix_transaction_category_date"], results
+
+        assert len(Transaction.get_transactions(category='gas')) == 19
+        assert [t.category for t in Transaction.get_transactions(category='rent')] == ['rent']
+        assert db.session.execute('SELECT count(*) FROM "transaction" WHERE category IS NOT NULL').scalar() == 0
+
+        results = dict(migrations.upgrade(db.engine))
+        assert results["backfill category ids"] == 0, "Upgrade is not idempotent"
+
+    @print_test_name
+    def test_upgrade_backfill_resumes_after_interruption(self):
+        db.session.execute(Transaction.__table__.update().values(balance_after=None))
+        db.session.commit()
+
+        batch_size, batch = migrations.BACKFILL_BATCH_SIZE, migrations.backfill_balances_batch
+        calls = []
+
+        def interrupted(connection, account_id, after=None):
+            calls.append(after)
+            if len(calls) == 3:
+                raise RuntimeError("Interrupted")
+            return batch(connection, account_id, after)
+
+        migrations.BACKFILL_BATCH_SIZE = 6
+        migrations.backfill_balances_batch = interrupted
+        try:
+            self.assertRaises(RuntimeError, migrations.upgrade, db.engine)
+            # The first two batches were committed on their own
+            assert db.session.execute('SELECT count(*) FROM "transaction" '
+                                      'WHERE balance_after IS NOT NULL').scalar() == 12
+
+            migrations.backfill_balances_batch = batch
+            results = dict(migrations.upgrade(db.engine))
+        finally:
+            migrations.BACKFILL_BATCH_SIZE = batch_size
+            migrations.backfill_balances_batch = batch
+
+        assert results["backfill running balances"] == 20, results
+        balances = [t.balance_after for t in Transaction.filter_query(account_id=self.account.id,
+                                                                      descending=False)]
+        assert balances == [-10 * (i + 1) for i in range(20)], balances
+
+    @print_test_name
+    def test_upgrade_creates_missing_indexes(self):
+        db.session.commit()
+        db.session.execute("DROP INDEX ix_transaction_category_id_date")
+        db.session.commit()
+
+        results = dict(migrations.upgrade(db.engine))
+        assert results["create missing indexes"] == ["ix_transaction_category_id_date"], results
+
+        results = dict(migrations.upgrade(db.engine))
+        assert results["create missing indexes"] == [], "Upgrade is not idempotent"
+
+
+
+class ArchiveModelTest(ModelTest):
+    def setUp(self):
+        super(ArchiveModelTest, self).setUp()
+        self.archive_path = os.path.join(basedir, 'test_archive.db')
+        app.config['ARCHIVE_DATABASE'] = self.archive_path
+
+        self.account = Account(description="Account1", type="checking", balance=1000)
+        db_add_all([self.account])
+        db_add_transactions(self.account, [
+            (datetime.date(2015, 6, 1), "place #1", 100, "debit", "gas"),
+            (datetime.date(2015, 12, 1), "place #2", 200, "debit", "rent"),
+            (datetime.date(2016, 1, 5), "place #3", 500, "credit", "paycheck"),
+            (datetime.date(2016, 2, 1), "place #4", 50, "debit", "gas"),
+        ])
+        self.account_id = self.account.id
+        self.moved = archive_before(datetime.date(2016, 1, 1))
+        db.session.remove()
+
+    def tearDown(self):
+        super(ArchiveModelTest, self).tearDown()
+        app.config['ARCHIVE_DATABASE'] = None
+        os.remove(self.archive_path)
+
+    @staticmethod
+    def descriptions(**filters):
+        return [t.description for t in Transaction.get_transactions(**filters)]
+
+    @print_test_name
+    def test_archive_moves_old_transactions(self):
+        assert self.moved == 2
+        assert db.session.execute('SELECT count(*) FROM "transaction"').scalar() == 2
+        assert db.session.execute('SELECT count(*) FROM archive."transaction"').scalar() == 2
+
+        account = Account.get_by_id(self.account_id)
+        assert account.archived_before == datetime.date(2016, 1, 1)
+        assert account.opening_balance == 700
+
+    @print_test_name
+    def test_queries_span_archive_when_needed(self):
+        assert not Transaction.needs_archive(date_from=datetime.date(2016, 1, 1))
+        assert self.descriptions(date_from=datetime.date(2016, 1, 1)) == ["place #4", "place #3"]
+
+        assert Transaction.needs_archive(account_id=self.account_id)
+        assert self.descriptions(account_id=self.account_id) == [
+            "place #4", "place #3", "place #2", "place #1"]
+        assert self.descriptions(account_id=self.account_id, limit=3) == [
+            "place #4", "place #3", "place #2"]
+        assert self.descriptions(category='gas', descending=False) == ["place #1", "place #4"]
+        assert self.descriptions(after=(datetime.date(2016, 1, 5), 3)) == ["place #2", "place #1"]
+
+        rows = list(Transaction.iter_rows(account_id=self.account_id))
+        assert [r[3] for r in rows] == ["place #1", "place #2", "place #3", "place #4"], rows
+        assert rows[0][6] == "gas"
+
+    @print_test_name
+    def test_new_accounts_use_the_archive_cutoff(self):
+        account = Account(description="Account2", type="checking")
+        db_add_all([account])
+        account_id = account.id
+
+        self.assertRaises(TransactionException, Account.insert_transaction,
+                          account_id, datetime.date(2015, 6, 1), "late", 10, "debit", "gas")
+        db.session.rollback()
+        account = Account.get_by_id(account_id)
+        self.assertRaises(TransactionException, account.add_transactions, [
+            {'date': datetime.date(2015, 6, 1), 'description': "late", 'amount': 10,
+             'type': "debit", 'category': "gas"}])
+        db.session.rollback()
+
+        db.session.add(Account.insert_transaction(account_id, datetime.date(2016, 1, 1), "on time",
+                                                  10, "debit", "gas"))
+        db.session.commit()
+        assert Account.get_by_id(account_id).balance == -10
+
+    @print_test_name
+    def test_cutoff_looked_up_once_per_request(self):
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            with app.test_request_context():
+                cutoffs = [archive_cutoff() for _ in range(3)]
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+
+        assert cutoffs == [datetime.date(2016, 1, 1)] * 3
+        assert len(statements) == 1, statements
+
+    @print_test_name
+    def test_remove_archived_transaction(self):
+        account = Account.get_by_id(self.account_id)
+        balance = account.balance
+        archived = Transaction.get_transactions(account_id=self.account_id,
+                                                date_to=datetime.date(2015, 7, 1))
+        assert [t.description for t in archived] == ["place #1"]
+
+        with self.assertRaises(TransactionException):
+            account.remove_transaction(archived[0])
+        db.session.remove()
+        assert Account.get_by_id(self.account_id).balance == balance
+        assert self.descriptions(account_id=self.account_id) == [
+            "place #4", "place #3", "place #2", "place #1"]
+
+    @print_test_name
+    def test_pages_read_hot_rows_first(self):
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        def reads_archive(**filters):
+            del statements[:]
+            event.listen(db.engine, 'before_cursor_execute', capture)
+            try:
+                descriptions = self.descriptions(**filters)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', capture)
+            return descriptions, any('archive.' in s for s in statements)
+
+        # The newest page and an id lookup are answered by the hot table.
+        assert reads_archive(account_id=self.account_id, limit=2) == (["place #4", "place #3"], False)
+        hot_id = Transaction.query.filter_by(description="place #4").one().id
+        assert reads_archive(transaction_id=hot_id) == (["place #4"], False)
+
+        # Pages reaching past the cutoff, or after a cursor before it, don't.
+        assert reads_archive(account_id=self.account_id, limit=3) == (
+            ["place #4", "place #3", "place #2"], True)
+        assert reads_archive(account_id=self.account_id, limit=2,
+                             after=(datetime.date(2015, 12, 1), 2)) == (["place #1"], True)
+
+    @print_test_name
+    def test_balances_and_summary_include_archive(self):
+        assert Account.balance_at(self.account_id, datetime.date(2015, 1, 1)) == 1000
+        assert Account.balance_at(self.account_id, datetime.date(2015, 6, 30)) == 900
+        assert Account.balance_at(self.account_id, datetime.date(2016, 1, 2)) == 700
+        assert Account.balance_at(self.account_id, datetime.date(2016, 3, 1)) == 1150
+
+        before = [r.as_dict() for r in TransactionSummary.get_for_account(self.account_id)]
+        TransactionSummary.rebuild()
+        db.session.commit()
+        after = [r.as_dict() for r in TransactionSummary.get_for_account(self.account_id)]
+        assert before == after and len(after) == 4, after
+
+    @print_test_name
+    def test_archived_history_is_read_only(self):
+        account = Account.get_by_id(self.account_id)
+        self.assertRaises(TransactionException, account.add_transaction,
+                          datetime.date(2015, 12, 31), "late", 10, "debit", "gas")
+        db.session.rollback()
+
+        db_add_transactions(account, [(datetime.date(2016, 1, 1), "on time", 10, "debit", "gas")])
+        assert Account.get_by_id(self.account_id).balance == 1140
+
+        self.assertRaises(TransactionException, account.add_transactions, [
+            {'date': datetime.date(2016, 1, 2), 'description': "batch", 'amount': 5,
+             'type': "debit", 'category': "gas"},
+            {'date': datetime.date(2015, 6, 1), 'description': "late", 'amount': 5,
+             'type': "debit", 'category': "gas"},
+        ])
+        db.session.rollback()
+        assert Account.get_by_id(self.account_id).balance == 1140
+
+    @print_test_name
+    def test_insert_reads_no_account_first(self):
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement.lstrip().upper())
+
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            db.session.add(Account.insert_transaction(
+                self.account_id, datetime.date(2016, 1, 1), "on time", 10, "debit", "gas"))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+        db.session.commit()
+
+        update = [i for i, s in enumerate(statements) if s.startswith("UPDATE ACCOUNT")][0]
+        assert not [s for s in statements[:update] if "FROM ACCOUNT" in s], statements
+
+
+class QueryPlanTest(ModelTest):
+    """
+    Hot listing queries must be answered from an index, not a table scan
+    followed by a sort.
+    """
+    def setUp(self):
+        super(QueryPlanTest, self).setUp()
+        self.account, = db_add_accounts([("Account1", "checking")])
+        db_add_transactions(self.account, [
+            (datetime.date(2016, 1, 1 + i), "place #{}".format(i), 10, "debit", "gas")
+            for i in range(20)
+        ])
+
+    def capture_statements(self, query):
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            query()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+
+        return [s for s in statements if s[0].lstrip().upper().startswith("SELECT")]
+
+    def assert_uses_index(self, query):
+        statements = self.capture_statements(query)
+        assert statements, "No query captured"
+
+        connection = db.engine.raw_connection()
+        try:
+            for statement, parameters in statements:
+                cursor = connection.cursor()
+                cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+                plan = [row[-1] for row in cursor.fetchall()]
+                for detail in plan:
+                    scan = detail.startswith("SCAN") and "INDEX" not in detail
+                    assert not scan and "TEMP B-TREE" not in detail, \
+                        "Query falls back to a scan: {}\n{}".format(statement, plan)
+        finally:
+            connection.close()
+
+    @print_test_name
+    def test_account_transactions_plan(self):
+        self.assert_uses_index(lambda: self.account.get_transactions())
+        self.assert_uses_index(lambda: self.account.get_transactions(
+            limit=5, after=(datetime.date(2016, 1, 10), 10)))
+
+    @print_test_name
+    def test_category_transactions_plan(self):
+        self.assert_uses_index(lambda: Category(category='gas').get_transactions())
+
+    @print_test_name
+    def test_transaction_filter_plan(self):
+        self.assert_uses_index(lambda: Transaction.get_transactions(account_id=self.account.id))
+        self.assert_uses_index(lambda: Transaction.get_transactions(category='gas'))
+
+    @print_test_name
+    def test_transaction_range_plan(self):
+        self.assert_uses_index(lambda: Transaction.get_transactions(
+            date_from=datetime.date(2016, 1, 5), date_to=datetime.date(2016, 1, 9)))
+        self.assert_uses_index(lambda: Transaction.get_transactions(
+            account_id=self.account.id, date_from=datetime.date(2016, 1, 5), limit=3))
+
+    @print_test_name
+    def test_balance_at_plan(self):
+        self.assert_uses_index(lambda: Account.balance_at(self.account.id, datetime.date(2016, 1, 10)))
+
+    @print_test_name
+    def test_cashflow_plan(self):
+        self.assert_uses_index(lambda: TransactionSummary.cashflow(
+            datetime.date(2016, 1, 1), datetime.date(2016, 3, 1)))
+
 
 if __name__ == "__main__":
     unittest.main()